@@ -1,14 +1,286 @@
 import numpy as np
 import scipy
 import scipy.interpolate
+import scipy.spatial
 import gc
 from . import RBFInterpolator
 import sys
+import time
 from functools import lru_cache
 MAX_CACHE = 2048
 
+# Default accuracy bound, in mm, a backend has to meet to be picked by "auto".
+DEFAULT_ACCURACY = 0.25
+
+
+def _axis_clusters(values, tolerance):
+    """Group axis values into lattice lines. Returns the sorted line positions and
+    the line index of every value, or None if the values do not cluster."""
+    order = np.argsort(values)
+    ordered = values[order]
+    gaps = np.diff(ordered)
+    if len(gaps) == 0 or gaps.max() <= 0:
+        return None
+    breaks = gaps > gaps.max() / 2.0
+    labels = np.empty(len(values), dtype=int)
+    labels[order] = np.concatenate(([0], np.cumsum(breaks)))
+    count = labels.max() + 1
+    lines = np.array([values[labels == n].mean() for n in range(count)])
+    spread = max(np.ptp(values[labels == n]) for n in range(count))
+    if count < 2 or spread > tolerance * np.diff(lines).min():
+        return None
+    return lines, labels
+
+
+def detect_grid(points, tolerance=0.05):
+    """
+    Checks whether the calibration points lie on a rectilinear lattice.
+
+    Measured points rarely sit exactly on the lattice; each line may wander by
+    `tolerance` times the smallest line spacing.
+
+    :param points: (P, 2) calibration coordinates.
+    :param tolerance: allowed wander as a fraction of line spacing.
+    :return: (xs, ys, index) where index maps each point to its (i, j) lattice node, or None.
+    """
+    points = np.asarray(points, dtype=float)
+    cx = _axis_clusters(points[:, 0], tolerance)
+    cy = _axis_clusters(points[:, 1], tolerance)
+    if cx is None or cy is None:
+        return None
+    xs, ix = cx
+    ys, iy = cy
+    if len(xs) * len(ys) != len(points):
+        return None
+    occupied = np.zeros((len(xs), len(ys)), dtype=bool)
+    occupied[ix, iy] = True
+    if not occupied.all():
+        return None
+    return xs, ys, (ix, iy)
+
+
+class CalBackend:
+    """
+    Maps calibration coordinates (mm) onto galvo coordinates. Backends are called with
+    (Q, 2) arrays and return (Q, 2) float arrays.
+    """
+    name = None
+    needs_grid = False
+    # Largest calibration "auto" will try this backend on, None for no limit.
+    max_points = None
+
+    def __init__(self, mcal, gcal, grid=None):
+        self.mcal = mcal
+        self.gcal = gcal
+
+    def __call__(self, xy):
+        raise NotImplementedError
+
+    def validation_residuals(self):
+        """
+        Residuals in galvo units used to judge the accuracy of this backend. Leave-one-out
+        where the backend can be refit cheaply, residual against the reference otherwise.
+        """
+        raise NotImplementedError
+
+
+class RBFBackend(CalBackend):
+    """Global thin plate spline, the original calibration method."""
+    name = "rbf"
+    # The global system is cubic in time and quadratic in memory.
+    max_points = 1500
+
+    def __init__(self, mcal, gcal, grid=None, kernel="thin_plate_spline", epsilon=None):
+        CalBackend.__init__(self, mcal, gcal, grid)
+        self.interpolator = RBFInterpolator.RBFInterpolator(
+            mcal, gcal, kernel=kernel, epsilon=epsilon
+        )
+
+    def __call__(self, xy):
+        return self.interpolator(xy)
+
+    def validation_residuals(self):
+        # Rippa's rule: for an interpolating RBF the leave-one-out residual of point i
+        # is coeffs[i] / inv(lhs)[i, i], so a single inverse replaces P refits.
+        interp = self.interpolator
+        lhs, rhs, shift, scale = RBFInterpolator._build_system_array(
+            interp.y, interp.d, interp.smoothing, interp.kernel, interp.epsilon, interp.powers
+        )
+        inverse = np.linalg.inv(lhs)
+        p = interp.y.shape[0]
+        diagonal = np.diag(inverse)[:p]
+        return interp._coeffs[:p] / diagonal[:, None]
+
+
+class LocalRBFBackend(RBFBackend):
+    """Thin plate spline solved per cell over the nearest calibration points, for dense calibrations."""
+    name = "local"
+    max_points = None
+
+    def __init__(self, mcal, gcal, grid=None, kernel="thin_plate_spline", epsilon=None, neighbors=16):
+        CalBackend.__init__(self, mcal, gcal, grid)
+        self.interpolator = RBFInterpolator.LocalRBFInterpolator(
+            mcal, gcal, neighbors=neighbors, kernel=kernel, epsilon=epsilon
+        )
+
+    def validation_residuals(self):
+        # Leave-one-out over each point's own neighborhood, solved as one batch.
+        interp = self.interpolator
+        p = interp.y.shape[0]
+        _, neighbors = interp._tree.query(interp.y, interp.neighbors + 1)
+        keep = neighbors != np.arange(p)[:, None]
+        keep[keep.all(axis=1), -1] = False
+        yidx = neighbors[keep].reshape(p, interp.neighbors)
+        shift, scale, coeffs = RBFInterpolator._build_and_solve_batch(
+            interp.y[yidx], interp.d[yidx], interp.smoothing[yidx],
+            interp.kernel, interp.epsilon, interp.powers
+        )
+        return RBFInterpolator._evaluate_batch(
+            interp.y, interp.y[yidx], interp.kernel, interp.epsilon, interp.powers,
+            shift, scale, coeffs
+        ) - interp.d
+
+
+class LinearBackend(CalBackend):
+    """Piecewise-linear on the Delaunay triangulation of the calibration points."""
+    name = "linear"
+    validation_neighbors = 24
+
+    def __init__(self, mcal, gcal, grid=None):
+        CalBackend.__init__(self, mcal, gcal, grid)
+        self.interpolator = scipy.interpolate.LinearNDInterpolator(mcal, gcal)
+        # Outside the convex hull we fall back to a least squares affine fit.
+        design = np.column_stack((mcal, np.ones(len(mcal))))
+        self.affine = np.linalg.lstsq(design, gcal, rcond=None)[0]
+
+    def __call__(self, xy):
+        xy = np.asarray(xy, dtype=float)
+        out = self.interpolator(xy)
+        outside = np.isnan(out[:, 0])
+        if outside.any():
+            out[outside] = np.column_stack((xy[outside], np.ones(outside.sum()))) @ self.affine
+        return out
+
+    def validation_residuals(self):
+        # Leaving a point out only changes the triangulation around it, so each point is
+        # left out of a triangulation of its nearest neighbors rather than of all points.
+        residuals = np.empty_like(self.gcal, dtype=float)
+        count = min(self.validation_neighbors + 1, len(self.mcal))
+        _, neighbors = scipy.spatial.KDTree(self.mcal).query(self.mcal, count)
+        for i, idx in enumerate(neighbors):
+            idx = idx[idx != i]
+            fit = scipy.interpolate.LinearNDInterpolator(self.mcal[idx], self.gcal[idx])
+            value = fit(self.mcal[i:i + 1])[0]
+            if np.isnan(value[0]):
+                value = np.append(self.mcal[i], 1.0) @ self.affine
+            residuals[i] = value - self.gcal[i]
+        return residuals
+
+
+class SplineBackend(CalBackend):
+    """Tensor-product bicubic spline, only valid for calibrations taken on a lattice."""
+    name = "spline"
+    needs_grid = True
+
+    def __init__(self, mcal, gcal, grid=None):
+        CalBackend.__init__(self, mcal, gcal, grid)
+        if grid is None:
+            raise ValueError("The spline backend requires calibration points on a regular grid.")
+        self.grid = grid
+        xs, ys, (ix, iy) = grid
+        k = min(3, len(xs) - 1, len(ys) - 1)
+        values = np.empty((len(xs), len(ys), 2))
+        values[ix, iy] = gcal
+        self.values = values
+        self.splines = [
+            scipy.interpolate.RectBivariateSpline(xs, ys, values[:, :, n], kx=k, ky=k)
+            for n in range(2)
+        ]
+
+    def __call__(self, xy):
+        xy = np.asarray(xy, dtype=float)
+        return np.column_stack([s.ev(xy[:, 0], xy[:, 1]) for s in self.splines])
+
+    def validation_residuals(self):
+        # Along a lattice line through a node the interpolating spline is the cubic spline
+        # of that line alone, so leaving the node out is a refit of its row and of its
+        # column without it. The worse of the two is kept, evaluated at the measured
+        # location so the cost of snapping points onto lattice lines is counted too.
+        xs, ys, (ix, iy) = self.grid
+        residuals = np.empty_like(self.gcal, dtype=float)
+        for p, (i, j) in enumerate(zip(ix, iy)):
+            along_x = self._leave_out(xs, self.values[:, j], i, self.mcal[p, 0]) - self.gcal[p]
+            along_y = self._leave_out(ys, self.values[i, :], j, self.mcal[p, 1]) - self.gcal[p]
+            residuals[p] = along_x if np.hypot(*along_x) >= np.hypot(*along_y) else along_y
+        return residuals
+
+    @staticmethod
+    def _leave_out(nodes, values, index, at):
+        """Value at `at` of the spline through nodes and values without node index."""
+        keep = np.arange(len(nodes)) != index
+        k = min(3, keep.sum() - 1)
+        if k == 2:
+            k = 1
+        return scipy.interpolate.make_interp_spline(nodes[keep], values[keep], k=k)(at)
+
+
+class LUTBackend(CalBackend):
+    """Reference RBF baked into a regular lookup table with bilinear lookups."""
+    name = "lut"
+    size = 129
+
+    def __init__(self, mcal, gcal, grid=None, reference=None):
+        CalBackend.__init__(self, mcal, gcal, grid)
+        if reference is None:
+            if len(mcal) > RBFBackend.max_points:
+                reference = LocalRBFBackend(mcal, gcal)
+            else:
+                reference = RBFBackend(mcal, gcal)
+        self.reference = reference
+        self.x0, self.y0 = mcal.min(axis=0)
+        x1, y1 = mcal.max(axis=0)
+        self.dx = (x1 - self.x0) / (self.size - 1)
+        self.dy = (y1 - self.y0) / (self.size - 1)
+        xs = self.x0 + self.dx * np.arange(self.size)
+        ys = self.y0 + self.dy * np.arange(self.size)
+        gx, gy = np.meshgrid(xs, ys, indexing="ij")
+        table = reference(np.column_stack((gx.ravel(), gy.ravel())))
+        self.table = table.reshape(self.size, self.size, 2)
+
+    def __call__(self, xy):
+        xy = np.asarray(xy, dtype=float)
+        fx = (xy[:, 0] - self.x0) / self.dx
+        fy = (xy[:, 1] - self.y0) / self.dy
+        # Clamping the cell but not the fraction extrapolates linearly off the table.
+        i = np.clip(np.floor(fx).astype(int), 0, self.size - 2)
+        j = np.clip(np.floor(fy).astype(int), 0, self.size - 2)
+        tx = (fx - i)[:, None]
+        ty = (fy - j)[:, None]
+        t = self.table
+        return (
+            t[i, j] * (1 - tx) * (1 - ty)
+            + t[i + 1, j] * tx * (1 - ty)
+            + t[i, j + 1] * (1 - tx) * ty
+            + t[i + 1, j + 1] * tx * ty
+        )
+
+    def validation_residuals(self):
+        # Error of the reference plus the error of baking it into the table.
+        baked = np.abs(self(self.mcal) - self.reference(self.mcal))
+        return np.abs(self.reference.validation_residuals()) + baked
+
+
+BACKENDS = {
+    RBFBackend.name: RBFBackend,
+    LocalRBFBackend.name: LocalRBFBackend,
+    SplineBackend.name: SplineBackend,
+    LinearBackend.name: LinearBackend,
+    LUTBackend.name: LUTBackend,
+}
+
+
 class Cal:
-    def __init__(self, cal_file):
+    def __init__(self, cal_file, backend="auto", accuracy=DEFAULT_ACCURACY):
         self.cache = {}
 
         if cal_file is None:
@@ -26,32 +298,139 @@ class Cal:
         self.mm_ymax = mm_y[-1]
         self.mm_ymin = mm_y[0]
 
-        self.linear_x = (mm_x[49] - mm_x[31]) / (g_x[49] - g_x[31])
-        self.linear_y = (mm_y[41] - mm_y[39]) / (g_y[41] - g_y[39])
+        # Least squares mm per galvo of each axis, valid for any grid size.
+        self.linear_x = np.polyfit(g_x, mm_x, 1)[0]
+        self.linear_y = np.polyfit(g_y, mm_y, 1)[0]
+
+        self.mcal = mcal
+        self.gcal = gcal
+        self.grid = detect_grid(mcal)
+        self.accuracy = accuracy
+        self.report = []
+        self._inverse = None
+        if backend == "auto":
+            self.interpolator = self._select_backend()
+        else:
+            if backend not in BACKENDS:
+                raise ValueError("Calibration backend must be one of %s." % ", ".join(BACKENDS))
+            self.interpolator = BACKENDS[backend](mcal, gcal, grid=self.grid)
+        self.backend = self.interpolator.name
+
+    def _candidates(self):
+        reference = None
+        for name, backend in BACKENDS.items():
+            if backend.needs_grid and self.grid is None:
+                continue
+            if backend.max_points is not None and len(self.mcal) > backend.max_points:
+                continue
+            start = time.perf_counter()
+            if backend is LUTBackend:
+                candidate = LUTBackend(self.mcal, self.gcal, grid=self.grid, reference=reference)
+            else:
+                candidate = backend(self.mcal, self.gcal, grid=self.grid)
+            built = time.perf_counter() - start
+            if isinstance(candidate, RBFBackend) and reference is None:
+                reference = candidate
+            yield candidate, built
+
+    def _error_mm(self, residuals):
+        """Euclidean length of galvo residuals, in mm."""
+        residuals = np.asarray(residuals, dtype=float)
+        return np.hypot(residuals[:, 0] * self.linear_x, residuals[:, 1] * self.linear_y)
+
+    def benchmark(self, candidate, samples=1000, singles=200, repeats=7):
+        """
+        Measures the evaluation speed and validation error of a backend on this calibration.
+        Times are medians, of repeats batches of samples points and of singles single point calls.
+
+        :return: dict with per point single/batch evaluation times (s) and errors (mm)
+        """
+        rng = np.random.default_rng(0)
+        lo = self.mcal.min(axis=0)
+        hi = self.mcal.max(axis=0)
+        points = lo + (hi - lo) * rng.random((samples, 2))
+        times = np.empty(repeats)
+        for n in range(repeats):
+            start = time.perf_counter()
+            candidate(points)
+            times[n] = time.perf_counter() - start
+        batch = float(np.median(times)) / samples
+        times = np.empty(singles)
+        for n in range(singles):
+            start = time.perf_counter()
+            candidate(points[n % samples:n % samples + 1])
+            times[n] = time.perf_counter() - start
+        single = float(np.median(times))
+        error = self._error_mm(candidate.validation_residuals())
+        return {
+            "backend": candidate.name,
+            "single": single,
+            "batch": batch,
+            "max_error": float(error.max()),
+            "mean_error": float(error.mean()),
+        }
+
+    def _select_backend(self):
+        """Pick the backend with the fastest batches within the accuracy bound, or the most
+        accurate if none are. Jobs are compiled through interpolate_array()."""
+        results = []
+        for candidate, built in self._candidates():
+            result = self.benchmark(candidate)
+            result["construct"] = built
+            results.append((result, candidate))
+        self.report = [r for r, c in results]
+        within = [rc for rc in results if rc[0]["max_error"] <= self.accuracy]
+        if within:
+            return min(within, key=lambda rc: rc[0]["batch"])[1]
+        return min(results, key=lambda rc: rc[0]["max_error"])[1]
 
-        #self.interpolator = scipy.interpolate.LinearNDInterpolator(
-        #        mcal,
-        #        gcal,
-        #        )
-        self.interpolator = RBFInterpolator.RBFInterpolator(
-                mcal,
-                gcal,
-                )
-
-        #self.interpolator = scipy.interpolate.CloughTocher2DInterpolator(
-        #        mcal,
-        #        gcal,
-        #        )
     @lru_cache(maxsize=MAX_CACHE)
     def interpolate(self, x, y):
         rv =  self.interpolator([(y,x)])[0]
         rv =  int(round(rv[1])), int(round(rv[0]))
         return rv
 
-    #def interpolate_list(self, xys):
-        #rv =  self.interpolator(xys)
-        #return [(int(round(x)), int(round(y))) for x,y in rv]
+    def interpolate_array(self, xys):
+        """Vectorized interpolate(): (N, 2) mm x, y to (N, 2) float galvo x, y."""
+        xys = np.asarray(xys, dtype=float)
+        return self.interpolator(xys[:, ::-1])[:, ::-1]
+
+    @property
+    def inverse_interpolator(self):
+        """
+        Backend mapping galvo back onto mm, built on first use. This is an RBF fit in the
+        inverse direction baked into a lookup table, so it agrees with the forward RBF
+        and handles millions of points per second.
+        """
+        if self._inverse is None:
+            self._inverse = LUTBackend(self.gcal, self.mcal)
+        return self._inverse
+
+    def inverse(self, x, y):
+        """Galvo x, y to calibrated mm x, y."""
+        rv = self.inverse_array([(x, y)])[0]
+        return float(rv[0]), float(rv[1])
+
+    def inverse_array(self, xys):
+        """Vectorized inverse(): (N, 2) galvo x, y to (N, 2) mm x, y."""
+        xys = np.asarray(xys, dtype=float)
+        return self.inverse_interpolator(xys[:, ::-1])[:, ::-1]
+
+    def round_trip_error(self, samples=10000):
+        """
+        Distance in mm between points and inverse(interpolate(point)), over random points
+        within the calibrated area. Includes rounding to whole galvo units.
+
+        :return: max error, mean error
+        """
+        rng = np.random.default_rng(0)
+        lo = self.mcal.min(axis=0)
+        hi = self.mcal.max(axis=0)
+        points = (lo + (hi - lo) * rng.random((samples, 2)))[:, ::-1]
+        back = self.inverse_array(np.round(self.interpolate_array(points)))
+        error = np.hypot(*(back - points).T)
+        return float(error.max()), float(error.mean())
+
 
 
 
-        
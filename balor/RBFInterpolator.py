@@ -36,13 +36,13 @@ from itertools import combinations_with_replacement
 import numpy as np
 from numpy.linalg import LinAlgError
 from scipy.spatial import KDTree
-from scipy.special import comb
+from scipy.special import comb, xlogy
 from scipy.linalg.lapack import dgesv  # type: ignore[attr-defined]
 
 from ._rbfinterp_pythran import _build_system, _evaluate, _polynomial_matrix
 
 
-__all__ = ["RBFInterpolator"]
+__all__ = ["RBFInterpolator", "LocalRBFInterpolator"]
 
 
 # These RBFs are implemented.
@@ -108,6 +108,165 @@ def _monomial_powers(ndim, degree):
     return out
 
 
+# Array versions of the kernels in `_rbfinterp_pythran`. That module is only fast
+# when compiled with pythran, these evaluate a whole distance matrix in numpy.
+_NAME_TO_ARRAY_FUNC = {
+    "linear": lambda r: -r,
+    "thin_plate_spline": lambda r: xlogy(r**2, r),
+    "cubic": lambda r: r**3,
+    "quintic": lambda r: -r**5,
+    "multiquadric": lambda r: -np.sqrt(r**2 + 1),
+    "inverse_multiquadric": lambda r: 1/np.sqrt(r**2 + 1),
+    "inverse_quadratic": lambda r: 1/(r**2 + 1),
+    "gaussian": lambda r: np.exp(-r**2)
+    }
+
+
+def _evaluate_array(x, y, kernel, epsilon, powers, shift, scale, coeffs,
+                    chunk=4096):
+    """Evaluate the RBF interpolant at `x` with numpy array operations.
+
+    Same arguments and result as `_evaluate`. The evaluation points are
+    processed `chunk` at a time to bound the size of the distance matrix.
+
+    """
+    kernel_func = _NAME_TO_ARRAY_FUNC[kernel]
+    p = y.shape[0]
+    yeps = y*epsilon
+    out = np.empty((x.shape[0], coeffs.shape[1]), dtype=float)
+    for start in range(0, x.shape[0], chunk):
+        xc = x[start:start + chunk]
+        diff = xc[:, None, :]*epsilon - yeps[None, :, :]
+        vec = kernel_func(np.sqrt(np.einsum("ijk,ijk->ij", diff, diff)))
+        xhat = (xc - shift)/scale
+        poly = np.prod(xhat[:, None, :]**powers[None, :, :], axis=-1)
+        out[start:start + chunk] = vec.dot(coeffs[:p]) + poly.dot(coeffs[p:])
+    return out
+
+
+def _build_system_array(y, d, smoothing, kernel, epsilon, powers):
+    """Build the RBF interpolation system with numpy array operations.
+
+    Same arguments and result as `_build_system`.
+
+    """
+    p = d.shape[0]
+    r = powers.shape[0]
+    kernel_func = _NAME_TO_ARRAY_FUNC[kernel]
+
+    mins = np.min(y, axis=0)
+    maxs = np.max(y, axis=0)
+    shift = (maxs + mins)/2
+    scale = (maxs - mins)/2
+    scale[scale == 0.0] = 1.0
+
+    yeps = y*epsilon
+    yhat = (y - shift)/scale
+
+    # Fortran order so that dgesv does not make a copy of lhs.
+    lhs = np.empty((p + r, p + r), dtype=float, order="F")
+    diff = yeps[:, None, :] - yeps[None, :, :]
+    lhs[:p, :p] = kernel_func(np.sqrt(np.einsum("ijk,ijk->ij", diff, diff)))
+    lhs[:p, p:] = np.prod(yhat[:, None, :]**powers[None, :, :], axis=-1)
+    lhs[p:, :p] = lhs[:p, p:].T
+    lhs[p:, p:] = 0.0
+    lhs[range(p), range(p)] += smoothing
+
+    rhs = np.empty((p + r, d.shape[1]), dtype=float, order="F")
+    rhs[:p] = d
+    rhs[p:] = 0.0
+    return lhs, rhs, shift, scale
+
+
+def _build_and_solve_batch(y, d, smoothing, kernel, epsilon, powers):
+    """Build and solve a batch of independent RBF systems of the same size.
+
+    Parameters
+    ----------
+    y : (B, P, N) float ndarray
+        Data point coordinates of each system.
+    d : (B, P, S) float ndarray
+        Data values at `y`.
+    smoothing : (B, P) float ndarray
+        Smoothing parameter for each data point.
+    kernel, epsilon, powers
+        As for `_build_and_solve_system`.
+
+    Returns
+    -------
+    shift : (B, N) float ndarray
+    scale : (B, N) float ndarray
+    coeffs : (B, P + R, S) float ndarray
+
+    """
+    b, p, _ = y.shape
+    r = powers.shape[0]
+    kernel_func = _NAME_TO_ARRAY_FUNC[kernel]
+
+    mins = np.min(y, axis=1)
+    maxs = np.max(y, axis=1)
+    shift = (maxs + mins)/2
+    scale = (maxs - mins)/2
+    scale[scale == 0.0] = 1.0
+
+    yeps = y*epsilon
+    yhat = (y - shift[:, None, :])/scale[:, None, :]
+
+    lhs = np.zeros((b, p + r, p + r), dtype=float)
+    diff = yeps[:, :, None, :] - yeps[:, None, :, :]
+    lhs[:, :p, :p] = kernel_func(np.sqrt(np.einsum("bijk,bijk->bij", diff, diff)))
+    lhs[:, :p, p:] = np.prod(yhat[:, :, None, :]**powers[None, None, :, :], axis=-1)
+    lhs[:, p:, :p] = np.swapaxes(lhs[:, :p, p:], 1, 2)
+    lhs[:, range(p), range(p)] += smoothing
+
+    rhs = np.zeros((b, p + r, d.shape[2]), dtype=float)
+    rhs[:, :p] = d
+    try:
+        coeffs = np.linalg.solve(lhs, rhs)
+    except LinAlgError:
+        raise LinAlgError(
+            "Singular matrix. A neighborhood of the data points does not "
+            "determine the interpolant."
+            )
+    return shift, scale, coeffs
+
+
+def _evaluate_batch(x, y, kernel, epsilon, powers, shift, scale, coeffs,
+                    chunk=4096):
+    """Evaluate each point of `x` against its own RBF system.
+
+    Parameters
+    ----------
+    x : (Q, N) float ndarray
+        Evaluation point coordinates.
+    y : (Q, P, N) float ndarray
+        Data point coordinates of the system for each evaluation point.
+    shift, scale, coeffs : (Q, N), (Q, N), (Q, P + R, S) float ndarray
+        The solved system for each evaluation point.
+
+    Returns
+    -------
+    (Q, S) float ndarray
+
+    """
+    kernel_func = _NAME_TO_ARRAY_FUNC[kernel]
+    p = y.shape[1]
+    out = np.empty((x.shape[0], coeffs.shape[2]), dtype=float)
+    for start in range(0, x.shape[0], chunk):
+        end = start + chunk
+        xc = x[start:end]
+        diff = (xc[:, None, :] - y[start:end])*epsilon
+        vec = kernel_func(np.sqrt(np.einsum("ijk,ijk->ij", diff, diff)))
+        xhat = (xc - shift[start:end])/scale[start:end]
+        poly = np.prod(xhat[:, None, :]**powers[None, :, :], axis=-1)
+        c = coeffs[start:end]
+        out[start:end] = (
+            np.einsum("ij,ijk->ik", vec, c[:, :p])
+            + np.einsum("ij,ijk->ik", poly, c[:, p:])
+            )
+    return out
+
+
 def _build_and_solve_system(y, d, smoothing, kernel, epsilon, powers):
     """Build and solve the RBF interpolation system of equations.
 
@@ -136,7 +295,7 @@ def _build_and_solve_system(y, d, smoothing, kernel, epsilon, powers):
         Domain scaling used to create the polynomial matrix.
 
     """
-    lhs, rhs, shift, scale = _build_system(
+    lhs, rhs, shift, scale = _build_system_array(
         y, d, smoothing, kernel, epsilon, powers
         )
     _, _, coeffs, info = dgesv(lhs, rhs, overwrite_a=True, overwrite_b=True)
@@ -444,7 +603,7 @@ class RBFInterpolator:
                 )
 
         if self.neighbors is None:
-            out = _evaluate(
+            out = _evaluate_array(
                 x, self.y, self.kernel, self.epsilon, self.powers, self._shift,
                 self._scale, self._coeffs
                 )
@@ -483,7 +642,7 @@ class RBFInterpolator:
                     ynbr, dnbr, snbr, self.kernel, self.epsilon, self.powers,
                     )
 
-                out[xidx] = _evaluate(
+                out[xidx] = _evaluate_array(
                     xnbr, ynbr, self.kernel, self.epsilon, self.powers, shift,
                     scale, coeffs
                     )
@@ -493,3 +652,133 @@ class RBFInterpolator:
         return out
 
 
+
+
+
+class LocalRBFInterpolator(RBFInterpolator):
+    """RBF interpolation solved locally, cell by cell, for dense data.
+
+    The bounding box of `y` is divided into cells about the size of the data
+    spacing. Each cell is interpolated by the RBF through the `neighbors`
+    observations nearest the cell center. Those systems are solved the first
+    time a cell is queried, all the new cells of a query together, and kept,
+    so evaluation is one vectorized pass over the cached cell coefficients.
+    Construction and evaluation cost grow linearly with the number of
+    observations, rather than the cubic cost and quadratic memory of the
+    global system.
+
+    Neighboring cells use different observations, so the interpolant is not
+    exactly continuous across cell edges.
+
+    Parameters
+    ----------
+    y, d, smoothing, kernel, epsilon, degree
+        As for `RBFInterpolator`.
+    neighbors : int, optional
+        Number of observations in each cell's system. The default of 16 is
+        the 4x4 block of observations around a cell of a regular lattice.
+    cell_size : float, optional
+        Edge length of the cells. Defaults to the mean distance between
+        each observation and its nearest neighbor.
+
+    """
+
+    def __init__(self, y, d,
+                 neighbors=16,
+                 cell_size=None,
+                 smoothing=0.0,
+                 kernel="thin_plate_spline",
+                 epsilon=None,
+                 degree=None):
+        RBFInterpolator.__init__(
+            self, y, d, neighbors=neighbors, smoothing=smoothing,
+            kernel=kernel, epsilon=epsilon, degree=degree
+            )
+        if cell_size is None:
+            cell_size = 0.0
+            if self.y.shape[0] > 1:
+                distance, _ = self._tree.query(self.y, 2)
+                cell_size = np.mean(distance[:, 1])
+            if cell_size <= 0.0:
+                cell_size = 1.0
+        self.cell_size = float(cell_size)
+        self._origin = self.y.min(axis=0)
+        extent = self.y.max(axis=0) - self._origin
+        self._cells = np.maximum(np.ceil(extent/self.cell_size), 1).astype(int)
+
+        ncells = int(np.prod(self._cells))
+        k = self.neighbors
+        ndim = self.y.shape[1]
+        self._solved = np.zeros(ncells, dtype=bool)
+        self._cell_y = np.zeros((ncells, k, ndim), dtype=float)
+        self._cell_shift = np.zeros((ncells, ndim), dtype=float)
+        self._cell_scale = np.ones((ncells, ndim), dtype=float)
+        self._cell_coeffs = np.zeros(
+            (ncells, k + self.powers.shape[0], self.d.shape[1]), dtype=float
+            )
+
+    def _cell_index(self, x):
+        """Flat index of the cell of each point, points outside fall in the
+        nearest edge cell."""
+        index = np.floor((x - self._origin)/self.cell_size).astype(int)
+        index = np.clip(index, 0, self._cells - 1)
+        return np.ravel_multi_index(tuple(index.T), self._cells)
+
+    def _solve_cells(self, cells):
+        """Solve the systems of `cells` in one batch and cache them."""
+        corners = np.array(np.unravel_index(cells, self._cells)).T
+        centers = self._origin + (corners + 0.5)*self.cell_size
+        _, yidx = self._tree.query(centers, self.neighbors)
+        yidx = np.sort(yidx.reshape(len(cells), -1), axis=1)
+        shift, scale, coeffs = _build_and_solve_batch(
+            self.y[yidx], self.d[yidx], self.smoothing[yidx], self.kernel,
+            self.epsilon, self.powers
+            )
+        self._cell_y[cells] = self.y[yidx]
+        self._cell_shift[cells] = shift
+        self._cell_scale[cells] = scale
+        self._cell_coeffs[cells] = coeffs
+        self._solved[cells] = True
+
+    def solve(self):
+        """Solve the system of every cell now rather than on first use."""
+        self._solve_cells(np.flatnonzero(~self._solved))
+
+    def __call__(self, x):
+        """Evaluate the interpolant at `x`.
+
+        Parameters
+        ----------
+        x : (Q, N) array_like
+            Evaluation point coordinates.
+
+        Returns
+        -------
+        (Q, ...) ndarray
+            Values of the interpolant at `x`.
+
+        """
+        x = np.asarray(x, dtype=float, order="C")
+        if x.ndim != 2:
+            raise ValueError("`x` must be a 2-dimensional array.")
+
+        nx, ndim = x.shape
+        if ndim != self.y.shape[1]:
+            raise ValueError(
+                "Expected the second axis of `x` to have length "
+                f"{self.y.shape[1]}."
+                )
+
+        cells = self._cell_index(x)
+        unsolved = np.unique(cells[~self._solved[cells]])
+        if len(unsolved):
+            self._solve_cells(unsolved)
+
+        out = _evaluate_batch(
+            x, self._cell_y[cells], self.kernel, self.epsilon, self.powers,
+            self._cell_shift[cells], self._cell_scale[cells],
+            self._cell_coeffs[cells]
+            )
+        out = out.view(self.d_dtype)
+        out = out.reshape((nx,) + self.d_shape)
+        return out
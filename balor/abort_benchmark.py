@@ -0,0 +1,138 @@
+"""
+Abort benchmark.
+
+Starts a long marking job, aborts it at a random point and measures the time from the
+abort call until the board acknowledged the stop and the laser off (Sender.stop_latency),
+until the job thread gave up, and until the machine was idle and ready again. Runs
+against the emulated board by default, or a real one with --machine, and writes JSON
+with the latency distribution and whether every stop met the target.
+
+    python -m balor.abort_benchmark --trials 100 --output abort.json
+"""
+import argparse
+import json
+import platform
+import sys
+import threading
+import time
+
+import numpy as np
+
+from .command_list import CommandList
+from .emulator import EmulatedConnection
+from .sender import Sender
+
+
+def marking_job(lines=2000, speed=500):
+    """Hatches back and forth across the field, a minute or more of marking."""
+    job = CommandList()
+    job.set_frequency(30)
+    job.set_power(50)
+    job.set_laser_on_delay(100)
+    job.set_laser_off_delay(100)
+    job.set_polygon_delay(10)
+    job.set_travel_speed(2000)
+    job.set_cut_speed(speed)
+    for i in range(lines):
+        y = 0x4000 + (i * 16) % 0x8000
+        job.goto(0x4000, y)
+        job.mark(0xC000, y)
+    return job
+
+
+def distribution(samples):
+    samples = np.asarray(samples, dtype=float)
+    if not len(samples):
+        return None
+    return {
+        "count": int(len(samples)),
+        "mean": float(samples.mean()),
+        "p50": float(np.percentile(samples, 50)),
+        "p95": float(np.percentile(samples, 95)),
+        "p99": float(np.percentile(samples, 99)),
+        "max": float(samples.max()),
+    }
+
+
+def benchmark(sender, trials, min_delay, max_delay, seed=0):
+    rng = np.random.default_rng(seed)
+    job = marking_job()
+    stop, exit_, idle, failures = [], [], [], 0
+    for trial in range(trials):
+        done = threading.Event()
+        thread = threading.Thread(
+            target=lambda: (sender.execute(job, float("inf")), done.set()), daemon=True
+        )
+        thread.start()
+        time.sleep(rng.uniform(min_delay, max_delay))
+        start = time.perf_counter()
+        abort = threading.Thread(target=sender.abort, daemon=True)
+        abort.start()
+        done.wait(10)
+        exited = time.perf_counter() - start
+        abort.join(10)
+        ended = time.perf_counter() - start
+        thread.join(10)
+        if thread.is_alive() or abort.is_alive() or sender.is_busy():
+            failures += 1
+            continue
+        stop.append(sender.stop_latency)
+        exit_.append(exited)
+        idle.append(ended)
+    return {
+        "trials": trials,
+        "failures": failures,
+        "stop_latency": distribution(stop),
+        "job_exit": distribution(exit_),
+        "idle": distribution(idle),
+    }
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Benchmark aborting a running job.")
+    parser.add_argument("--trials", type=int, default=50)
+    parser.add_argument("--target", type=float, default=0.050, help="stop latency target in seconds")
+    parser.add_argument(
+        "--delay",
+        type=float,
+        nargs=2,
+        default=(0.02, 0.5),
+        metavar=("MIN", "MAX"),
+        help="seconds the job runs before the abort, drawn uniformly",
+    )
+    parser.add_argument("--machine", type=int, help="benchmark this machine index, not the emulator")
+    parser.add_argument("--handshake", default="packet", help="packet or start")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write JSON here instead of stdout")
+    args = parser.parse_args(args)
+
+    sender = Sender()
+    sender.handshake = args.handshake
+    if args.machine is None:
+        sender.open(mock=EmulatedConnection())
+    else:
+        sender.open(machine_index=args.machine)
+    try:
+        result = benchmark(sender, args.trials, args.delay[0], args.delay[1], args.seed)
+    finally:
+        sender.close()
+    worst = result["stop_latency"]["max"] if result["stop_latency"] else None
+    report = {
+        "benchmark": "abort",
+        "python": platform.python_version(),
+        "machine": "emulator" if args.machine is None else args.machine,
+        "handshake": args.handshake,
+        "target": args.target,
+        "met": worst is not None and worst < args.target and not result["failures"],
+        "result": result,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=1)
+    else:
+        json.dump(report, sys.stdout, indent=1)
+        print()
+
+
+if __name__ == "__main__":
+    main()
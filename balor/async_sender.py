@@ -0,0 +1,130 @@
+# Balor Galvo Laser Control Module
+# Copyright (C) 2021-2022 Gnostic Instruments, Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import asyncio
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from balor.sender import Sender
+
+# kind is "started", "packet", "loop", "finished" or "aborted". loop and packet
+# are the loop and packet index where they apply, otherwise None.
+ProgressEvent = namedtuple("ProgressEvent", "kind loop packet time")
+
+
+class AsyncSender:
+    """asyncio facade for a Sender.
+
+    The blocking Sender calls run on a small executor owned by this object: one
+    thread for jobs and one for control (abort, status), so an abort is never
+    stuck behind the job it is aborting. Many AsyncSenders can share one event
+    loop, one per device.
+
+        sender = AsyncSender()
+        await sender.open(mock=True)
+        async for event in sender.progress():
+            ...
+    """
+
+    def __init__(self, sender=None, **kwargs):
+        self.sender = sender if sender is not None else Sender(**kwargs)
+        self._job_executor = ThreadPoolExecutor(1, thread_name_prefix="balor-job")
+        self._control_executor = ThreadPoolExecutor(1, thread_name_prefix="balor-control")
+        self._subscribers = set()
+        self._loop = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    def _run(self, executor, function, *args, **kwargs):
+        self._loop = asyncio.get_running_loop()
+        return self._loop.run_in_executor(executor, lambda: function(*args, **kwargs))
+
+    async def open(self, **kwargs):
+        """Open the connection, takes the arguments of Sender.open."""
+        return await self._run(self._control_executor, self.sender.open, **kwargs)
+
+    async def close(self):
+        """Close the connection and end every progress() iteration."""
+        if self.sender._usb_connection is not None:
+            await self._run(self._control_executor, self.sender.close)
+        for queue in list(self._subscribers):
+            queue.put_nowait(None)
+        self._job_executor.shutdown(wait=False)
+        self._control_executor.shutdown(wait=False)
+
+    def _publish(self, kind, loop=None, packet=None):
+        event = ProgressEvent(kind, loop, packet, time.time())
+        for queue in list(self._subscribers):
+            queue.put_nowait(event)
+
+    def _publish_threadsafe(self, kind, loop=None, packet=None):
+        self._loop.call_soon_threadsafe(self._publish, kind, loop, packet)
+
+    async def execute(self, job, loop_count=1):
+        """Run a job, see Sender.execute. Cancelling the awaiting task aborts the job,
+        or drops it without running it if it is still queued behind another.
+
+        :return: True if the job ran to completion, False if it was aborted.
+        """
+        self._loop = asyncio.get_running_loop()
+        self._publish("started")
+        # The executor's own future, which can only be cancelled while it is queued.
+        queued = self._job_executor.submit(
+            self.sender.execute,
+            job,
+            loop_count,
+            callback_progress=self._publish_threadsafe,
+        )
+        future = asyncio.wrap_future(queued)
+        try:
+            completed = await asyncio.shield(future)
+        except asyncio.CancelledError:
+            if not queued.cancel() and not queued.done():
+                await self.abort()
+                await asyncio.wait([future])
+            self._publish("aborted")
+            raise
+        self._publish("finished" if completed else "aborted")
+        return completed
+
+    loop_job = execute
+
+    async def abort(self):
+        """Abort any job in progress, see Sender.abort."""
+        await self._run(self._control_executor, self.sender.abort)
+
+    async def status(self):
+        """A freshly read 16 bit condition register."""
+        monitor = self.sender.monitor
+        await self._run(self._control_executor, monitor.wait_for, lambda status: True)
+        return monitor.status
+
+    async def progress(self):
+        """Iterate over ProgressEvents until the sender is closed."""
+        queue = asyncio.Queue()
+        self._subscribers.add(queue)
+        try:
+            while True:
+                event = await queue.get()
+                if event is None:
+                    return
+                yield event
+        finally:
+            self._subscribers.discard(queue)
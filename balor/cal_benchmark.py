@@ -0,0 +1,200 @@
+"""
+Calibration benchmark.
+
+Measures construction time, single point and batch throughput, lru cache hit rate and
+leave-one-out residuals of the RBF calibration for every kernel RBFInterpolator offers,
+solved globally and per cell (LocalRBFInterpolator).
+Runs offline against calibration files and synthetic distorted grids, and writes JSON so
+runs before and after a change can be diffed.
+
+    python -m balor.cal_benchmark cal_0002.csv --output before.json
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+import numpy as np
+import scipy
+from numpy.linalg import LinAlgError
+from scipy.spatial import KDTree
+
+from .Cal import Cal, LocalRBFBackend, RBFBackend
+from .RBFInterpolator import _AVAILABLE, _SCALE_INVARIANT
+
+
+def write_synthetic_cal(filename, size, distortion=2.5e-6, noise=0.01, seed=0):
+    """
+    Writes a size x size calibration file in the cal_*.csv format: a regular galvo lattice
+    from 0x2000 to 0xE000 measured through a lens with radial distortion plus measurement noise.
+    """
+    rng = np.random.default_rng(seed)
+    steps = np.linspace(0x2000, 0xE000, size).round().astype(int)
+    mm_per_galvo = 0.0026
+    half = size // 2
+    with open(filename, "w") as f:
+        for i, gx in enumerate(steps):
+            for j, gy in enumerate(steps):
+                x = (gx - 0x8000) * mm_per_galvo
+                y = (gy - 0x8000) * mm_per_galvo
+                k = 1 + distortion * (x * x + y * y)
+                x, y = np.array([x * k, y * k]) + rng.normal(0, noise, 2)
+                f.write(
+                    "%+09.4f %+09.4f %4d %4d %04X %04X\n"
+                    % (x, y, i - half, j - half, gx, gy)
+                )
+
+
+def kernel_epsilon(points):
+    """Shape parameter for kernels that are not scale invariant, one over the point spacing."""
+    distance, _ = KDTree(points).query(points, 2)
+    return 1.0 / np.mean(distance[:, 1])
+
+
+def job_workload(cal, points=500, repeats=10):
+    """An outline traced `repeats` times, like a looped light job."""
+    lo = cal.mcal.min(axis=0)
+    hi = cal.mcal.max(axis=0)
+    t = np.linspace(0, 2 * np.pi, points, endpoint=False)
+    center = (lo + hi) / 2.0
+    radius = (hi - lo) / 3.0
+    outline = np.column_stack(
+        (center[0] + radius[0] * np.cos(t), center[1] + radius[1] * np.sin(t))
+    )
+    return [(float(x), float(y)) for x, y in outline] * repeats
+
+
+MODES = {"global": RBFBackend, "local": LocalRBFBackend}
+
+
+def benchmark_kernel(cal, kernel, mode="global", singles=200, batch=10000):
+    result = {"kernel": kernel, "mode": mode}
+    epsilon = None if kernel in _SCALE_INVARIANT else kernel_epsilon(cal.mcal)
+    start = time.perf_counter()
+    try:
+        backend = MODES[mode](cal.mcal, cal.gcal, kernel=kernel, epsilon=epsilon)
+        if mode == "local":
+            # Cells are otherwise solved on first use, count them all as construction.
+            backend.interpolator.solve()
+    except (LinAlgError, ValueError) as e:
+        result["error"] = str(e)
+        return result
+    result["construct_s"] = time.perf_counter() - start
+    result["epsilon"] = epsilon
+
+    rng = np.random.default_rng(0)
+    lo = cal.mcal.min(axis=0)
+    hi = cal.mcal.max(axis=0)
+    points = lo + (hi - lo) * rng.random((max(batch, singles), 2))
+
+    start = time.perf_counter()
+    for n in range(singles):
+        backend(points[n : n + 1])
+    result["single_pts_per_s"] = singles / (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    backend(points[:batch])
+    result["batch_pts_per_s"] = batch / (time.perf_counter() - start)
+
+    cal.interpolator = backend
+    Cal.interpolate.cache_clear()
+    start = time.perf_counter()
+    workload = job_workload(cal)
+    for x, y in workload:
+        cal.interpolate(x, y)
+    result["workload_pts_per_s"] = len(workload) / (time.perf_counter() - start)
+    info = Cal.interpolate.cache_info()
+    result["cache_hits"] = info.hits
+    result["cache_misses"] = info.misses
+    result["cache_hit_rate"] = info.hits / float(info.hits + info.misses)
+
+    start = time.perf_counter()
+    try:
+        residuals = backend.validation_residuals()
+    except LinAlgError as e:
+        result["loo_error"] = str(e)
+        return result
+    result["loo_s"] = time.perf_counter() - start
+    error = cal._error_mm(residuals)
+    result["loo_max_mm"] = float(error.max())
+    result["loo_mean_mm"] = float(error.mean())
+    result["loo_rms_mm"] = float(np.sqrt(np.mean(error ** 2)))
+    return result
+
+
+def benchmark_file(filename, kernels, modes=("global",), name=None):
+    cal = Cal(filename, backend="local")
+    results = []
+    for mode in modes:
+        for kernel in kernels:
+            result = benchmark_kernel(cal, kernel, mode)
+            result["dataset"] = name or os.path.basename(filename)
+            result["points"] = len(cal.mcal)
+            results.append(result)
+            print(
+                "%-24s %5d %-6s %-20s %s"
+                % (
+                    result["dataset"],
+                    result["points"],
+                    mode,
+                    kernel,
+                    result.get("error", "%.4fs loo max %.4fmm" % (
+                        result["construct_s"], result.get("loo_max_mm", float("nan"))
+                    )),
+                ),
+                file=sys.stderr,
+            )
+    return results
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Benchmark the calibration interpolation.")
+    parser.add_argument("calfiles", nargs="*", help="calibration files to benchmark")
+    parser.add_argument(
+        "--sizes",
+        default="9,17,33,65",
+        help="comma separated synthetic grid sizes, 9 is 81 points, 65 is 4225. Empty for none.",
+    )
+    parser.add_argument(
+        "--kernels", default=",".join(sorted(_AVAILABLE)), help="comma separated kernels"
+    )
+    parser.add_argument(
+        "--modes", default="global,local", help="comma separated solves, global and/or local"
+    )
+    parser.add_argument("--output", help="write JSON here instead of stdout")
+    args = parser.parse_args(args)
+
+    kernels = [k for k in args.kernels.split(",") if k]
+    modes = [m for m in args.modes.split(",") if m]
+    results = []
+    for filename in args.calfiles:
+        results.extend(benchmark_file(filename, kernels, modes))
+    sizes = [int(s) for s in args.sizes.split(",") if s]
+    with tempfile.TemporaryDirectory() as directory:
+        for size in sizes:
+            filename = os.path.join(directory, "synthetic_%d.csv" % size)
+            write_synthetic_cal(filename, size)
+            results.extend(
+                benchmark_file(filename, kernels, modes, name="synthetic_%dx%d" % (size, size))
+            )
+
+    report = {
+        "benchmark": "calibration",
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "scipy": scipy.__version__,
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=1)
+    else:
+        json.dump(report, sys.stdout, indent=1)
+        print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""
+Generates on-board correction tables (.cor) from calibration files (cal_*.csv).
+
+The board corrects a 65x65 grid of galvo positions, 0x400 apart, by the offsets in its
+correction table. A table generated here makes a board fed with linear galvo coordinates,
+
+    galvo = 0x8000 + mm / mm_per_galvo
+
+land where Cal.interpolate(mm) would have put it, so jobs need no host interpolation.
+
+    python -m balor.calcor cal_0002.csv lens.cor
+"""
+import argparse
+import sys
+
+import numpy as np
+
+from .Cal import Cal
+
+HEADER_SIZE = 0x24
+GRID_SIZE = 65
+GRID_STEP = 0x400
+
+
+def correction_table(cal, mm_per_galvo=None):
+    """
+    Fits a calibration into a board correction table.
+
+    Entries are ordered x major, as Sender._read_correction_file reads them, and are the
+    offset from each grid node to the galvo position the calibration gives for it.
+
+    :param cal: Cal object.
+    :param mm_per_galvo: (x, y) scale of the linear galvo space. Defaults to the linear
+        scale of the calibration itself, which keeps offsets small.
+    :return: (4225, 2) int array of galvo x, y offsets.
+    """
+    if mm_per_galvo is None:
+        # interpolate() takes x, y swapped relative to the calibration file columns.
+        mm_per_galvo = (cal.linear_y, cal.linear_x)
+    nodes = np.minimum(np.arange(GRID_SIZE) * GRID_STEP, 0xFFFF)
+    gx, gy = np.meshgrid(nodes, nodes, indexing="ij")
+    linear = np.column_stack((gx.ravel(), gy.ravel())).astype(float)
+    mm = (linear - 0x8000) * np.asarray(mm_per_galvo, dtype=float)
+    target = np.clip(np.round(cal.interpolate_array(mm)), 0, 0xFFFF)
+    return (target - linear).astype(int)
+
+
+def encode_correction_table(table):
+    """Encodes a correction table as .cor file data: a blank header then int32 dx, dy pairs."""
+    table = np.asarray(table, dtype=np.int64)
+    if np.abs(table).max(initial=0) >= 0x8000:
+        raise ValueError("Correction offsets must be within +/-0x7FFF galvo units.")
+    return bytes(HEADER_SIZE) + table.astype("<i4").tobytes()
+
+
+def write_correction_file(filename, table):
+    with open(filename, "wb") as f:
+        f.write(encode_correction_table(table))
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description="Generate an on-board correction table from a calibration file."
+    )
+    parser.add_argument("calfile", help="calibration file, cal_*.csv")
+    parser.add_argument("corfile", help="correction file to write")
+    parser.add_argument(
+        "--scale",
+        type=float,
+        nargs=2,
+        metavar=("X", "Y"),
+        help="mm per galvo unit of the linear galvo space, defaults to the calibration's",
+    )
+    args = parser.parse_args(args)
+    cal = Cal(args.calfile)
+    table = correction_table(cal, args.scale)
+    write_correction_file(args.corfile, table)
+    scale = args.scale or (cal.linear_y, cal.linear_x)
+    print(
+        "Wrote {file}: largest offset {offset} galvo, lens size {x:.2f}mm x {y:.2f}mm.".format(
+            file=args.corfile,
+            offset=int(np.abs(table).max()),
+            x=scale[0] * 0xFFFF,
+            y=scale[1] * 0xFFFF,
+        ),
+        file=sys.stderr,
+    )
+
+
+if __name__ == "__main__":
+    main()
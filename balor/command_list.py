@@ -1,4 +1,5 @@
 import math
+import queue
 
 import numpy as np
 
@@ -562,9 +563,17 @@ def OperationFactory(code, tracking=None, position=0):
 
 class CommandSource:
     tick = None
+    # Changes whenever the job's own methods change the packets, None if that
+    # cannot be told, so a Sender never runs the job again from packets it sent
+    # before. Edits made to the operations directly are caught by fingerprint().
+    version = None
     def packet_generator(self):
         assert False, "Override this abstract method!"
 
+    def fingerprint(self):
+        """Hash of everything the packets are compiled from, None if unknown."""
+        return None
+
 class CommandBinary(CommandSource):
     def __init__(self, data, repeat=1):
         self._original_data = data
@@ -580,6 +589,69 @@ class CommandBinary(CommandSource):
             self._repeat -= 1
 
 
+class CommandStream(CommandSource):
+    """
+    A job whose packets are put by another thread while it runs, so marking starts before the
+    job is finished being built. At most `depth` packets wait to be sent; put() blocks until
+    there is room, and returns False once the job has stopped taking packets, after an abort.
+    close() ends the job after the packets put so far. Run it with a Sender pipeline_depth, the
+    default, so an abort does not wait on the next packet. Whoever runs it must stop() it when
+    the run ends however it ends, or put() waits for a job that will never take the packets.
+    """
+
+    def __init__(self, depth=16):
+        self.depth = depth
+        self._queue = queue.Queue(depth)
+        self._stopped = False
+        self.packets = 0
+        self.error = None
+
+    def put(self, packet):
+        while not self._stopped:
+            try:
+                self._queue.put(packet, timeout=0.1)
+                self.packets += 1
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def close(self):
+        return self.put(None)
+
+    def stop(self, error=None):
+        """
+        Stops taking packets, put() returns False from here on. error is the exception the run
+        ended with, if it failed.
+        """
+        if error is not None:
+            self.error = error
+        self._stopped = True
+
+    @property
+    def stopped(self):
+        return self._stopped
+
+    @property
+    def waiting(self):
+        return self._queue.qsize()
+
+    def packet_generator(self):
+        try:
+            while True:
+                try:
+                    packet = self._queue.get(timeout=0.1)
+                except queue.Empty:
+                    if self._stopped:
+                        return
+                    continue
+                if packet is None:
+                    return
+                yield packet
+        finally:
+            self.stop()
+
+
 class CommandList(CommandSource):
     def __init__(self,
                  machine=None,
@@ -591,11 +663,14 @@ class CommandList(CommandSource):
                  ):
         self.machine = machine
         self.tick = tick
+        self.version = 0
 
         self._last_x = x
         self._last_y = y
         self._start_x = x
         self._start_y = y
+        # Position the packets taken so far leave off at, see take_packets().
+        self._taken_xy = x, y
         self.cal = cal
         self._sender = sender
         self.operations = []
@@ -632,6 +707,7 @@ class CommandList(CommandSource):
 
     def clear(self):
         self.operations.clear()
+        self.version += 1
         self._ready = False
         self._cut_speed = None
         self._travel_speed = None
@@ -651,15 +727,18 @@ class CommandList(CommandSource):
     def duplicate(self, begin, end, repeats=1):
         for _ in range(repeats):
             self.operations.extend(self.operations[begin:end])
+        self.version += 1
 
     def append(self, x):
         x.bind(self)
         self.operations.append(x)
+        self.version += 1
 
     def extend(self, x):
         for op in x:
             op.bind(self)
         self.operations.extend(x)
+        self.version += 1
 
     def execute(self, loop_count=1, *args, **kwargs):
         if not self._sender:
@@ -669,6 +748,15 @@ class CommandList(CommandSource):
     def __iter__(self):
         return iter(self.operations)
 
+    def fingerprint(self):
+        """
+        Hash of the start position and of every operation's opcode and parameters, a tenth of
+        the cost of compiling them. Compiling fills in distances, so this is taken after.
+        """
+        return hash(
+            (self._start_x, self._start_y, tuple([(op.opcode, *op.params) for op in self.operations]))
+        )
+
     def __bytes__(self):
         return bytes(self.serialize())
 
@@ -697,6 +785,34 @@ class CommandList(CommandSource):
             i += 12
         return buf
 
+    def take_packets(self, final=False):
+        """
+        Performs final operations on the operations of every full packet, and of the last partial
+        one if final, and removes them, returning the packets. Operations added later carry on
+        from where these left off, so a job can be sent a packet at a time as it is built.
+        :return: list of packets
+        """
+        count = len(self.operations) if final else len(self.operations) - len(self.operations) % 256
+        last_xy = self._taken_xy
+        packets = []
+        eol = bytes([0x02, 0x80] + [0] * 10)  # End of Line Command
+        for n in range(0, count, 256):
+            buf = bytearray(eol * 256)
+            for i, op in enumerate(self.operations[n:n + 256]):
+                if op.has_d():
+                    nx, ny = op.get_xy()
+                    x, y = last_xy
+                    op.set_d(int(((nx - x) ** 2 + (ny - y) ** 2) ** 0.5))
+                if op.has_xy():
+                    last_xy = op.get_xy()
+                buf[i * 12: i * 12 + 12] = op.serialize()
+            packets.append(bytes(buf))
+        if count:
+            del self.operations[:count]
+            self.version += 1
+        self._taken_xy = last_xy
+        return packets
+
     def packet_generator(self):
         """
         Performs final operations and generates packets on the fly.
@@ -910,6 +1026,29 @@ class CommandList(CommandSource):
         self._last_y = y
         self.append(OpCut(*self.pos(x, y)))
 
+    def mark_polyline(self, points):
+        """
+        Mark through each of a run of points, as mark(x, y) for each, with the settings
+        checked once and the calibration applied to the whole run at once.
+        :param points: (N, 2) x, y
+        :return:
+        """
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        if not len(points):
+            return
+        self.mark(*points[0])
+        if len(points) == 1:
+            return
+        rest = points[1:]
+        if self.cal is None:
+            xys = rest.astype(int)
+        elif hasattr(self.cal, "interpolate_array"):
+            xys = np.rint(self.cal.interpolate_array(rest)).astype(int)
+        else:
+            xys = np.array([self.cal.interpolate(x, y) for x, y in rest.tolist()])
+        self._last_x, self._last_y = rest[-1].tolist()
+        self.extend([OpCut(x, y) for x, y in xys.tolist()])
+
     def jump_delay(self, delay=0x0008):
         if self._jump_delay == delay:
             return
@@ -962,6 +1101,7 @@ class CommandList(CommandSource):
         self._last_y = y
         self._start_x = x
         self._start_y = y
+        self.version += 1
 
     def set_mark_settings(
         self,
@@ -1023,6 +1163,7 @@ class CommandList(CommandSource):
             op = OperationFactory(command, tracking=tracking, position=i)
             op.bind(self)
             self.operations.append(op)
+            self.version += 1
             i += 12
 
     def plot(self, draw, resolution=2048, show_travels=False):
@@ -0,0 +1,385 @@
+# Balor Galvo Laser Control Module
+# Copyright (C) 2021-2022 Gnostic Instruments, Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import time
+from collections import deque
+
+import numpy as np
+import usb.core
+
+from balor.sender import (
+    UsbConnection, UsbStats, BalorDataValidityException,
+    EXECUTE_LIST, GET_REGISTER, GET_SERIAL_NUMBER, GET_LIST_STATUS,
+    GET_XY_POSITION, SET_XY_POSITION, RESET_LIST, RESTART_LIST, SET_END_OF_LIST,
+    STOP_EXECUTE, STOP_LIST, WRITE_PORT, READ_PORT, WRITE_CORRECTION_LINE,
+    STATUS_BUSY, STATUS_READY,
+)
+
+# List opcodes the emulator gives a duration or an effect to.
+OP_TRAVEL = 0x8001
+OP_MARK_END_DELAY = 0x8004
+OP_CUT = 0x8005
+OP_TRAVEL_SPEED = 0x8006
+OP_LASER_ON_DELAY = 0x8007
+OP_LASER_OFF_DELAY = 0x8008
+OP_CUT_SPEED = 0x800C
+OP_JUMP_DELAY = 0x800D
+OP_POLYGON_DELAY = 0x800F
+OP_WRITE_PORT = 0x8011
+OP_LASER_CONTROL = 0x8021
+
+SPEED_UNIT = 1.9656  # mm/s per unit of the speed list commands
+
+
+def _ops(data):
+    """The (opcode, param0, param1, param2) of each op in a list packet."""
+    words = np.frombuffer(bytes(data), dtype="<u2").reshape(-1, 6)
+    return zip(*(words[:, i].tolist() for i in range(4)))
+
+
+class EmulatedConnection:
+    """A stand in for UsbConnection that behaves like an LMC board.
+
+    List chunks go into a buffer of buffer_packets packets. STATUS_READY is
+    set while there is room in it and STATUS_BUSY from EXECUTE_LIST until the
+    list has played out to SET_END_OF_LIST(0) or is stopped. The ops are
+    played against the clock: moves take their distance over the last set
+    travel or cut speed, plus the jump, laser and mark end delays. The
+    machine state is advanced lazily whenever the host talks to it, so no
+    thread is needed.
+
+    Writing a chunk while the buffer is full blocks until there is room, and
+    times out like a NAKed endpoint after write_timeout seconds.
+
+    A list of up to list_memory_packets packets stays in list memory once
+    played, until the list is reset or stopped or the galvo moved, and
+    RESTART_LIST rewinds it for EXECUTE_LIST to play again.
+
+        sender.open(mock=EmulatedConnection(buffer_packets=2, time_scale=0.1))
+    """
+    chunk_size = UsbConnection.chunk_size
+    serial_number = (0x3230, 0x3132)
+    version = (0x0402, 0x0000)
+
+    def __init__(
+        self,
+        machine_index=0,
+        debug=None,
+        buffer_packets=8,
+        time_scale=1.0,
+        latency=0.0002,
+        chunk_latency=0.0005,
+        write_timeout=0.1,
+        mm_per_galvo=110.0 / 0x10000,
+        list_memory_packets=None,
+    ):
+        """
+        :param buffer_packets: list packets the board holds before READY drops.
+        :param time_scale: multiplies the simulated execution time, 0 runs lists instantly.
+        :param latency: seconds each command takes on the bus.
+        :param chunk_latency: seconds each list chunk takes on the bus.
+        :param write_timeout: seconds a chunk write waits for room in the buffer.
+        :param mm_per_galvo: lens scale, to turn speeds in mm/s into galvo units.
+        :param list_memory_packets: longest list RESTART_LIST can play again, buffer_packets if None.
+        """
+        self.machine_index = machine_index
+        self._debug = debug
+        self.buffer_packets = buffer_packets
+        self.time_scale = time_scale
+        self.latency = latency
+        self.chunk_latency = chunk_latency
+        self.write_timeout = write_timeout
+        self.mm_per_galvo = mm_per_galvo
+        self.list_memory_packets = list_memory_packets or buffer_packets
+        self.device = None
+        self.status = None
+        self.stats = UsbStats()
+        self.footswitch = False
+        self.write_port = 0
+        self.registers = {}
+        self.chunks_received = 0
+        self.ops_executed = 0
+        self.restarts = 0
+        # Time a started list spent waiting for the host to send more of it.
+        self.underruns = 0
+        self.starved_time = 0.0
+        self._starved_since = None
+        self.reset()
+
+    def reset(self):
+        """Power on state."""
+        self.x = 0x8000
+        self.y = 0x8000
+        self.laser = False
+        self.travel_speed = 2000.0
+        self.cut_speed = 100.0
+        self.jump_delay = 0.0
+        self.polygon_delay = 0.0
+        self.laser_on_delay = 0.0
+        self.laser_off_delay = 0.0
+        self.list_port = 0
+        self._reset_list()
+
+    def _reset_list(self):
+        self._fed()
+        # Each buffered packet is a deque of (opcode, param0, param1, param2) ops.
+        self.buffer = deque()
+        # The ops of every packet of the list, None once it outgrew list memory.
+        self.memory = []
+        self.executing = False
+        self.end_of_list = False
+        # The op being played: start time, duration and the move it makes.
+        self._op = None
+        self._clock = None
+
+    def open(self):
+        self.device = True
+        self.reset()
+        if self._debug:
+            self._debug("Connected.")
+
+    def close(self):
+        self.status = None
+        self.device = None
+        if self._debug:
+            self._debug("Disconnected.")
+
+    def is_ready(self):
+        self.send_command(READ_PORT, 0)
+        return self.status & STATUS_READY
+
+    ################
+    # Machine state.
+    ################
+
+    def condition(self):
+        """The condition register, as of now."""
+        self.advance()
+        status = 0
+        if len(self.buffer) < self.buffer_packets:
+            status |= STATUS_READY
+        if self.executing:
+            status |= STATUS_BUSY
+        return status
+
+    def position(self):
+        """The galvo position, as of now, interpolated along the move in progress."""
+        self.advance()
+        if self._op is not None:
+            start, duration, x0, y0, x1, y1 = self._op
+            if duration > 0:
+                t = min(1.0, (time.perf_counter() - start) / duration)
+                return int(round(x0 + (x1 - x0) * t)), int(round(y0 + (y1 - y0) * t))
+        return self.x, self.y
+
+    def _stop(self):
+        self._reset_list()
+        self.laser = False
+
+    def advance(self, now=None):
+        """Plays buffered ops up to now."""
+        if not self.executing:
+            return
+        if now is None:
+            now = time.perf_counter()
+        if self._clock is None:
+            self._clock = now
+        while True:
+            if self._op is not None:
+                start, duration, x0, y0, x1, y1 = self._op
+                if start + duration > now:
+                    return
+                self._clock = start + duration
+                self._op = None
+            if not self.buffer:
+                if self.end_of_list:
+                    self.executing = False
+                    self.laser = False
+                else:
+                    # Underrun: stall, still busy, until more data arrives.
+                    if self._starved_since is None:
+                        self._starved_since = self._clock
+                    self._clock = None
+                return
+            packet = self.buffer[0]
+            if not packet:
+                self.buffer.popleft()
+                continue
+            self._op = self._play(self._clock, *packet.popleft())
+            self.ops_executed += 1
+
+    def _fed(self):
+        """Ends an underrun, if there was one."""
+        if self._starved_since is not None:
+            self.underruns += 1
+            self.starved_time += time.perf_counter() - self._starved_since
+            self._starved_since = None
+
+    def _play(self, start, opcode, p0, p1, p2):
+        """Applies a list op, returns the (start, duration, x0, y0, x1, y1) it occupies.
+           Moves are taken in the order CommandList.pos() writes them, the same
+           order as SET_XY_POSITION and the GET_XY_POSITION reply."""
+        x0, y0 = self.x, self.y
+        duration = 0.0
+        if opcode == OP_TRAVEL or opcode == OP_CUT:
+            cut = opcode == OP_CUT
+            x, y = p0, p1
+            distance = ((x - x0) ** 2 + (y - y0) ** 2) ** 0.5 * self.mm_per_galvo
+            speed = self.cut_speed if cut else self.travel_speed
+            if speed > 0:
+                duration = distance / speed
+            if cut and not self.laser:
+                duration += self.laser_on_delay
+            elif not cut and self.laser:
+                duration += self.laser_off_delay
+            duration += self.polygon_delay if cut else self.jump_delay
+            self.laser = cut
+            self.x, self.y = x, y
+        elif opcode == OP_MARK_END_DELAY:
+            duration = p0 * 10e-6
+        elif opcode == OP_TRAVEL_SPEED:
+            self.travel_speed = p0 * SPEED_UNIT
+        elif opcode == OP_CUT_SPEED:
+            self.cut_speed = p0 * SPEED_UNIT
+        elif opcode == OP_JUMP_DELAY:
+            self.jump_delay = p0 * 1e-6
+        elif opcode == OP_POLYGON_DELAY:
+            self.polygon_delay = p0 * 1e-6
+        elif opcode == OP_LASER_ON_DELAY:
+            self.laser_on_delay = p0 * 1e-6
+        elif opcode == OP_LASER_OFF_DELAY:
+            self.laser_off_delay = p0 * 1e-6
+        elif opcode == OP_WRITE_PORT:
+            self.list_port = p0
+        elif opcode == OP_LASER_CONTROL:
+            self.laser = bool(p0)
+        return start, duration * self.time_scale, x0, y0, self.x, self.y
+
+    def _command(self, code, params):
+        """Applies a command, returns the two reply words."""
+        if code == READ_PORT:
+            self.advance()
+            return (0x8000 if self.footswitch else 0) | (self.write_port & 0x7FFF), 0
+        if code == GET_XY_POSITION:
+            return self.position()
+        if code == EXECUTE_LIST:
+            if not self.executing:
+                self.executing = True
+                self._clock = None
+            return 0, 0
+        if code == SET_END_OF_LIST:
+            self.advance()
+            self.end_of_list = params[0] == 0
+            if self.end_of_list:
+                self._fed()
+            return 0, 0
+        if code == RESTART_LIST:
+            self.advance()
+            memory = self.memory if self.end_of_list else None
+            self._stop()
+            if memory:
+                self.buffer = deque(deque(packet) for packet in memory)
+                self.memory = memory
+                self.end_of_list = True
+                self.restarts += 1
+            return 0, 0
+        if code in (RESET_LIST, STOP_EXECUTE, STOP_LIST):
+            self._stop()
+            return 0, 0
+        if code == SET_XY_POSITION:
+            self._stop()
+            self.x, self.y = params[0], params[1]
+            return 0, 0
+        if code == WRITE_PORT:
+            self.write_port = params[0]
+            return 0, 0
+        if code == GET_SERIAL_NUMBER:
+            return self.serial_number
+        if code == GET_REGISTER:
+            return self.version
+        if code == GET_LIST_STATUS:
+            self.advance()
+            return len(self.buffer), 0
+        self.registers[code] = tuple(params)
+        return 0, 0
+
+    #############
+    # Transport.
+    #############
+
+    def send_correction_entry(self, correction):
+        """Send an individual correction table entry to the machine."""
+        if len(correction) != 12:
+            raise BalorDataValidityException("Invalid correction entry size %d" % len(correction))
+        self.stats.write(WRITE_CORRECTION_LINE, self.latency)
+
+    def send_correction_table(self, packed):
+        """Send packed correction table entries to the machine. Each is a write
+           without a read, half a command's latency."""
+        entries = len(packed) // 12
+        if self.latency:
+            time.sleep(self.latency / 2 * entries)
+        for i in range(entries):
+            self.stats.write(WRITE_CORRECTION_LINE, self.latency / 2)
+        if self._debug:
+            self._debug("---> %d correction entries" % (len(packed) // 12))
+
+    def send_command(self, code, *parameters, read=True):
+        """Send a command to the machine and return the response.
+           Updates the host condition register as a side effect."""
+        if self._debug:
+            self._debug("---> %04X %s" % (code, str(parameters)))
+        params = list(parameters) + [0] * (5 - len(parameters))
+        start = time.perf_counter()
+        if self.latency:
+            time.sleep(self.latency / 2)
+        reply = self._command(code, [int(p) & 0xFFFF for p in params])
+        written = time.perf_counter()
+        self.stats.write(code, written - start)
+        if not read:
+            return 0, 0
+        if self.latency:
+            time.sleep(self.latency / 2)
+        self.status = self.condition()
+        self.stats.read(code, time.perf_counter() - written)
+        if self._debug:
+            self._debug("<--- %04X %04X status %04X" % (reply[0], reply[1], self.status))
+        return reply
+
+    def send_list_chunk(self, data):
+        """Send a command list chunk to the machine."""
+        if len(data) != self.chunk_size:
+            raise BalorDataValidityException("Invalid chunk size %d" % len(data))
+        start = time.perf_counter()
+        # The board NAKs the chunk until it has room for it.
+        while not self.condition() & STATUS_READY:
+            if time.perf_counter() - start > self.write_timeout:
+                error = usb.core.USBTimeoutError("Operation timed out")
+                self.stats.failed(error)
+                raise error
+            time.sleep(0.0002)
+        if self.chunk_latency:
+            time.sleep(self.chunk_latency)
+        ops = list(_ops(data))
+        self.buffer.append(deque(ops))
+        if self.memory is not None:
+            self.memory.append(ops)
+            if len(self.memory) > self.list_memory_packets:
+                self.memory = None
+        self._fed()
+        self.chunks_received += 1
+        self.stats.chunk(time.perf_counter() - start, len(data))
+        if self._debug:
+            self._debug("---> list chunk %d, %d buffered" % (self.chunks_received, len(self.buffer)))
@@ -0,0 +1,340 @@
+# Balor Galvo Laser Control Module
+# Copyright (C) 2021-2022 Gnostic Instruments, Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import itertools
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import usb.core
+
+from balor.command_list import CommandBinary, CommandList
+from balor.emulator import EmulatedConnection
+from balor.sender import (
+    Sender, UsbConnection, BalorMachineException, GET_SERIAL_NUMBER,
+)
+
+
+def count_ops(job):
+    """List ops in one run of a job, from what it holds without compiling it, or None
+    if that cannot be told."""
+    if isinstance(job, CommandList):
+        return len(job.operations)
+    if isinstance(job, CommandBinary):
+        return len(job._original_data) // 12 * job._repeat
+    return None
+
+
+def format_serial(serial_number):
+    """The GET_SERIAL_NUMBER reply as a string."""
+    return "%04X%04X" % tuple(serial_number)
+
+
+def find_machines():
+    """The (machine_index, serial number) of every board attached."""
+    count = len(list(usb.core.find(find_all=True, idVendor=0x9588, idProduct=0x9899)))
+    machines = []
+    for index in range(count):
+        connection = UsbConnection(index)
+        connection.open()
+        try:
+            machines.append((index, format_serial(connection.send_command(GET_SERIAL_NUMBER))))
+        finally:
+            connection.close()
+    return machines
+
+
+class PooledMachine:
+    """One board of a SenderPool: its Sender, its job queue and the worker
+    thread that runs them, one job at a time."""
+    # Seconds per list op a job is estimated at, until the board has completed
+    # jobs to measure its own.
+    default_op_time = 0.001
+
+    def __init__(self, sender, index, serial, debug=None):
+        self.sender = sender
+        self.index = index
+        self.serial = serial
+        self._debug = debug
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+        # Estimated seconds of each queued job by future, and the running job's start
+        # and estimate. Endless jobs are estimated at inf.
+        self._estimates = {}
+        self.running = None
+        # Run time and list ops of the completed jobs whose ops were known.
+        self._measured_time = 0.0
+        self._measured_ops = 0
+        self.reset_stats()
+
+    @property
+    def op_time(self):
+        """Seconds per list op measured on this board, default_op_time until then."""
+        if not self._measured_ops:
+            return self.default_op_time
+        return self._measured_time / self._measured_ops
+
+    def estimate(self, ops):
+        """Seconds this board takes to run ops list ops."""
+        return ops * self.op_time
+
+    def reset_stats(self):
+        self.started = time.perf_counter()
+        self.jobs = 0
+        self.aborted = 0
+        self.failed = 0
+        self.packets = 0
+        self.busy_time = 0.0
+        self.estimated_time = 0.0
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self._run, name="balor-pool-%s" % self.serial, daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        """Cancels the queued jobs and ends the worker after the running one."""
+        for future in self._drain():
+            future.cancel()
+        self._queue.put(None)
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _drain(self):
+        futures = []
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                return futures
+            if item is None:
+                continue
+            with self._lock:
+                self._estimates.pop(item[0], None)
+            futures.append(item[0])
+
+    def put(self, future, job, loop_count, estimate, ops=None):
+        with self._lock:
+            self._estimates[future] = estimate
+        self._queue.put((future, job, loop_count, estimate, ops))
+
+    def remaining(self):
+        """Estimated seconds until this machine has run everything it was given."""
+        with self._lock:
+            remaining = sum(self._estimates.values())
+            if self.running is not None:
+                started, estimate = self.running
+                remaining += max(0.0, estimate - (time.perf_counter() - started))
+        return remaining
+
+    @property
+    def queued(self):
+        return len(self._estimates)
+
+    def _progress(self, kind, loop_index, packet_index):
+        if kind == "packet":
+            self.packets += 1
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            future, job, loop_count, estimate, ops = item
+            with self._lock:
+                self._estimates.pop(future, None)
+                if not future.set_running_or_notify_cancel():
+                    continue
+                self.running = (time.perf_counter(), estimate)
+            start = time.perf_counter()
+            try:
+                completed = self.sender.execute(job, loop_count, callback_progress=self._progress)
+            except Exception as e:
+                self.failed += 1
+                future.set_exception(e)
+                if self._debug:
+                    self._debug("Job failed on %s: %s" % (self.serial, e))
+            else:
+                if completed:
+                    self.jobs += 1
+                    self.estimated_time += estimate
+                    if ops and loop_count != float("inf"):
+                        self._measured_time += time.perf_counter() - start
+                        self._measured_ops += ops * loop_count
+                else:
+                    self.aborted += 1
+                future.set_result(completed)
+            finally:
+                self.busy_time += time.perf_counter() - start
+                with self._lock:
+                    self.running = None
+
+    def abort(self):
+        """Aborts the running job and cancels the queued ones."""
+        for future in self._drain():
+            future.cancel()
+        self.sender.abort()
+
+    def stats(self):
+        elapsed = time.perf_counter() - self.started
+        return {
+            "index": self.index,
+            "serial": self.serial,
+            "queued": self.queued,
+            "running": self.running is not None,
+            "remaining": self.remaining(),
+            "jobs": self.jobs,
+            "aborted": self.aborted,
+            "failed": self.failed,
+            "packets": self.packets,
+            "busy_time": self.busy_time,
+            "utilization": self.busy_time / elapsed if elapsed > 0 else 0.0,
+            "jobs_per_hour": self.jobs * 3600 / elapsed if elapsed > 0 else 0.0,
+            "bytes_per_second": self.packets * self.sender.get_packet_size() / elapsed if elapsed > 0 else 0.0,
+            # Run time of the completed jobs against their estimates, to check the estimates.
+            "estimated_time": self.estimated_time,
+            "op_time": self.op_time,
+        }
+
+
+class SenderPool:
+    """Drives several boards from one process.
+
+    Each board gets its own Sender and a worker thread running the jobs queued for it.
+    submit() queues a job on a board chosen by policy: "round_robin", or
+    "least_loaded", the board with the least estimated time of work left, or on a
+    given board, by index or serial number.
+
+        pool = SenderPool()
+        pool.open()
+        futures = [pool.submit(job) for job in jobs]
+        concurrent.futures.wait(futures)
+    """
+    policies = ("round_robin", "least_loaded")
+
+    def __init__(self, policy="least_loaded", debug=None):
+        if policy not in self.policies:
+            raise ValueError("Unknown policy %s" % policy)
+        self.policy = policy
+        self._debug = debug
+        self.machines = []
+        self._round_robin = None
+
+    def open(self, machines=None, mock=0, mock_options=None, **kwargs):
+        """Connects to and initializes the boards, in parallel.
+
+        :param machines: machine indices or serial numbers to use, all attached boards if None.
+        :param mock: number of emulated boards to use instead.
+        :param mock_options: keyword arguments for the EmulatedConnections.
+        :param kwargs: passed to Sender.open for every board.
+        """
+        if self.machines:
+            raise BalorMachineException("Pool is already open.")
+        if mock:
+            found = [(index, None) for index in range(mock)]
+        else:
+            found = find_machines()
+            if machines is not None:
+                found = [(i, s) for i, s in found if i in machines or s in machines]
+        if not found:
+            raise BalorMachineException("No compatible engraver machine was found.")
+
+        errors = []
+
+        def connect(index):
+            sender = Sender(debug=self._debug)
+            try:
+                if mock:
+                    connection = EmulatedConnection(index, **(mock_options or {}))
+                    connection.serial_number = (0x3230, 0x3132 + index)
+                    sender.open(mock=connection, **kwargs)
+                else:
+                    sender.open(machine_index=index, **kwargs)
+            except Exception as e:
+                errors.append(e)
+                return
+            machine = PooledMachine(sender, index, format_serial(sender.serial_number), self._debug)
+            machine.start()
+            self.machines.append(machine)
+
+        threads = [threading.Thread(target=connect, args=(index,)) for index, serial in found]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.machines.sort(key=lambda m: m.index)
+        self._round_robin = itertools.cycle(self.machines)
+        if errors:
+            self.close()
+            raise errors[0]
+
+    def close(self):
+        for machine in self.machines:
+            machine.stop()
+            machine.sender.close()
+        self.machines = []
+
+    def machine(self, key):
+        """The PooledMachine with the given index or serial number."""
+        for machine in self.machines:
+            if key == machine.index or key == machine.serial or key is machine:
+                return machine
+        raise KeyError(key)
+
+    def _choose(self, policy):
+        if policy == "round_robin":
+            return next(self._round_robin)
+        if policy == "least_loaded":
+            return min(self.machines, key=lambda m: (m.remaining(), m.queued))
+        raise ValueError("Unknown policy %s" % policy)
+
+    def submit(self, job, loop_count=1, machine=None, policy=None, estimate=None):
+        """Queues a job, see Sender.execute.
+
+        :param machine: index or serial number of the board to run it on, else one is chosen by policy.
+        :param policy: overrides the pool's policy for this job.
+        :param estimate: seconds the job takes once through. If None it is estimated from the
+            number of list ops at the board's measured time per op, which needs no compile; jobs
+            that cannot be counted are estimated at 0, and endless ones always at inf.
+        :return: concurrent.futures.Future of the execute result, True if the job completed.
+        """
+        if not self.machines:
+            raise BalorMachineException("Pool is not open.")
+        ops = count_ops(job)
+        target = self.machine(machine) if machine is not None else self._choose(policy or self.policy)
+        if estimate is None:
+            estimate = target.estimate(ops) if ops else 0.0
+        # An endless job keeps its board busy however little is known of it.
+        total = float("inf") if loop_count == float("inf") else estimate * loop_count
+        future = Future()
+        target.put(future, job, loop_count, total, ops)
+        return future
+
+    def abort(self, machine=None):
+        """Aborts the running and queued jobs of one board, or of all of them."""
+        for target in [self.machine(machine)] if machine is not None else self.machines:
+            target.abort()
+
+    def stats(self):
+        """Per board throughput and load, keyed by serial number. JSON serializable."""
+        return {machine.serial: machine.stats() for machine in self.machines}
+
+    def reset_stats(self):
+        for machine in self.machines:
+            machine.reset_stats()
@@ -0,0 +1,417 @@
+"""
+Records the USB traffic of a Sender to a file and replays it without the machine.
+
+    sender.open(record="session.balor")           # on the line
+    sender.open(mock=ReplayConnection("session.balor", time_scale=0.5))
+
+A recording is a short header followed by one record per transaction: a kind, the
+microseconds since the previous record started, the microseconds the transaction took,
+then the kind's payload. Commands keep their 12 byte query and the reply words and
+condition register, list chunks and correction tables are zlib compressed.
+
+    python -m balor.recording session.balor
+"""
+import argparse
+import json
+import struct
+import sys
+import time
+import zlib
+from collections import Counter, namedtuple
+
+import usb.core
+
+from balor.sender import (
+    BalorCommunicationException, BalorDataValidityException, UsbStats,
+    UsbConnection, OPCODE_NAMES, READ_PORT, WRITE_CORRECTION_LINE,
+)
+
+MAGIC = b"BALORUSB"
+VERSION = 1
+_HEADER = struct.Struct("<8sHd")  # magic, version, wall clock start
+_RECORD = struct.Struct("<BII")  # kind, delta us, duration us
+_QUERY = struct.Struct("<6H")
+_REPLY = struct.Struct("<3H")  # reply words and condition register
+_BLOB = struct.Struct("<I")
+_ERROR = struct.Struct("<BHB")  # failed kind, opcode, timed out
+
+COMMAND = 1  # query and reply
+COMMAND_NO_READ = 2  # query only
+LIST_CHUNK = 3
+CORRECTION_ENTRY = 4
+CORRECTION_TABLE = 5
+ERROR = 6  # a transaction that raised
+
+KIND_NAMES = {
+    COMMAND: "command",
+    COMMAND_NO_READ: "command_no_read",
+    LIST_CHUNK: "list_chunk",
+    CORRECTION_ENTRY: "correction_entry",
+    CORRECTION_TABLE: "correction_table",
+    ERROR: "error",
+}
+
+# time and duration are in seconds, time from the start of the recording. code and params
+# are those of the command (code 0 otherwise); data is the chunk, table or entry bytes.
+# For ERROR records, failed is the kind of transaction that failed and timeout whether
+# it was a usb timeout.
+Record = namedtuple("Record", "kind time duration code params reply status data failed timeout")
+
+
+def _record(kind, t, duration, code=0, params=(), reply=(0, 0), status=0, data=b"", failed=0, timeout=False):
+    return Record(kind, t, duration, code, tuple(params), tuple(reply), status, data, failed, timeout)
+
+
+def _us(seconds):
+    return min(max(int(round(seconds * 1e6)), 0), 0xFFFFFFFF)
+
+
+class RecordingConnection:
+    """Wraps a connection, UsbConnection or otherwise, and records its traffic to a file.
+    Everything but the transactions is passed through to the wrapped connection."""
+
+    def __init__(self, connection, filename, compression=1):
+        self.connection = connection
+        self.filename = filename
+        self.compression = compression
+        self.records = 0
+        self._file = None
+        self._last = None
+
+    def __getattr__(self, item):
+        return getattr(self.connection, item)
+
+    def open(self):
+        self.connection.open()
+        self._file = open(self.filename, "wb")
+        self._file.write(_HEADER.pack(MAGIC, VERSION, time.time()))
+        self._last = time.perf_counter()
+
+    def close(self):
+        try:
+            self.connection.close()
+        finally:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def _write(self, kind, start, end, payload):
+        if self._file is None:
+            return
+        self._file.write(_RECORD.pack(kind, _us(start - self._last), _us(end - start)))
+        self._file.write(payload)
+        self._last = start
+        self.records += 1
+
+    def _blob(self, data):
+        data = zlib.compress(bytes(data), self.compression)
+        return _BLOB.pack(len(data)) + data
+
+    def _call(self, kind, code, function, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            result = function(*args, **kwargs)
+        except usb.core.USBError as e:
+            timeout = isinstance(e, usb.core.USBTimeoutError)
+            self._write(ERROR, start, time.perf_counter(), _ERROR.pack(kind, code, timeout))
+            raise
+        return start, time.perf_counter(), result
+
+    def send_command(self, code, *parameters, read=True):
+        params = (list(parameters) + [0] * 5)[:5]
+        query = _QUERY.pack(code & 0xFFFF, *(int(p) & 0xFFFF for p in params))
+        kind = COMMAND if read else COMMAND_NO_READ
+        start, end, reply = self._call(kind, code, self.connection.send_command, code, *parameters, read=read)
+        if read:
+            query += _REPLY.pack(reply[0] & 0xFFFF, reply[1] & 0xFFFF, (self.connection.status or 0) & 0xFFFF)
+        self._write(kind, start, end, query)
+        return reply
+
+    def send_list_chunk(self, data):
+        start, end, _ = self._call(LIST_CHUNK, 0, self.connection.send_list_chunk, data)
+        self._write(LIST_CHUNK, start, end, self._blob(data))
+
+    def send_correction_entry(self, correction):
+        start, end, _ = self._call(
+            CORRECTION_ENTRY, WRITE_CORRECTION_LINE, self.connection.send_correction_entry, correction
+        )
+        self._write(CORRECTION_ENTRY, start, end, bytes(correction))
+
+    def send_correction_table(self, packed):
+        start, end, _ = self._call(
+            CORRECTION_TABLE, WRITE_CORRECTION_LINE, self.connection.send_correction_table, packed
+        )
+        self._write(CORRECTION_TABLE, start, end, self._blob(packed))
+
+
+def read_recording(filename):
+    """Reads a recording.
+
+    :return: wall clock time the recording started, list of Records.
+    """
+    with open(filename, "rb") as f:
+        data = f.read()
+    if len(data) < _HEADER.size:
+        raise BalorDataValidityException("Not a balor usb recording: %s" % filename)
+    magic, version, started = _HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise BalorDataValidityException("Not a balor usb recording: %s" % filename)
+    if version != VERSION:
+        raise BalorDataValidityException("Unsupported recording version %d" % version)
+    records = []
+    offset = _HEADER.size
+    t = 0.0
+    try:
+        while offset < len(data):
+            kind, delta, duration = _RECORD.unpack_from(data, offset)
+            offset += _RECORD.size
+            t += delta * 1e-6
+            duration *= 1e-6
+            if kind in (COMMAND, COMMAND_NO_READ):
+                query = _QUERY.unpack_from(data, offset)
+                offset += _QUERY.size
+                reply, status = (0, 0), 0
+                if kind == COMMAND:
+                    reply_a, reply_b, status = _REPLY.unpack_from(data, offset)
+                    reply = (reply_a, reply_b)
+                    offset += _REPLY.size
+                records.append(_record(kind, t, duration, query[0], query[1:], reply, status))
+            elif kind in (LIST_CHUNK, CORRECTION_TABLE):
+                (size,) = _BLOB.unpack_from(data, offset)
+                offset += _BLOB.size
+                blob = zlib.decompress(data[offset:offset + size])
+                offset += size
+                code = WRITE_CORRECTION_LINE if kind == CORRECTION_TABLE else 0
+                records.append(_record(kind, t, duration, code, data=blob))
+            elif kind == CORRECTION_ENTRY:
+                entry = data[offset:offset + 12]
+                offset += 12
+                records.append(_record(kind, t, duration, WRITE_CORRECTION_LINE, data=entry))
+            elif kind == ERROR:
+                failed, code, timeout = _ERROR.unpack_from(data, offset)
+                offset += _ERROR.size
+                records.append(_record(kind, t, duration, code, failed=failed, timeout=bool(timeout)))
+            else:
+                raise BalorDataValidityException("Unknown record kind %d at byte %d" % (kind, offset))
+    except (struct.error, zlib.error):
+        # A recording cut short by a crash keeps every complete record.
+        pass
+    return started, records
+
+
+class ReplayConnection:
+    """Serves a recording back to a Sender in place of the machine.
+
+    Transactions other than READ_PORT are replayed in order and each takes its recorded
+    duration, times time_scale (0 replies at once). READ_PORT is how the status monitor
+    polls, and how often it does depends on the host, so polls are answered from a
+    timeline instead: the condition register the recording saw that long after the
+    previous transaction. A host that waits on the board waits about as long as the
+    recorded one did.
+
+    With strict set, a transaction that differs from the recording raises
+    BalorDataValidityException. Otherwise the replay resynchronizes on the next
+    matching transaction within lookahead records, or answers with the last status,
+    and counts a divergence. Either way the recording's ERROR records raise the usb
+    errors they recorded.
+    """
+    chunk_size = UsbConnection.chunk_size
+
+    def __init__(self, filename, time_scale=1.0, strict=True, lookahead=64, debug=None):
+        self.filename = filename
+        self.time_scale = time_scale
+        self.strict = strict
+        self.lookahead = lookahead
+        self._debug = debug
+        self.device = None
+        self.status = None
+        self.stats = UsbStats()
+        self.started, records = read_recording(filename)
+        self.records = [r for r in records if not self._is_poll(r)]
+        # Polls between records[i - 1] and records[i], as (seconds since the former ended, status).
+        self.polls = [[] for _ in range(len(self.records) + 1)]
+        poll_durations = []
+        index = 0
+        ended = 0.0
+        for r in records:
+            if self._is_poll(r):
+                if r.kind == COMMAND:
+                    self.polls[index].append((r.time + r.duration - ended, r.status))
+                    poll_durations.append(r.duration)
+            else:
+                index += 1
+                ended = r.time + r.duration
+        poll_durations.sort()
+        self.poll_duration = poll_durations[len(poll_durations) // 2] if poll_durations else 0.0
+        self.index = 0
+        self.divergences = 0
+        self._gap_start = None
+        self._last_status = 0
+
+    @staticmethod
+    def _is_poll(record):
+        if record.kind == ERROR:
+            return record.failed == COMMAND and record.code == READ_PORT
+        return record.kind == COMMAND and record.code == READ_PORT
+
+    def open(self):
+        self.device = True
+        self.index = 0
+        self._gap_start = time.perf_counter()
+        if self._debug:
+            self._debug("Replaying %d records from %s." % (len(self.records), self.filename))
+
+    def close(self):
+        self.status = None
+        self.device = None
+
+    def _sleep(self, seconds):
+        if seconds > 0 and self.time_scale:
+            time.sleep(seconds * self.time_scale)
+
+    def _poll_status(self):
+        polls = self.polls[self.index]
+        if self.time_scale:
+            elapsed = (time.perf_counter() - self._gap_start) / self.time_scale
+        else:
+            elapsed = float("inf")
+        status = self._last_status
+        for offset, recorded in polls:
+            if offset > elapsed:
+                break
+            status = recorded
+        return status
+
+    def _matches(self, record, kind, code, params, data):
+        if record.kind == ERROR:
+            return record.failed == kind and record.code == code
+        if record.kind != kind or record.code != code:
+            return False
+        if not self.strict:
+            return True
+        if kind in (COMMAND, COMMAND_NO_READ):
+            return record.params == tuple(params)
+        return record.data == bytes(data)
+
+    def _next(self, kind, code=0, params=(), data=b""):
+        """The record answering this transaction, None if there is none."""
+        end = len(self.records) if self.strict else min(len(self.records), self.index + self.lookahead)
+        if self.strict:
+            if self.index >= len(self.records):
+                raise BalorCommunicationException(
+                    "Replay of %s ended after %d records." % (self.filename, len(self.records))
+                )
+            record = self.records[self.index]
+            if not self._matches(record, kind, code, params, data):
+                raise BalorDataValidityException(
+                    "Replay diverged at record %d: expected %s %s %s, got %s %s %s" % (
+                        self.index,
+                        KIND_NAMES[record.kind], OPCODE_NAMES.get(record.code, record.code), record.params,
+                        KIND_NAMES[kind], OPCODE_NAMES.get(code, code), tuple(params),
+                    )
+                )
+            self.index += 1
+            return record
+        for i in range(self.index, end):
+            if self._matches(self.records[i], kind, code, params, data):
+                if i != self.index:
+                    self.divergences += 1
+                self.index = i + 1
+                return self.records[i]
+        self.divergences += 1
+        return None
+
+    def _served(self, record):
+        self._gap_start = time.perf_counter()
+        if record is not None and record.kind == ERROR:
+            if record.timeout:
+                error = usb.core.USBTimeoutError("Operation timed out")
+            else:
+                error = usb.core.USBError("Replayed usb error")
+            self.stats.failed(error)
+            raise error
+
+    def send_command(self, code, *parameters, read=True):
+        """Send a command to the machine and return the response.
+           Updates the host condition register as a side effect."""
+        start = time.perf_counter()
+        if code == READ_PORT and read:
+            self._sleep(self.poll_duration)
+            self.status = self._poll_status()
+            self.stats.write(code, 0.0)
+            self.stats.read(code, time.perf_counter() - start)
+            return self.status, 0
+        params = (list(parameters) + [0] * 5)[:5]
+        record = self._next(COMMAND if read else COMMAND_NO_READ, code, [int(p) & 0xFFFF for p in params])
+        if record is not None:
+            self._sleep(record.duration)
+        self.stats.write(code, time.perf_counter() - start)
+        self._served(record)
+        if not read:
+            return 0, 0
+        if record is not None:
+            self._last_status = record.status
+        self.status = self._last_status
+        self.stats.read(code, 0.0)
+        return record.reply if record is not None else (0, 0)
+
+    def send_list_chunk(self, data):
+        """Send a command list chunk to the machine."""
+        if len(data) != self.chunk_size:
+            raise BalorDataValidityException("Invalid chunk size %d" % len(data))
+        start = time.perf_counter()
+        record = self._next(LIST_CHUNK, data=data)
+        if record is not None:
+            self._sleep(record.duration)
+        self._served(record)
+        self.stats.chunk(time.perf_counter() - start, len(data))
+
+    def send_correction_entry(self, correction):
+        """Send an individual correction table entry to the machine."""
+        start = time.perf_counter()
+        record = self._next(CORRECTION_ENTRY, WRITE_CORRECTION_LINE, data=correction)
+        if record is not None:
+            self._sleep(record.duration)
+        self._served(record)
+        self.stats.write(WRITE_CORRECTION_LINE, time.perf_counter() - start)
+
+    def send_correction_table(self, packed):
+        """Send packed correction table entries to the machine."""
+        start = time.perf_counter()
+        record = self._next(CORRECTION_TABLE, WRITE_CORRECTION_LINE, data=packed)
+        if record is not None:
+            self._sleep(record.duration)
+        self._served(record)
+        self.stats.write(WRITE_CORRECTION_LINE, time.perf_counter() - start)
+
+
+def summarize(filename):
+    """Counts, bytes and time of a recording, by record kind and command."""
+    started, records = read_recording(filename)
+    kinds = Counter(KIND_NAMES[r.kind] for r in records)
+    commands = Counter(OPCODE_NAMES.get(r.code, "0x%04X" % r.code) for r in records if r.kind in (COMMAND, COMMAND_NO_READ))
+    busy = Counter()
+    for r in records:
+        busy[KIND_NAMES[r.kind]] += r.duration
+    return {
+        "started": started,
+        "records": len(records),
+        "seconds": records[-1].time + records[-1].duration if records else 0.0,
+        "kinds": dict(kinds),
+        "kind_seconds": dict(busy),
+        "commands": dict(commands),
+        "list_chunk_bytes": sum(len(r.data) for r in records if r.kind == LIST_CHUNK),
+        "errors": sum(1 for r in records if r.kind == ERROR),
+    }
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Summarize a balor usb recording.")
+    parser.add_argument("recording", help="file written by Sender.open(record=...)")
+    args = parser.parse_args(args)
+    json.dump(summarize(args.recording), sys.stdout, indent=2)
+    print()
+
+
+if __name__ == "__main__":
+    main()
@@ -17,6 +17,10 @@ import usb.core
 import usb.util
 import time
 import threading
+import hashlib
+import queue
+
+import numpy as np
 
 from balor.command_list import CommandSource, CommandList
 
@@ -97,6 +101,592 @@ IS_LITE_VERSION        = 0x0040 # Tell laser to nerf itself for ezcad lite appar
 GET_MARK_TIME          = 0x0041 # Seen at end of cutting, only and always called with param 0x0003
 SET_FPK_PARAM          = 0x0062  # Probably "first pulse killer" = fpk
 
+OPCODE_NAMES = {
+    value: name for name, value in list(globals().items())
+    if name.isupper() and isinstance(value, int)
+}
+
+
+
+# Immediate commands whose last arguments the Sender shadows, and the commands after
+# which the state they set can no longer be assumed. A list may hold WritePort ops, and
+# one rerun from list memory is started without its chunks being seen again.
+SHADOWED = (SET_XY_POSITION, WRITE_PORT, WRITE_ANALOG_PORT_1, WRITE_ANALOG_PORT_2, WRITE_ANALOG_PORT_X)
+SHADOW_INVALIDATED_BY = {
+    RESET: SHADOWED,
+    EXECUTE_LIST: SHADOWED,
+    RESTART_LIST: SHADOWED,
+    STOP_EXECUTE: (SET_XY_POSITION,),
+    STOP_LIST: (SET_XY_POSITION,),
+}
+# The opcode of the WritePort list op, as it appears in a packet.
+_LIST_WRITE_PORT = b"\x11\x80"
+# Commands after which the board's list memory no longer holds the last job.
+LIST_MEMORY_CLEARED_BY = (RESET, RESET_LIST, STOP_EXECUTE, STOP_LIST, SET_XY_POSITION)
+
+# Condition register bits
+STATUS_BUSY            = 0x0004 # Running a list, lighting jobs included
+STATUS_READY           = 0x0020 # Ready to accept another list chunk
+
+# Packed correction tables keyed by the sha1 of the .cor file, None for the empty table.
+_correction_cache = {}
+# What _init_machine last applied to each board, keyed by serial number: the replies
+# identifying it, the arguments of each setting command with the sha1 of the packed
+# correction table as "correction", and "xy", the galvo position last known, kept
+# current while connected and None while a list may be moving it. A board that still
+# reports that position on reconnect was not reset or used by anyone else since.
+_board_states = {}
+# Galvo positions a reset or freshly powered board may report, no evidence of anything.
+_RESET_POSITIONS = ((0x8000, 0x8000), (0, 0))
+
+
+class IoLock:
+    """Reentrant lock serializing USB transactions between threads.
+
+    Threads marked background with set_background(), the job thread while it
+    writes the list and the status monitor, stand aside while any other thread
+    is waiting. A query or control command from another thread then waits for
+    the one transaction in progress, not for a run of list chunks."""
+
+    def __init__(self):
+        self._condition = threading.Condition(threading.Lock())
+        self._owner = None
+        self._depth = 0
+        self._waiting = 0  # foreground threads waiting
+        self._local = threading.local()
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.waits = {"foreground": LatencyHistogram(), "background": LatencyHistogram()}
+
+    def set_background(self, background=True):
+        """Marks the calling thread as background, or not."""
+        self._local.background = background
+
+    def acquire(self):
+        me = threading.get_ident()
+        background = getattr(self._local, "background", False)
+        with self._condition:
+            if self._owner == me:
+                self._depth += 1
+                return True
+            start = time.perf_counter()
+            if not background:
+                self._waiting += 1
+            try:
+                while self._owner is not None or (background and self._waiting):
+                    self._condition.wait()
+            finally:
+                if not background:
+                    self._waiting -= 1
+            self._owner = me
+            self._depth = 1
+            self.waits["background" if background else "foreground"].add(time.perf_counter() - start)
+        return True
+
+    def release(self):
+        with self._condition:
+            self._depth -= 1
+            if not self._depth:
+                self._owner = None
+                self._condition.notify_all()
+
+    __enter__ = acquire
+
+    def __exit__(self, *args):
+        self.release()
+
+    def stats(self):
+        return {kind: histogram.to_dict() for kind, histogram in self.waits.items()}
+
+
+class StatusMonitor:
+    """Owns READ_PORT polling for a Sender and publishes the condition register.
+
+    A background thread polls the board, quickly while a list is draining or
+    someone is waiting and backing off towards idle_interval while nothing
+    changes. Every command reply is published too, so waiters often see a
+    change before the next poll. Waiters block on a condition variable rather
+    than polling the bus themselves."""
+    min_interval = 0.0005
+    busy_interval = 0.002
+    idle_interval = 0.05
+    backoff = 2.0
+
+    def __init__(self, sender):
+        self._sender = sender
+        self._condition = threading.Condition()
+        self._thread = None
+        self._running = False
+        self._waiters = 0
+        self._poke = False
+        self._interval = self.min_interval
+        self.error = None
+        self.status = None
+        self.port = None
+        self.sequence = 0
+        self.updated = None
+        # Input port reads are numbered apart from status updates, with the times of
+        # the last two.
+        self.port_sequence = 0
+        self.port_updated = None
+        self.port_previous = None
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.started = time.perf_counter()
+        self.polls = 0
+        self.poll_time = 0.0
+        self.poll_time_max = 0.0
+        self.changes = 0
+        self.detect_time = 0.0
+        self.detect_time_max = 0.0
+        self.waits = 0
+        self.wait_time = 0.0
+        # Time spent in wait_for, by what was waited on.
+        self.wait_histograms = {}
+
+    @property
+    def running(self):
+        return self._running
+
+    def start(self):
+        if self._running:
+            return
+        self._running = True
+        self.error = None
+        self._thread = threading.Thread(
+            target=self._run, name="balor-status", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        with self._condition:
+            self._running = False
+            self._condition.notify_all()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+        self._thread = None
+
+    def wake(self):
+        """Poll again right away, e.g. after a list was started."""
+        with self._condition:
+            self._interval = self.min_interval
+            self._poke = True
+            self._condition.notify_all()
+
+    def publish(self, status):
+        """Record the condition register from the reply to any command."""
+        now = time.perf_counter()
+        with self._condition:
+            if status != self.status:
+                self.changes += 1
+                if self.updated is not None:
+                    # The change happened at some point since the last update.
+                    elapsed = now - self.updated
+                    self.detect_time += elapsed
+                    self.detect_time_max = max(self.detect_time_max, elapsed)
+                self._interval = self.min_interval
+            self.status = status
+            self.sequence += 1
+            self.updated = now
+            self._condition.notify_all()
+
+    def poll(self):
+        """Read the port once, the reply publishes the condition register. The
+           footswitch callback is left to the threads asking for status, see
+           Sender.read_port()."""
+        start = time.perf_counter()
+        port = self._sender.raw_read_port()
+        now = time.perf_counter()
+        with self._condition:
+            self.port = port
+            self.port_sequence += 1
+            self.port_previous = self.port_updated
+            self.port_updated = now
+            self._condition.notify_all()
+        elapsed = now - start
+        self.polls += 1
+        self.poll_time += elapsed
+        self.poll_time_max = max(self.poll_time_max, elapsed)
+
+    def _run(self):
+        self._sender._io_lock.set_background()
+        while self._running:
+            try:
+                self.poll()
+            except (BalorException, usb.core.USBError) as e:
+                with self._condition:
+                    self.error = e
+                    self._running = False
+                    self._condition.notify_all()
+                return
+            with self._condition:
+                draining = self._waiters or (self.status or 0) & STATUS_BUSY
+                limit = self.busy_interval if draining else self.idle_interval
+                self._interval = min(self._interval * self.backoff, limit)
+                # Sleep until the interval has passed since the last update, which
+                # replies to other commands push back, or until poked.
+                while self._running and not self._poke:
+                    remaining = self.updated + self._interval - time.perf_counter()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+                self._poke = False
+
+    def wait_for(self, predicate, timeout=None, abort=None, since=None, kind="status", port=False):
+        """Block until predicate(status) holds for a condition register read
+           after this call, or after the read numbered `since` if given.
+           Returns False on timeout or once abort() is true. kind labels the
+           wait in the statistics. port=True tests predicate(port) on the input
+           port reads, numbered by port_sequence, instead.
+
+           Polls inline if the monitor thread is not running."""
+        if port:
+            def read():
+                return self.port_sequence, self.port
+        else:
+            def read():
+                return self.sequence, self.status
+        start = time.perf_counter()
+        deadline = None if timeout is None else start + timeout
+        with self._condition:
+            current, value = read()
+            sequence = current if since is None else since
+            if current != sequence and predicate(value):
+                # Already answered by a reply since `since`, no need to poll.
+                self._waited(kind, time.perf_counter() - start)
+                return True
+            self._waiters += 1
+            self._interval = self.min_interval
+            self._poke = True
+            self._condition.notify_all()
+        try:
+            while True:
+                if abort is not None and abort():
+                    return False
+                if not self._running:
+                    if self.error is not None:
+                        raise BalorCommunicationException(
+                            "Status monitor stopped: %s" % self.error
+                        )
+                    self.poll()
+                with self._condition:
+                    current, value = read()
+                    if current != sequence and predicate(value):
+                        return True
+                    sequence = current
+                    if deadline is not None and time.perf_counter() >= deadline:
+                        return False
+                    if self._running:
+                        self._condition.wait(self.busy_interval)
+                if not self._running:
+                    time.sleep(self._sender.sleep_time)
+        finally:
+            with self._condition:
+                self._waiters -= 1
+            self._waited(kind, time.perf_counter() - start)
+
+    def _waited(self, kind, seconds):
+        self.waits += 1
+        self.wait_time += seconds
+        histogram = self.wait_histograms.get(kind)
+        if histogram is None:
+            histogram = self.wait_histograms[kind] = LatencyHistogram()
+        histogram.add(seconds)
+
+    def wait_ready(self, timeout=None, abort=None, since=None):
+        return self.wait_for(
+            lambda status: status & STATUS_READY, timeout, abort, since, kind="ready"
+        )
+
+    def wait_idle(self, timeout=None, abort=None, since=None):
+        return self.wait_for(
+            lambda status: not status & STATUS_BUSY, timeout, abort, since, kind="idle"
+        )
+
+    def wait_footswitch(self, pressed=True, timeout=None, abort=None):
+        """Block until an input port read shows the footswitch pressed, or released."""
+        return self.wait_for(
+            lambda port: bool(port[0] & 0x8000) == pressed,
+            timeout, abort, kind="footswitch", port=True,
+        )
+
+    def stats(self):
+        """Poll rate and latency counters, times in seconds."""
+        elapsed = time.perf_counter() - self.started
+        return {
+            "polls": self.polls,
+            "poll_rate": self.polls / elapsed if elapsed > 0 else 0.0,
+            "poll_latency_mean": self.poll_time / self.polls if self.polls else 0.0,
+            "poll_latency_max": self.poll_time_max,
+            "changes": self.changes,
+            "detect_latency_mean": self.detect_time / self.changes if self.changes else 0.0,
+            "detect_latency_max": self.detect_time_max,
+            "waits": self.waits,
+            "wait_time": self.wait_time,
+            "wait_by_kind": {k: h.to_dict() for k, h in self.wait_histograms.items()},
+            "interval": self._interval,
+        }
+
+
+class PositionStream:
+    """Streams galvo positions for a Sender, latest wins.
+
+    move() only records the target and returns. A background thread sends
+    SET_XY_POSITION for whatever target is newest, no more than max_rate times
+    a second, so a burst of jog or pointer events collapses into the last one
+    and the galvo never falls behind a queue of stale positions."""
+    max_rate = 200.0
+
+    def __init__(self, sender):
+        self._sender = sender
+        self._condition = threading.Condition()
+        self._thread = None
+        self._running = False
+        # Newest (x, y) not yet sent, and when the oldest request it replaces came in.
+        self._target = None
+        self._requested = None
+        self._sending = False
+        self._last_send = None
+        self.error = None
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.started = time.perf_counter()
+        self.requests = 0
+        self.sent = 0
+        self.coalesced = 0
+        self.errors = 0
+        # Time with a target pending or being sent, over which the rate is measured.
+        self.active_time = 0.0
+        self._active_since = None
+        # From the oldest request a send answered until the board acknowledged it.
+        self.lag = LatencyHistogram()
+
+    @property
+    def running(self):
+        return self._running
+
+    def start(self):
+        if self._running:
+            return
+        self._running = True
+        self.error = None
+        self._thread = threading.Thread(
+            target=self._run, name="balor-jog", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        """Ends the thread, dropping any target not yet sent."""
+        with self._condition:
+            self._running = False
+            self._target = None
+            self._active_since = None
+            self._condition.notify_all()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+        self._thread = None
+
+    def move(self, x, y):
+        """Set the galvo target, replacing any target not yet sent."""
+        now = time.perf_counter()
+        with self._condition:
+            self.requests += 1
+            if self._target is not None:
+                self.coalesced += 1
+            else:
+                self._requested = now
+                if self._active_since is None:
+                    self._active_since = now
+            self._target = (int(x), int(y))
+            self._condition.notify_all()
+
+    def discard(self, wait=True):
+        """Drop any target not yet sent, so a position set directly is not followed by
+           a stale one. With wait, also block until a send already under way is done."""
+        with self._condition:
+            if self._target is not None:
+                self._target = None
+                if not self._sending and self._active_since is not None:
+                    self.active_time += time.perf_counter() - self._active_since
+                    self._active_since = None
+                self._condition.notify_all()
+            if wait and self._thread is not threading.current_thread():
+                self._condition.wait_for(lambda: not self._sending)
+
+    def flush(self, timeout=None):
+        """Block until the last target was sent. Returns False on timeout."""
+        with self._condition:
+            return self._condition.wait_for(
+                lambda: not self._running or (self._target is None and not self._sending),
+                timeout,
+            )
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while self._running:
+                    if self._target is not None:
+                        interval = 1.0 / self.max_rate if self.max_rate else 0.0
+                        remaining = (
+                            0.0 if self._last_send is None
+                            else self._last_send + interval - time.perf_counter()
+                        )
+                        if remaining <= 0:
+                            break
+                        # Anything arriving meanwhile replaces the target.
+                        self._condition.wait(remaining)
+                    else:
+                        self._condition.wait()
+                if not self._running:
+                    return
+                x, y = self._target
+                requested = self._requested
+                self._target = None
+                self._sending = True
+                self._last_send = time.perf_counter()
+            try:
+                self._sender._send_xy(x, y)
+            except BalorException as e:
+                self.error = e
+                self.errors += 1
+            else:
+                now = time.perf_counter()
+                self.sent += 1
+                self.lag.add(now - requested)
+            with self._condition:
+                self._sending = False
+                if self._target is None and self._active_since is not None:
+                    self.active_time += time.perf_counter() - self._active_since
+                    self._active_since = None
+                self._condition.notify_all()
+
+    def stats(self):
+        """Request and send counts, the rate achieved while streaming and the lag,
+           times in seconds."""
+        return {
+            "max_rate": self.max_rate,
+            "requests": self.requests,
+            "sent": self.sent,
+            "coalesced": self.coalesced,
+            "errors": self.errors,
+            "rate": self.sent / self.active_time if self.active_time > 0 else 0.0,
+            "lag": self.lag.to_dict(),
+        }
+
+
+class PacketPipeline:
+    """Compiles list packets on a producer thread ahead of the thread sending them.
+
+    Up to `depth` packets wait ready in a bounded queue, so the Python work of
+    packet_generator overlaps with USB I/O instead of adding to the time the board
+    waits for data. Records queue depth and starvation, when the sender found no
+    packet ready, across every run()."""
+
+    def __init__(self, depth=4):
+        self.depth = depth
+        self._stop = threading.Event()
+        self.packets = 0
+        self.depth_total = 0
+        self.depth_max = 0
+        self.startup_time = 0.0
+        self.starvations = 0
+        self.starvation_time = 0.0
+        self.compile_time = 0.0
+
+    def _produce(self, packets, ready):
+        try:
+            start = time.perf_counter()
+            for packet in packets:
+                # Generators may yield one buffer rewritten in place, so copy it.
+                packet = bytes(packet)
+                self.compile_time += time.perf_counter() - start
+                if not self._put(ready, packet):
+                    return
+                start = time.perf_counter()
+            self._put(ready, None)
+        except Exception as e:
+            self._put(ready, e)
+        finally:
+            # Let the generator clean up here, on the thread running it.
+            close = getattr(packets, "close", None)
+            if close is not None:
+                close()
+
+    def _put(self, ready, item):
+        """Queue item for the sender, False if the pipeline was closed first."""
+        while not self._stop.is_set():
+            try:
+                ready.put(item, timeout=0.05)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def run(self, packet_generator):
+        """Iterate over the packets of packet_generator(), compiled on another thread."""
+        self._stop.clear()
+        ready = queue.Queue(self.depth)
+        thread = threading.Thread(
+            target=self._produce,
+            args=(packet_generator(), ready),
+            name="balor-compile",
+            daemon=True,
+        )
+        thread.start()
+        first = True
+        try:
+            while True:
+                depth = ready.qsize()
+                if depth:
+                    packet = ready.get()
+                else:
+                    start = time.perf_counter()
+                    packet = self._get(ready)
+                    waited = time.perf_counter() - start
+                    if first:
+                        self.startup_time += waited
+                    elif packet is not None:
+                        self.starvations += 1
+                        self.starvation_time += waited
+                if packet is None:
+                    return
+                if isinstance(packet, Exception):
+                    raise packet
+                first = False
+                self.packets += 1
+                self.depth_total += depth
+                self.depth_max = max(self.depth_max, depth)
+                yield packet
+        finally:
+            self.close()
+
+    def _get(self, ready):
+        """The next packet, None once closed, however long the generator takes."""
+        while True:
+            try:
+                return ready.get(timeout=0.05)
+            except queue.Empty:
+                if self._stop.is_set():
+                    return None
+
+    def close(self):
+        """Stop the producer, e.g. when the job is aborted."""
+        self._stop.set()
+
+    def stats(self):
+        return {
+            "depth": self.depth,
+            "packets": self.packets,
+            "depth_mean": self.depth_total / self.packets if self.packets else 0.0,
+            "depth_max": self.depth_max,
+            "startup_time": self.startup_time,
+            "starvations": self.starvations,
+            "starvation_time": self.starvation_time,
+            "compile_time": self.compile_time,
+        }
 
 
 class Sender:
@@ -106,6 +696,26 @@ class Sender:
     It does have an .abort() method that it is expected will be called 
     asynchronously from another thread."""
     sleep_time = 0.001
+    # Packets compiled ahead of the USB writes by execute(), 0 compiles inline.
+    pipeline_depth = 4
+    # "packet" sends SET_END_OF_LIST and EXECUTE_LIST after every list packet, as
+    # EzCad does. "start" sends them after the first packet of each loop only and
+    # writes the rest into the running list.
+    handshake = "packet"
+    # Packets the board buffers, sent without confirming READY in between when the
+    # handshake is "start". None confirms every packet; a READY bit only promises
+    # room for one more, so a run longer than the board's buffer overflows it.
+    list_buffer_packets = None
+    # Packets of list memory a job stays in after it ran, for RESTART_LIST and
+    # EXECUTE_LIST to run it again without sending it. Jobs run again that fit are
+    # uploaded once. None uploads every run.
+    list_memory_packets = None
+    # Most packets of a job kept compiled on the host, to send again without
+    # regenerating them when it is run again.
+    loop_cache_packets = 1024
+    # Most packets of an armed job written to the board ahead of the trigger, fewer
+    # if READY drops first.
+    arm_packets = 8
 
     # We include this "blob" here (the contents of which are all well-understood) to 
     # avoid introducing a dependency on job generation from within the sender.
@@ -122,52 +732,196 @@ class Sender:
 
     def __init__(self, footswitch_callback=None, debug=False):
         self._lock = threading.Lock()
+        # Serializes USB transactions between threads, the job's list writes and the
+        # status monitor yielding to everyone else.
+        self._io_lock = IoLock()
+        self.monitor = StatusMonitor(self)
+        self.positions = PositionStream(self)
         self._terminate_execution = False
         self._footswitch_callback = footswitch_callback
         self._debug = debug
         self._usb_connection = None
         self._write_port = 0x0000
-
-
-    def open(self, machine_index=0, mock=False, **kwargs):
+        self.connect_time = None
+        self.correction_sent = False
+        # Seconds the last correction table upload took, None if it was not sent.
+        self.correction_time = None
+        self.init_verified = False
+        self.init_commands = 0
+        # The connected board's entry in _board_states, None for emulated and replayed ones.
+        self._board = None
+        self.pipeline = None
+        self.round_trips = 0
+        self.send_stats = None
+        self.stop_latency = None
+        self.stop_histogram = LatencyHistogram()
+        # Last (arguments, reply) of each SHADOWED command, and the sends saved by it.
+        self._shadow = {}
+        self.elided = {}
+        # (loop_index, packet_index) last sent by the running job, and the last
+        # galvo position set or read with when.
+        self.progress = None
+        self._xy = None
+        # (job, version, fingerprint, packets) of the last job compiled, and (job,
+        # version, fingerprint) of the job in the board's list memory, to run them again
+        # without compiling or sending them. The refresh period of every run.
+        self._compiled = None
+        self._resident = None
+        self.restarts = 0
+        self.reused = 0
+        self.refresh = LatencyHistogram()
+        # Commands sent that cleared list memory, to tell when a staged list was lost.
+        self.list_clears = 0
+        self._armed = False
+        self._arm_thread = None
+        # From the trigger seen to EXECUTE_LIST acknowledged, and the gap between the
+        # port reads before it, how long the trigger may have come before it was seen.
+        self.trigger_latency = None
+        self.trigger_histogram = LatencyHistogram()
+        self.trigger_window = LatencyHistogram()
+
+
+    def open(self, machine_index=0, mock=False, record=None, **kwargs):
+        """Connect to and initialize a machine. mock=True connects to an
+           emulated board instead, mock may also be a connection object such
+           as a configured balor.emulator.EmulatedConnection or a
+           balor.recording.ReplayConnection. record is a file to record the
+           session's USB traffic to."""
         if self._usb_connection is not None:
             raise BalorCommunicationException("Attempting to open an open connection.")
         if not mock:
             connection = UsbConnection(machine_index, debug=self._debug)
+        elif mock is True:
+            from balor.emulator import EmulatedConnection
+            connection = EmulatedConnection(machine_index, debug=self._debug)
         else:
-            connection = MockConnection(machine_index, debug=self._debug)
+            connection = mock
+            connection._debug = self._debug
+        if record:
+            from balor.recording import RecordingConnection
+            connection = RecordingConnection(connection, record)
         connection.open()
         self._usb_connection = connection
+        self.invalidate_shadow()
+        self._resident = None
+        start = time.perf_counter()
+        if mock:
+            # Emulated and replayed boards start fresh and must see the same commands
+            # every run.
+            kwargs["force_init"] = True
         self._init_machine(**kwargs)
-        time.sleep(0.05)  # We sacrifice this time at the altar of the unknown race condition
+        if mock:
+            self._board = None
+        if not self.init_verified:
+            time.sleep(0.05)  # We sacrifice this time at the altar of the unknown race condition
+        self.connect_time = time.perf_counter() - start
+        if self._debug:
+            self._debug(
+                "Machine %s in %.3fs, %d setting commands, correction table %s."
+                % ("reconnected" if self.init_verified else "initialized",
+                   self.connect_time, self.init_commands,
+                   "sent in %.3fs" % self.correction_time if self.correction_sent
+                   else "unchanged, not sent")
+            )
+        self.monitor.reset_stats()
+        self.monitor.start()
+        self.positions.start()
         return True
 
     def close(self):
+        self.positions.stop()
+        self._armed = False
         self.abort()
-        if self._usb_connection is not None:
-            self._usb_connection.close()
-        self._usb_connection = None
+        self.disarm()
+        self.monitor.stop()
+        with self._io_lock:
+            if self._usb_connection is not None:
+                self._usb_connection.close()
+            self._usb_connection = None
+        self._board = None
+
+    @property
+    def lost(self):
+        """True once the open board stopped answering, e.g. after a USB hiccup."""
+        return self._usb_connection is not None and self.monitor.error is not None
+
+    def drop(self):
+        """Forgets a lost connection without talking to the board, so open() can be
+           called again. What the board was last known to hold is kept for open()
+           to check, and only what it lost is sent again."""
+        self.positions.stop()
+        self._armed = False
+        self._terminate_execution = True
+        if self.pipeline is not None:
+            self.pipeline.close()
+        self.monitor.stop()
+        with self._io_lock:
+            if self._usb_connection is not None:
+                try:
+                    self._usb_connection.close()
+                except (BalorException, usb.core.USBError):
+                    pass
+            self._usb_connection = None
+        self._board = None
 
     def job(self, *args, **kwargs):
         return CommandList(*args, **kwargs, sender=self)
 
-    def _send_command(self, *args, **kwargs):
+    def _connection(self):
+        """The open connection, call holding _io_lock."""
         if self._usb_connection is None:
             raise BalorCommunicationException("No usb connection.")
-        return self._usb_connection.send_command(*args, **kwargs)
+        return self._usb_connection
+
+    def _send_command(self, *args, **kwargs):
+        with self._io_lock:
+            connection = self._connection()
+            reply = connection.send_command(*args, **kwargs)
+            if kwargs.get("read", True):
+                self.round_trips += 1
+                self.monitor.publish(connection.status)
+            for code in SHADOW_INVALIDATED_BY.get(args[0], ()):
+                self._shadow.pop(code, None)
+            if args[0] in LIST_MEMORY_CLEARED_BY:
+                self._resident = None
+                self.list_clears += 1
+            if args[0] in (EXECUTE_LIST, RESTART_LIST) and self._board is not None:
+                self._board["xy"] = None
+            return reply
+
+    def _send_immediate(self, code, *args):
+        """Sends a command setting machine state, unless the same arguments were the
+           last sent and nothing since may have changed that state. Galvo moves are
+           always sent while the board is busy."""
+        with self._io_lock:
+            shadow = self._shadow.get(code)
+            if shadow is not None and shadow[0] == args and not (
+                code == SET_XY_POSITION and (self.monitor.status or 0) & STATUS_BUSY
+            ):
+                self.elided[code] = self.elided.get(code, 0) + 1
+                return shadow[1]
+            reply = self._send_command(code, *args)
+            self._shadow[code] = (args, reply)
+            return reply
+
+    def invalidate_shadow(self):
+        """Forget the shadowed machine state, so the next immediate commands are sent."""
+        with self._io_lock:
+            self._shadow.clear()
 
     def _send_correction_entry(self, *args):
-        if self._usb_connection is None:
-            raise BalorCommunicationException("No usb connection.")
-        self._usb_connection.send_correction_entry(*args)
+        with self._io_lock:
+            self._connection().send_correction_entry(*args)
 
-    def _send_list_chunk(self, *args):
-        if self._usb_connection is None:
-            raise BalorCommunicationException("No usb connection.")
-        self._usb_connection.send_list_chunk(*args)
+    def _send_list_chunk(self, packet):
+        with self._io_lock:
+            self._connection().send_list_chunk(packet)
+            if _LIST_WRITE_PORT in packet:
+                self._shadow.pop(WRITE_PORT, None)
 
     def _init_machine(self,
                       cor_file=None,
+                      cor_data=None,
                       first_pulse_killer=200,
                       pwm_half_period=125,
                       pwm_pulse_width=125,
@@ -185,163 +939,583 @@ class Sender:
                       fly_res_p2=99,
                       fly_res_p3=1000,
                       fly_res_p4=25,
+                      force_correction=False,
+                      force_init=False,
                       **kwargs):
-        """Initialize the machine."""
+        """Initialize the machine.
+           A board initialized before in this process, whose identifying replies are
+           unchanged and whose galvo still reports the position it was last known at,
+           read without moving it, is taken to have kept its settings: only the
+           settings that differ are sent, and the reset is skipped. The correction
+           table is likewise only sent if it differs, unless force_correction. Any
+           other board, one last known at a position a reset board reports too, one
+           lost mid job, or force_init, is sent everything.
+           cor_data is the contents of a .cor file, and takes the place of cor_file."""
         self.serial_number = self.raw_get_serial_no()
         self.version = self.raw_get_version()
-        self.raw_get_st_mo_ap()
-        
-        # Unknown function
-        self.raw_reset()
+        probe = (self.serial_number, self.version, self.raw_get_st_mo_ap())
+
+        # Nothing is known of the board until this init completes.
+        previous = _board_states.pop(self.serial_number, None)
+        self._board = None
+        xy = previous["xy"] if previous is not None else None
+        self.init_verified = (
+            not force_init
+            and previous is not None
+            and previous["probe"] == probe
+            and xy is not None
+            and xy not in _RESET_POSITIONS
+            and tuple(self.raw_get_xy_position()) == xy
+        )
+        applied = previous["settings"] if self.init_verified else {}
+        settings = {}
+        self.init_commands = 0
+
+        if not self.init_verified:
+            # Unknown function
+            self.raw_reset()
 
         # Load in-machine correction table
-        cor_table = None
-        if cor_file is not None:
-            cor_table = self._read_correction_file(cor_file)
-        self._send_correction_table(cor_table)
-
-        self.raw_enable_laser()
-        self.raw_set_control_mode(control_mode,0)
-        self.raw_set_laser_mode(laser_mode, 0)
-        self.raw_set_delay_mode(delay_mode, 0)
-        self.raw_set_timing(timing_mode, 0)
-        self.raw_set_standby(standby_param_1, standby_param_2, 0, 0)
-        self.raw_set_first_pulse_killer(first_pulse_killer, 0)
-        self.raw_set_pwm_half_period(pwm_half_period, 0)
-
-        # unknown function
-        self.raw_set_pwm_pulse_width(pwm_pulse_width, 0)
-        # "IPG_OpenMO" (main oscillator?)
-        self.raw_fiber_open_mo(0, 0)
-        # Unclear if used for anything
-        self._send_command(GET_REGISTER, 0)
-
-        # 0x0FFB is probably a 12 bit rendering of int12 -5
-        # Apparently some parameters for the first pulse killer
-        self.raw_set_fpk_param_2(fpk2_p1, fpk2_p2, fpk2_p3, fpk2_p4)
-
-        # Unknown fiber laser related command
-        self.raw_set_fly_res(fly_res_p1, fly_res_p2, fly_res_p3, fly_res_p4)
-
-        # Is this appropriate for all laser engraver machines?
-        self.raw_write_port(self._write_port)
-
-        # Conjecture is that this puts the output port out of a 
-        # high impedance state (based on the name in the DLL,
-        # ENABLEZ)
-        # Based on how it's used, it could also be about latching out
-        # some of the data that has been set up.
-        self.raw_enable_z()
-
-        # We don't know what this does, since this laser's power is set
-        # digitally
-        self.raw_write_analog_port_1(0x07FF, 0)
-        self.raw_enable_z()
+        packed = self._load_correction_table(cor_file, cor_data)
+        settings["correction"] = hashlib.sha1(packed).hexdigest()
+        self.correction_sent = force_correction or applied.get("correction") != settings["correction"]
+        self.correction_time = None
+        if self.correction_sent:
+            start = time.perf_counter()
+            self._send_correction_table(packed)
+            self.correction_time = time.perf_counter() - start
+
+        # (name, command, arguments) in the order they are sent. Settings unchanged
+        # on a verified board are skipped; ENABLE_Z goes whenever anything went before it.
+        steps = [
+            ("enable_laser", self.raw_enable_laser, ()),
+            ("control_mode", self.raw_set_control_mode, (control_mode, 0)),
+            ("laser_mode", self.raw_set_laser_mode, (laser_mode, 0)),
+            ("delay_mode", self.raw_set_delay_mode, (delay_mode, 0)),
+            ("timing", self.raw_set_timing, (timing_mode, 0)),
+            ("standby", self.raw_set_standby, (standby_param_1, standby_param_2, 0, 0)),
+            ("first_pulse_killer", self.raw_set_first_pulse_killer, (first_pulse_killer, 0)),
+            ("pwm_half_period", self.raw_set_pwm_half_period, (pwm_half_period, 0)),
+            # unknown function
+            ("pwm_pulse_width", self.raw_set_pwm_pulse_width, (pwm_pulse_width, 0)),
+            # "IPG_OpenMO" (main oscillator?)
+            ("fiber_open_mo", self.raw_fiber_open_mo, (0, 0)),
+            # Unclear if used for anything
+            ("get_register", self._send_command, (GET_REGISTER, 0)),
+            # 0x0FFB is probably a 12 bit rendering of int12 -5
+            # Apparently some parameters for the first pulse killer
+            ("fpk_param_2", self.raw_set_fpk_param_2, (fpk2_p1, fpk2_p2, fpk2_p3, fpk2_p4)),
+            # Unknown fiber laser related command
+            ("fly_res", self.raw_set_fly_res, (fly_res_p1, fly_res_p2, fly_res_p3, fly_res_p4)),
+            # Is this appropriate for all laser engraver machines?
+            ("write_port", self.raw_write_port, (self._write_port,)),
+            # Conjecture is that this puts the output port out of a
+            # high impedance state (based on the name in the DLL,
+            # ENABLEZ)
+            # Based on how it's used, it could also be about latching out
+            # some of the data that has been set up.
+            ("enable_z", self.raw_enable_z, ()),
+            # We don't know what this does, since this laser's power is set
+            # digitally
+            ("analog_port_1", self.raw_write_analog_port_1, (0x07FF, 0)),
+            ("enable_z", self.raw_enable_z, ()),
+        ]
+        pending = False
+        for name, command, args in steps:
+            if name == "enable_z":
+                send = pending or name not in applied
+                pending = False
+            else:
+                # The laser stays off and the output port as this Sender has it.
+                send = name in ("fiber_open_mo", "write_port") or applied.get(name) != args
+                pending = pending or send
+            if send:
+                command(*args)
+                self.init_commands += 1
+            settings[name] = args
+
+        self._board = _board_states[self.serial_number] = {
+            "probe": probe,
+            "settings": settings,
+            "xy": xy if self.init_verified else None,
+        }
 
     def _read_correction_file(self, filename):
-        table = []
+        """Reads the 65x65 table of a .cor file as (4225, 2) uint16 dx, dy entries."""
         with open(filename, "rb") as f:
-            f.seek(0x24)
-            for j in range(65):
-                for k in range(65):
-                    dx = int.from_bytes(f.read(4), "little", signed=True)
-                    dx = dx if dx >= 0 else -dx + 0x8000
-                    dy = int.from_bytes(f.read(4), "little", signed=True)
-                    dy = dy if dy >= 0 else -dy + 0x8000
-                    table.append([dx & 0xFFFF, dy & 0xFFFF])
-        return table
-
-    def _send_correction_table(self, table=None):
-        """Send the onboard correction table to the machine."""
+            return self._parse_correction_data(f.read())
+
+    @staticmethod
+    def _parse_correction_data(data):
+        # 65*65 little endian int32 dx, dy pairs after a 0x24 byte header.
+        table = np.frombuffer(data, dtype="<i4", count=65 * 65 * 2, offset=0x24)
+        table = table.astype(np.int64).reshape(65 * 65, 2)
+        # Negative values are stored sign-magnitude, with 0x8000 as the sign bit.
+        table = np.where(table >= 0, table, -table + 0x8000)
+        return (table & 0xFFFF).astype(np.uint16)
+
+    @staticmethod
+    def _pack_correction_table(table=None):
+        """Packs a correction table into the 4225 WRITE_CORRECTION_LINE commands,
+        12 bytes each. No table packs all zero corrections."""
+        packed = np.zeros((65 * 65, 6), dtype="<u2")
+        packed[:, 0] = WRITE_CORRECTION_LINE
+        if table is not None:
+            packed[:, 1:3] = table
+        packed[1:, 3] = 1  # nonfirst
+        return packed.tobytes()
+
+    def _load_correction_table(self, cor_file=None, cor_data=None):
+        """Packed correction commands for cor_file, or the .cor contents cor_data,
+        cached by the hash of the contents."""
+        data = cor_data
+        if data is None and cor_file is not None:
+            with open(cor_file, "rb") as f:
+                data = f.read()
+        key = None if data is None else hashlib.sha1(data).hexdigest()
+        packed = _correction_cache.get(key)
+        if packed is None:
+            table = None if data is None else self._parse_correction_data(data)
+            packed = self._pack_correction_table(table)
+            _correction_cache[key] = packed
+        return packed
+
+    def _send_correction_table(self, packed):
+        """Send the packed onboard correction table to the machine."""
         self.raw_write_correction_table(True)
-        if table is None:
-            for n in range(65**2):
-                self.raw_write_correction_line(0,0,0 if n == 0 else 1)
-        else:
-            for n in range(65**2):
-                self.raw_write_correction_line(table[n][0], table[n][1],0 if n == 0 else 1)
+        with self._io_lock:
+            self._connection().send_correction_table(packed)
 
-    def is_ready(self):
-        """Returns true if the laser is ready for more data, false otherwise."""
-        self.read_port()
-        return bool(self._usb_connection.status & 0x20)
+    def is_ready(self, fresh=False):
+        """Returns true if the laser is ready for more data, false otherwise.
+           Answers from the status monitor while it is running, which may be up to
+           its idle_interval old; fresh=True reads the board."""
+        return bool(self._current_status(fresh) & STATUS_READY)
 
-    def is_busy(self):
+    def is_busy(self, fresh=False):
         """Returns true if the machine is busy, false otherwise;
-           Note that running a lighting job counts as being busy."""
+           Note that running a lighting job counts as being busy.
+           Answers from the status monitor while it is running, which may be up to
+           its idle_interval old; fresh=True reads the board."""
+        return bool(self._current_status(fresh) & STATUS_BUSY)
+
+    def _current_status(self, fresh=False):
+        if not fresh and self.monitor.running and self.monitor.status is not None:
+            self._check_footswitch(self.monitor.port)
+            return self.monitor.status
         self.read_port()
-        return bool(self._usb_connection.status & 0x04)
+        return self._usb_connection.status
+
+    def _aborted(self):
+        # The job's waits call this on the job's thread, where the footswitch callback
+        # fired when they read the port themselves.
+        self._check_footswitch(self.monitor.port)
+        return self._terminate_execution
 
     def execute(self, command_list: CommandSource, loop_count=1,
-                callback_finished=None):
+                callback_finished=None, callback_progress=None, trigger=None):
         """Run a job. loop_count is the number of times to repeat the
            job; if it is inf, it repeats until aborted. If there is a job
            already running, it will be aborted and replaced. Optionally,
-           calls a callback function when the job is finished.
+           calls a callback function when the job is finished, and
+           callback_progress(kind, loop_index, packet_index) as each packet
+           is sent ("packet") and each loop completes ("loop").
            The loop job can either be regular data in multiples of 3072 bytes, or
-           it can be a callable that provides data as above on command."""
+           it can be a callable that provides data as above on command.
+           Commands from other threads go between the list writes, see IoLock.
+           A streamed position still pending is sent first, not into the job.
+           With a trigger, the job is compiled and its first packets written to
+           the board, then trigger() blocks until it should start and returns
+           the perf_counter() time the trigger was seen, or None to give up;
+           callback_progress("fired", 0, None) follows the start. See arm()."""
+        self.positions.flush()
+        self._io_lock.set_background()
+        try:
+            return self._execute(command_list, loop_count, callback_finished, callback_progress, trigger)
+        finally:
+            self._io_lock.set_background(False)
+            self.progress = None
+            # A source fed from another thread, such as a CommandStream, takes no more
+            # packets and its generator stops waiting for them.
+            stop = getattr(command_list, "stop", None)
+            if stop is not None:
+                stop()
+
+    loop_job = execute
+
+    def _execute(self, command_list, loop_count, callback_finished, callback_progress, trigger):
         self._terminate_execution = False
+        monitor = self.monitor
         with self._lock:
-            while self.is_busy():
-                time.sleep(self.sleep_time)
-                if self._terminate_execution:
-                    return False
-            while not self.is_ready():
-                time.sleep(self.sleep_time)
-                if self._terminate_execution:
-                    return False
+            if not monitor.wait_idle(abort=self._aborted):
+                return False
+            if not monitor.wait_ready(abort=self._aborted):
+                return False
 
             self.port_on(bit=0)
 
+            if self.pipeline_depth:
+                self.pipeline = PacketPipeline(self.pipeline_depth)
+            start = time.perf_counter()
+            round_trips = self.round_trips
+            sent = 0
+            restarts = self.restarts
+            reused = self.reused
             loop_index = 0
+            # A job that cannot change under us may be run again from list memory or
+            # from the packets compiled for the last run.
+            cacheable = command_list.tick is None and command_list.version is not None
             while loop_index < loop_count:
+                loop_start = time.perf_counter()
                 if command_list.tick is not None:
                     command_list.tick(command_list, loop_index)
-                self.raw_reset_list()
-
-                for packet in command_list.packet_generator():
-                    while not self.is_ready():
-                        if self._terminate_execution:
+                key = None
+                if cacheable:
+                    key = (command_list, command_list.version)
+                    if key in ((self._resident or ())[:2], (self._compiled or ())[:2]):
+                        # The version only follows the job's own methods, make sure nothing
+                        # was edited in place.
+                        key += (command_list.fingerprint(),)
+                if cacheable and self._resident == key:
+                    if not self._unless_aborted(self.raw_restart_list):
+                        return False
+                    if trigger is not None:
+                        if not self._fire(trigger, callback_progress, end_of_list=False):
                             return False
-                        time.sleep(self.sleep_time)
-                    self._usb_connection.send_list_chunk(packet)
-                    self.raw_set_end_of_list(0x8001, 0x8001)
-                    self.raw_execute_list()
-                    # SET_END_OF_LIST(1), EXECUTE_LIST, 7
-
-                # when done, SET_END_OF_LIST(0), SET_CONTROL_MODE(1), 7(1)
-                self.raw_set_end_of_list(0, 0)
-                #self.raw_execute_list()
-                self.raw_set_control_mode(1,0)
-
-                while self.is_busy():
-                    if self._terminate_execution:
+                    elif not self._unless_aborted(self.raw_execute_list):
+                        return False
+                    monitor.wake()
+                    self.restarts += 1
+                    count = 0
+                else:
+                    self.raw_reset_list()
+                    compiled = self._compiled
+                    if cacheable and compiled is not None and compiled[:3] == key:
+                        packets = compiled[3]
+                        self.reused += 1
+                        compiled = None
+                    elif trigger is not None:
+                        # Compile it all now rather than after the trigger.
+                        packets = [bytes(packet) for packet in command_list.packet_generator()]
+                        compiled = None
+                        if cacheable:
+                            key = self._cache_key(command_list)
+                            if len(packets) <= self.loop_cache_packets:
+                                self._compiled = key + (packets,)
+                    else:
+                        if self.pipeline_depth:
+                            packets = self.pipeline.run(command_list.packet_generator)
+                        else:
+                            packets = command_list.packet_generator()
+                        compiled = [] if cacheable else None
+                    count = self._send_packets(packets, loop_index, compiled, callback_progress, trigger)
+                    if count is None or self._terminate_execution:
                         return False
+                    sent += count
+                    if compiled is not None:
+                        self._compiled = None
+                        if len(compiled) <= self.loop_cache_packets:
+                            key = self._cache_key(command_list)
+                            self._compiled = key + (compiled,)
+
+                    # when done, SET_END_OF_LIST(0), SET_CONTROL_MODE(1), 7(1)
+                    self.raw_set_end_of_list(0, 0)
+                    #self.raw_execute_list()
+                    self.raw_set_control_mode(1,0)
+
+                if not monitor.wait_idle(abort=self._aborted):
+                    return False
+                trigger = None
+                if count and cacheable and count <= (self.list_memory_packets or 0):
+                    if len(key) < 3:
+                        key = self._cache_key(command_list)
+                    self._resident = key
+                self.refresh.add(time.perf_counter() - loop_start)
+                if callback_progress is not None:
+                    callback_progress("loop", loop_index, None)
                 loop_index += 1
+            self._record_send_stats(
+                sent, self.round_trips - round_trips, time.perf_counter() - start,
+                loop_index, self.restarts - restarts, self.reused - reused,
+            )
+            if self._board is not None:
+                # Where the list left the galvo, for a reconnect to check.
+                self.get_xy()
         if callback_finished is not None:
             callback_finished()
         return True
 
-    loop_job = execute
+    @staticmethod
+    def _cache_key(command_list):
+        """(job, version, fingerprint) identifying the packets a job just compiled to."""
+        return command_list, command_list.version, command_list.fingerprint()
+
+    def _send_packets(self, packets, loop_index, compiled, callback_progress, trigger=None):
+        """Writes a loop's list packets with the configured handshake, appending them
+           to compiled unless it is None. With a trigger, up to arm_packets are
+           written without starting the list, which starts once trigger() returns.
+           Returns the number sent, None if aborted."""
+        monitor = self.monitor
+        # Packets that may still be sent before READY has to be confirmed.
+        credits = 0
+        since = None
+        count = 0
+        for packet_index, packet in enumerate(packets):
+            if compiled is not None and len(compiled) <= self.loop_cache_packets:
+                # Generators may yield one buffer rewritten in place, so copy it.
+                packet = bytes(packet)
+                compiled.append(packet)
+            if trigger is not None and packet_index and (
+                packet_index >= self.arm_packets or not self._has_room(since)
+            ):
+                # Staged all that fits, the rest goes once the list runs.
+                if not self._fire(trigger, callback_progress):
+                    return None
+                trigger = None
+                credits = 0
+            if credits <= 0:
+                if not monitor.wait_ready(abort=self._aborted, since=since):
+                    return None
+                credits = self._ahead()
+            since = monitor.sequence
+            if not self._unless_aborted(self._send_list_chunk, packet):
+                return None
+            credits -= 1
+            count += 1
+            self.progress = (loop_index, packet_index)
+            if trigger is None and (self.handshake != "start" or packet_index == 0):
+                # The replies to these are fresh status, READY in them
+                # lets the next packet go without polling.
+                if not self._unless_aborted(self.raw_set_end_of_list, 0x8001, 0x8001):
+                    return None
+                if not self._unless_aborted(self.raw_execute_list):
+                    return None
+            # SET_END_OF_LIST(1), EXECUTE_LIST, 7
+            if callback_progress is not None:
+                callback_progress("packet", loop_index, packet_index)
+        if trigger is not None and not self._fire(trigger, callback_progress):
+            return None
+        return count
+
+    def _has_room(self, since):
+        """Whether a condition register read after the read numbered since is READY."""
+        monitor = self.monitor
+        if not monitor.wait_for(lambda status: True, abort=self._aborted, since=since, kind="ready"):
+            return False
+        return bool(monitor.status & STATUS_READY)
+
+    def _fire(self, trigger, callback_progress, end_of_list=True):
+        """Waits for trigger() and starts the list staged on the board. Returns False
+           if the trigger gave up or an abort came in."""
+        seen = trigger()
+        if seen is None:
+            return False
+        if end_of_list and not self._unless_aborted(self.raw_set_end_of_list, 0x8001, 0x8001):
+            return False
+        if not self._unless_aborted(self.raw_execute_list):
+            return False
+        self.trigger_latency = time.perf_counter() - seen
+        self.trigger_histogram.add(self.trigger_latency)
+        self.monitor.wake()
+        if self._debug:
+            self._debug("Fired %.1fms after the trigger was seen." % (self.trigger_latency * 1e3))
+        if callback_progress is not None:
+            callback_progress("fired", 0, None)
+        return True
+
+    def _ahead(self):
+        """Packets to send before confirming READY again. With the full handshake every
+           packet's replies confirm READY for free, so only the lean handshake sends ahead,
+           by the configured buffer size."""
+        if self.handshake != "start":
+            return 1
+        return self.list_buffer_packets or 1
+
+    def usb_stats(self):
+        """Everything measured about this connection: transport latency and traffic,
+           status monitor polling and waits, and the last job's send and compile
+           statistics. JSON serializable."""
+        connection = self._usb_connection
+        return {
+            "connection": connection.stats.to_dict() if connection is not None else None,
+            "round_trips": self.round_trips,
+            "connect": {
+                "time": self.connect_time,
+                "verified": self.init_verified,
+                "commands": self.init_commands,
+                "correction_time": self.correction_time,
+            },
+            "monitor": self.monitor.stats(),
+            "send": self.send_stats,
+            "pipeline": self.pipeline.stats() if self.pipeline is not None else None,
+            "abort": {
+                "stop_latency": self.stop_latency,
+                "stop": self.stop_histogram.to_dict(),
+            },
+            "elided": {OPCODE_NAMES.get(code, code): count for code, count in self.elided.items()},
+            "io_wait": self._io_lock.stats(),
+            "loops": {
+                "restarts": self.restarts,
+                "reused": self.reused,
+                "refresh": self.refresh.to_dict(),
+                "refresh_rate": self.refresh.count / self.refresh.total if self.refresh.total > 0 else 0.0,
+            },
+            "positions": self.positions.stats(),
+            "trigger": {
+                "armed": self._armed,
+                "latency": self.trigger_latency,
+                "fired": self.trigger_histogram.to_dict(),
+                "window": self.trigger_window.to_dict(),
+            },
+        }
+
+    def reset_usb_stats(self):
+        if self._usb_connection is not None:
+            self._usb_connection.stats.reset()
+        self.monitor.reset_stats()
+        self.round_trips = 0
+        self.send_stats = None
+        self.pipeline = None
+        self.stop_histogram = LatencyHistogram()
+        self.elided = {}
+        self.restarts = 0
+        self.reused = 0
+        self.refresh = LatencyHistogram()
+        self.trigger_histogram = LatencyHistogram()
+        self.trigger_window = LatencyHistogram()
+        self._io_lock.reset_stats()
+        self.positions.reset_stats()
+
+    def _record_send_stats(self, packets, round_trips, seconds, loops=1, restarts=0, reused=0):
+        self.send_stats = {
+            "handshake": self.handshake,
+            "buffer_packets": self._ahead(),
+            "packets": packets,
+            "round_trips": round_trips,
+            "round_trips_per_packet": round_trips / packets if packets else 0.0,
+            "seconds": seconds,
+            "bytes_per_second": packets * self._packet_size / seconds if seconds > 0 else 0.0,
+            # Runs of the job, how many were restarted from list memory or sent from
+            # packets compiled before, and runs per second.
+            "loops": loops,
+            "restarts": restarts,
+            "reused": reused,
+            "refresh_rate": loops / seconds if seconds > 0 else 0.0,
+        }
+        if self._debug:
+            self._debug(
+                "Sent %d packets in %.3fs, %.1f round trips per packet, %.0f bytes/s."
+                % (packets, seconds, self.send_stats["round_trips_per_packet"],
+                   self.send_stats["bytes_per_second"])
+            )
+
+    def _unless_aborted(self, function, *args):
+        """Runs a job transaction unless an abort has come in. The check and the
+           transaction share _io_lock, so nothing the job sends can follow an
+           abort's stop onto the bus."""
+        with self._io_lock:
+            if self._terminate_execution:
+                return False
+            function(*args)
+            return True
 
     def abort(self):
         """Aborts any job in progress and puts the machine back into an
-           idle ready condition."""
+           idle ready condition. The list is stopped and the laser turned off
+           first, without waiting for the job thread to let go of the machine;
+           stop_latency is the time from the call until the board acknowledged
+           both."""
+        requested = time.perf_counter()
         self._terminate_execution = True
+        # No jog still pending goes out after the galvo is recentred below.
+        self.positions.discard(wait=False)
+        self.raw_stop_execute()
+        self.raw_fiber_open_mo(0,0)
+        self.stop_latency = time.perf_counter() - requested
+        self.stop_histogram.add(self.stop_latency)
+        self.invalidate_shadow()
+        if self.pipeline is not None:
+            self.pipeline.close()
+        self.monitor.wake()
+        if self._debug:
+            self._debug("Stopped in %.1fms." % (self.stop_latency * 1e3))
         with self._lock:
-            self.raw_stop_execute()
-            self.raw_fiber_open_mo(0,0)
             self.raw_reset_list()
             self._send_list_chunk(self._abort_list_chunk)
 
             self.raw_set_end_of_list()
             self.raw_execute_list()
 
-            while self.is_busy():
-                time.sleep(self.sleep_time)
+            self.monitor.wait_idle()
 
             self.set_xy(0x8000, 0x8000)
 
+    def arm(self, command_list, loop_count=1, rearm=True,
+            callback_finished=None, callback_progress=None):
+        """Stages a job to run when the footswitch is pressed. The job is compiled
+           and its first packets written to the board now, or it is left in list
+           memory, so pressing the footswitch only has to start the list. The
+           status monitor watches the input port meanwhile and the job starts on
+           the press, not while the footswitch is held. It arms again once the
+           job finishes unless rearm is False, until disarm() or abort().
+           trigger_latency is the time from the press seen to the list started."""
+        self.disarm()
+        self._armed = True
+        self._arm_thread = threading.Thread(
+            target=self._run_armed,
+            args=(command_list, loop_count, rearm, callback_finished, callback_progress),
+            name="balor-armed",
+            daemon=True,
+        )
+        self._arm_thread.start()
+
+    @property
+    def armed(self):
+        return self._armed
+
+    def disarm(self):
+        """Stops waiting for the footswitch and drops the staged packets. A job
+           already started runs to the end."""
+        self._armed = False
+        thread = self._arm_thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+        self._arm_thread = None
+
+    def _run_armed(self, command_list, loop_count, rearm, callback_finished, callback_progress):
+        while self._armed:
+            if self.execute(command_list, loop_count, callback_finished,
+                            callback_progress, trigger=self._wait_footswitch):
+                if not rearm:
+                    break
+                continue
+            if self._terminate_execution:
+                break
+            if not self._armed:
+                with self._lock:
+                    self.raw_reset_list()
+                break
+            # Something cleared the staged list, stage it again.
+        self._armed = False
+
+    def _wait_footswitch(self):
+        """The trigger of an armed job: the time a press of the footswitch was
+           seen, None if disarmed, aborted or the staged list was cleared."""
+        monitor = self.monitor
+        staged = self.list_clears
+
+        def cancelled():
+            return self._terminate_execution or not self._armed or self.list_clears != staged
+
+        if not monitor.wait_footswitch(False, abort=cancelled):
+            return None
+        if not monitor.wait_footswitch(True, abort=cancelled):
+            return None
+        seen = monitor.port_updated
+        if monitor.port_previous is not None:
+            self.trigger_window.add(seen - monitor.port_previous)
+        return seen
+
     def set_footswitch_callback(self, callback_footswitch):
         """Sets the callback function for the footswitch."""
         self._footswitch_callback = callback_footswitch
@@ -376,21 +1550,66 @@ class Sender:
 
     def read_port(self):
         port = self.raw_read_port()
-        if port[0] & 0x8000 and self._footswitch_callback:
+        self._check_footswitch(port)
+        return port
+
+    def _check_footswitch(self, port):
+        """Calls the footswitch callback, once, if port shows the footswitch pressed.
+           Only called on threads asking for status, never the status monitor's."""
+        if port is not None and port[0] & 0x8000 and self._footswitch_callback:
             callback = self._footswitch_callback
             self._footswitch_callback = None
             callback(port)
 
-        return port
-
     def set_xy(self, x, y):
         """Change the galvo position. If the machine is running a job,
-           this will abort the job."""
+           this will abort the job. A streamed position not yet sent is dropped."""
+        self.positions.discard()
+        self._send_xy(x, y)
+
+    def _send_xy(self, x, y):
         self.raw_set_xy_position(x,y)
+        self._note_xy(x, y)
+
+    def stream_xy(self, x, y):
+        """Change the galvo position without waiting for it. Only the newest of a
+           burst of positions is sent, at most positions.max_rate a second, see
+           PositionStream. Use for jogging and following the pointer."""
+        self.positions.move(x, y)
 
     def get_xy(self):
         """Returns the galvo position."""
-        return self.raw_get_xy_position()
+        xy = self.raw_get_xy_position()
+        self._note_xy(*xy)
+        return xy
+
+    def _note_xy(self, x, y):
+        self._xy = (int(x), int(y), time.perf_counter())
+        if self._board is not None:
+            self._board["xy"] = (int(x), int(y))
+
+    def snapshot(self):
+        """The last known machine state, from replies already received, without
+           touching USB. Cheap enough for a GUI to call on every refresh, from any
+           thread, while a job runs. Ages are seconds since the value was current."""
+        now = time.perf_counter()
+        monitor = self.monitor
+        status = monitor.status
+        port = monitor.port
+        xy = self._xy
+        return {
+            "connected": self._usb_connection is not None,
+            "status": status,
+            "status_age": now - monitor.updated if status is not None else None,
+            "busy": bool(status & STATUS_BUSY) if status is not None else None,
+            "ready": bool(status & STATUS_READY) if status is not None else None,
+            "input_port": port[0] if port is not None else None,
+            "footswitch": bool(port[0] & 0x8000) if port is not None else None,
+            "output_port": self._write_port,
+            "xy": xy[:2] if xy is not None else None,
+            "xy_age": now - xy[2] if xy is not None else None,
+            "progress": self.progress,
+        }
 
     #############################
     # Raw LMC Interface Commands.
@@ -466,7 +1685,7 @@ class Sender:
         :param y:
         :return: value response
         """
-        return self._send_command(SET_XY_POSITION, int(x), int(y))
+        return self._send_immediate(SET_XY_POSITION, int(x), int(y))
 
     def raw_laser_signal_off(self):
         """
@@ -633,7 +1852,7 @@ class Sender:
         :param value:
         :return: value response
         """
-        return self._send_command(WRITE_PORT, v1, s1, value)
+        return self._send_immediate(WRITE_PORT, v1, s1, value)
 
     def raw_write_analog_port_1(self, s1: int, value: int):
         """
@@ -643,7 +1862,7 @@ class Sender:
         :param value:
         :return: value response
         """
-        return self._send_command(WRITE_ANALOG_PORT_1, s1, value)
+        return self._send_immediate(WRITE_ANALOG_PORT_1, s1, value)
 
     def raw_write_analog_port_2(self, s1: int, value: int):
         """
@@ -653,7 +1872,7 @@ class Sender:
         :param value:
         :return: value response
         """
-        return self._send_command(WRITE_ANALOG_PORT_2, 0, s1, value)
+        return self._send_immediate(WRITE_ANALOG_PORT_2, 0, s1, value)
 
     def raw_write_analog_port_x(self, v1: int, s1: int, value: int):
         """
@@ -664,7 +1883,7 @@ class Sender:
         :param value:
         :return: value response
         """
-        return self._send_command(WRITE_ANALOG_PORT_X, v1, s1, value)
+        return self._send_immediate(WRITE_ANALOG_PORT_X, v1, s1, value)
 
     def raw_read_port(self):
         """
@@ -913,6 +2132,113 @@ class Sender:
         return self._send_command(SET_FPK_PARAM, v1, v2, v3, s1)
 
 
+class LatencyHistogram:
+    """Counts of durations in power of two microsecond buckets, bucket n holding
+       durations under 2**n us. Adding a sample is a few integer operations."""
+    buckets = 24
+
+    def __init__(self):
+        self.counts = [0] * self.buckets
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.counts[min(int(seconds * 1e6).bit_length(), self.buckets - 1)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, fraction):
+        """Upper bound in seconds of the bucket holding the given fraction of samples."""
+        if not self.count:
+            return 0.0
+        target = fraction * self.count
+        seen = 0
+        for n, count in enumerate(self.counts):
+            seen += count
+            if seen >= target:
+                return min((1 << n) * 1e-6, self.max)
+        return self.max
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "total": self.total,
+            "mean": self.total / self.count if self.count else 0.0,
+            "p50": self.percentile(0.5),
+            "p99": self.percentile(0.99),
+            "max": self.max,
+            "buckets_us": {str(1 << n): c for n, c in enumerate(self.counts) if c},
+        }
+
+
+class UsbStats:
+    """Timing and traffic counters for a connection: per opcode write and read
+       latency, list chunk send time, bytes moved and timeouts."""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.started = time.perf_counter()
+        self.writes = {}
+        self.reads = {}
+        self.chunks = LatencyHistogram()
+        self.bytes_written = 0
+        self.bytes_read = 0
+        self.timeouts = 0
+        self.errors = 0
+
+    def write(self, code, seconds, size=12):
+        histogram = self.writes.get(code)
+        if histogram is None:
+            histogram = self.writes[code] = LatencyHistogram()
+        histogram.add(seconds)
+        self.bytes_written += size
+
+    def read(self, code, seconds, size=8):
+        histogram = self.reads.get(code)
+        if histogram is None:
+            histogram = self.reads[code] = LatencyHistogram()
+        histogram.add(seconds)
+        self.bytes_read += size
+
+    def chunk(self, seconds, size):
+        self.chunks.add(seconds)
+        self.bytes_written += size
+
+    def failed(self, error):
+        if isinstance(error, usb.core.USBTimeoutError):
+            self.timeouts += 1
+        else:
+            self.errors += 1
+
+    @staticmethod
+    def _by_opcode(histograms):
+        return {
+            OPCODE_NAMES.get(code, "0x%04X" % code): histogram.to_dict()
+            for code, histogram in sorted(histograms.items())
+        }
+
+    def to_dict(self):
+        elapsed = time.perf_counter() - self.started
+        chunk_time = self.chunks.total
+        return {
+            "elapsed": elapsed,
+            "bytes_written": self.bytes_written,
+            "bytes_read": self.bytes_read,
+            "bytes_per_second": (self.bytes_written + self.bytes_read) / elapsed if elapsed > 0 else 0.0,
+            "chunk_bytes_per_second": self.chunks.count * UsbConnection.chunk_size / chunk_time if chunk_time > 0 else 0.0,
+            "timeouts": self.timeouts,
+            "errors": self.errors,
+            "writes": self._by_opcode(self.writes),
+            "reads": self._by_opcode(self.reads),
+            "list_chunks": self.chunks.to_dict(),
+        }
+
+
 class UsbConnection:
     chunk_size = 12*256
     ep_hodi = 0x01  # endpoint for the "dog," i.e. dongle.
@@ -925,6 +2251,7 @@ class UsbConnection:
         self.device = None
         self.status = None
         self._debug = debug
+        self.stats = UsbStats()
 
     def open(self):
         devices=list(usb.core.find(find_all=True, idVendor=0x9588, idProduct=0x9899))
@@ -955,14 +2282,42 @@ class UsbConnection:
     def is_ready(self):
         self.send_command(READ_PORT, 0)
         return self.status & 0x20
+
+    def _write(self, data):
+        try:
+            return self.device.write(self.ep_homi, data, 100)
+        except usb.core.USBError as e:
+            self.stats.failed(e)
+            raise
     
     def send_correction_entry(self, correction):
-        """Send an individual correction table entry to the machine."""
+        """Send an individual packed 12 byte WRITE_CORRECTION_LINE to the machine."""
         # This is really a command and should just be issued without reading.
-        query = bytearray([0x10] + [0] * 11)
-        query[2:2 + 5] = correction
-        if self.device.write(self.ep_homi, query, 100) != 12:
+        if len(correction) != 12:
+            raise BalorDataValidityException("Invalid correction entry size %d" % len(correction))
+        start = time.perf_counter()
+        if self._write(correction) != 12:
             raise BalorCommunicationException("Failed to write correction entry")
+        self.stats.write(WRITE_CORRECTION_LINE, time.perf_counter() - start)
+        if self._debug:
+            self._debug("---> " + str(correction))
+
+    def send_correction_table(self, packed):
+        """Send packed WRITE_CORRECTION_LINE commands back to back. The machine does
+           not reply to these, so nothing is read between them. They are still one
+           12 byte transfer each, as they always were: whether the board takes several
+           commands in one transfer is unknown. Time is saved by not sending an
+           unchanged table at all, see Sender._init_machine()."""
+        write = self._write
+        record = self.stats.write
+        clock = time.perf_counter
+        for i in range(0, len(packed), 12):
+            start = clock()
+            if write(packed[i:i + 12]) != 12:
+                raise BalorCommunicationException("Failed to write correction entry")
+            record(WRITE_CORRECTION_LINE, clock() - start)
+        if self._debug:
+            self._debug("---> %d correction entries" % (len(packed) // 12))
 
     def send_command(self, code, *parameters, read=True):
         """Send a command to the machine and return the response.
@@ -973,12 +2328,20 @@ class UsbConnection:
         for n, parameter in enumerate(parameters):
             query[2 * n + 2] = parameter & 0x00FF
             query[2 * n + 3] = (parameter >> 8) & 0x00FF
-        if self.device.write(self.ep_homi, query, 100) != 12:
+        start = time.perf_counter()
+        if self._write(query) != 12:
             raise BalorCommunicationException("Failed to write command")
+        written = time.perf_counter()
+        self.stats.write(code, written - start)
         if self._debug:
             self._debug("---> " + str(query))
         if read:
-            response = self.device.read(self.ep_himo, 8, 100)
+            try:
+                response = self.device.read(self.ep_himo, 8, 100)
+            except usb.core.USBError as e:
+                self.stats.failed(e)
+                raise
+            self.stats.read(code, time.perf_counter() - written)
             if len(response) != 8:
                 raise BalorCommunicationException("Invalid response")
             if self._debug:
@@ -993,54 +2356,11 @@ class UsbConnection:
         if len(data) != self.chunk_size:
             raise BalorDataValidityException("Invalid chunk size %d" % len(data))
 
-        sent = self.device.write(self.ep_homi, data, 100)
+        start = time.perf_counter()
+        sent = self._write(data)
+        self.stats.chunk(time.perf_counter() - start, sent)
         if sent != len(data):
             raise BalorCommunicationException("Could not send list chunk")
         if self._debug:
             self._debug("---> " + str(data))
 
-
-class MockConnection:
-    def __init__(self, machine_index=0, debug=None):
-        self.machine_index = machine_index
-        self._debug = debug
-        self.device = True
-
-    @property
-    def status(self):
-        import random
-        return random.randint(0, 255)
-
-    def open(self):
-        self.device = True
-        if self._debug:
-            self._debug("Connected.")
-
-    def close(self):
-        if self._debug:
-            self._debug("Disconnected.")
-
-    def send_correction_entry(self, correction):
-        """Send an individual correction table entry to the machine."""
-        pass
-
-    def send_command(self, code, *parameters, read=True):
-        """Send a command to the machine and return the response.
-           Updates the host condition register as a side effect."""
-        if self._debug:
-            self._debug("---> " + str(code) + " " + str(parameters))
-        time.sleep(0.005)
-        # This should be replaced with a robust connection to the simulation code
-        # so the fake laser can give sensical responses
-        if read:
-            import random
-            return random.randint(0, 255), random.randint(0, 255)
-        else:
-            return 0, 0
-
-    def send_list_chunk(self, data):
-        """Send a command list chunk to the machine."""
-        if len(data) != 0xC00:
-            raise BalorDataValidityException("Invalid chunk size %d" % len(data))
-        if self._debug:
-            self._debug("---> " + str(data))
@@ -0,0 +1,198 @@
+"""
+Sender throughput benchmark.
+
+Drives Sender.execute with synthetic jobs of raster rows, hatch fills and looped light
+jobs like animate-clock.py, from a thousand to millions of list ops, against the
+emulated board (balor.emulator). Reports packets per second, host CPU per packet, USB
+round trips per packet, time the board sat starved for data and end to end job time,
+as JSON, so runs before and after a change can be diffed.
+
+    python -m balor.sender_benchmark --sizes 1000,100000,1000000 --output before.json
+
+The board plays the lists at time_scale times their real duration. The default of 0
+plays them instantly, so the host is the bottleneck and its throughput is what is
+measured; at 1 the job runs as long as it would on a machine.
+"""
+import argparse
+import json
+import math
+import platform
+import sys
+import time
+
+import numpy as np
+
+from .command_list import CommandList, CommandSource
+from .emulator import EmulatedConnection
+from .sender import Sender
+
+SEGMENT_OPS = 50000
+
+
+class SegmentedJob(CommandSource):
+    """A job built and compiled SEGMENT_OPS at a time, so jobs of millions of ops
+    are streamed rather than held in memory. build(job, start, count) appends
+    count ops to job, continuing from op start."""
+
+    def __init__(self, ops, build, tick=None):
+        self.ops = ops
+        self.build = build
+        self.tick = tick
+
+    def packet_generator(self):
+        for start in range(0, self.ops, SEGMENT_OPS):
+            job = CommandList()
+            self.build(job, start, min(SEGMENT_OPS, self.ops - start))
+            yield from job.packet_generator()
+
+
+def _marking(job):
+    job.set_frequency(30)
+    job.set_power(50)
+    job.set_laser_on_delay(100)
+    job.set_laser_off_delay(100)
+    job.set_polygon_delay(10)
+    job.set_travel_speed(4000)
+    job.set_cut_speed(1000)
+
+
+def build_raster(job, start, count):
+    """Rows of 0x1000 galvo units, a travel and a short mark per pixel, 0x100 wide."""
+    _marking(job)
+    pixels = 0x1000 // 0x100
+    for n in range(start // 2, (start + count) // 2):
+        row, pixel = divmod(n, pixels)
+        y = 0x6000 + (row * 8) % 0x4000
+        x = 0x6000 + pixel * 0x100
+        job.goto(x, y)
+        job.mark(x + 0xC0, y)
+
+
+def build_hatch(job, start, count):
+    """Long parallel lines across the field, a travel and a mark each."""
+    _marking(job)
+    for n in range(start // 2, (start + count) // 2):
+        y = 0x4000 + (n * 16) % 0x8000
+        job.goto(0x4000, y)
+        job.mark(0xC000, y)
+
+
+def light_loop(ops):
+    """A circle of ops light moves, regenerated by tick before every loop as
+    animate-clock.py redraws its time."""
+
+    def tick(job, loop_index):
+        job.clear()
+        job.set_travel_speed(8000)
+        angle = np.linspace(0, 2 * math.pi, ops) + loop_index * 0.1
+        xs = (0x8000 + 0x3000 * np.cos(angle)).astype(int)
+        ys = (0x8000 + 0x3000 * np.sin(angle)).astype(int)
+        job.light(int(xs[0]), int(ys[0]), light=False, jump_delay=200)
+        for x, y in zip(xs.tolist(), ys.tolist()):
+            job.light(x, y, light=True, jump_delay=0)
+        job.light_off()
+
+    return CommandList(tick=tick)
+
+
+WORKLOADS = {"raster": build_raster, "hatch": build_hatch, "light": None}
+
+
+def run(sender, board, workload, ops, loops):
+    if workload == "light":
+        job = light_loop(max(ops // loops, 1))
+    else:
+        job = SegmentedJob(ops, WORKLOADS[workload])
+    sender.reset_usb_stats()
+    board.underruns = 0
+    board.starved_time = 0.0
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    completed = sender.execute(job, loops if workload == "light" else 1)
+    cpu = time.process_time() - cpu
+    wall = time.perf_counter() - wall
+    send = sender.send_stats or {}
+    packets = send.get("packets", 0)
+    stats = sender.usb_stats()
+    return {
+        "workload": workload,
+        "ops": ops,
+        "loops": loops if workload == "light" else 1,
+        "completed": completed,
+        "packets": packets,
+        "wall_time": wall,
+        "packets_per_second": packets / wall if wall > 0 else 0.0,
+        "ops_per_second": ops / wall if wall > 0 else 0.0,
+        "cpu_time": cpu,
+        "cpu_per_packet": cpu / packets if packets else 0.0,
+        "round_trips_per_packet": send.get("round_trips_per_packet", 0.0),
+        "device_starved_time": board.starved_time,
+        "device_underruns": board.underruns,
+        "host_starvation_time": stats["pipeline"]["starvation_time"] if stats["pipeline"] else None,
+        "compile_time": stats["pipeline"]["compile_time"] if stats["pipeline"] else None,
+        "list_chunk_latency": stats["connection"]["list_chunks"],
+    }
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Benchmark Sender job throughput.")
+    parser.add_argument(
+        "--sizes", default="1000,10000,100000,1000000", help="comma separated job sizes in ops"
+    )
+    parser.add_argument(
+        "--workloads", default=",".join(WORKLOADS), help="comma separated, raster, hatch and/or light"
+    )
+    parser.add_argument("--loops", type=int, default=10, help="loops of the light job, ops are split over them")
+    parser.add_argument("--handshakes", default="packet,start", help="comma separated list handshakes")
+    parser.add_argument("--time-scale", type=float, default=0.0, help="board speed, 1 is real time")
+    parser.add_argument("--latency", type=float, default=0.0002, help="seconds per command round trip")
+    parser.add_argument("--chunk-latency", type=float, default=0.0005, help="seconds per list chunk")
+    parser.add_argument("--buffer-packets", type=int, default=8, help="board list buffer, in packets")
+    parser.add_argument("--pipeline-depth", type=int, default=Sender.pipeline_depth)
+    parser.add_argument("--output", help="write JSON here instead of stdout")
+    args = parser.parse_args(args)
+
+    board = EmulatedConnection(
+        buffer_packets=args.buffer_packets,
+        time_scale=args.time_scale,
+        latency=args.latency,
+        chunk_latency=args.chunk_latency,
+    )
+    sender = Sender()
+    sender.pipeline_depth = args.pipeline_depth
+    sender.open(mock=board)
+    results = []
+    try:
+        for handshake in [h for h in args.handshakes.split(",") if h]:
+            sender.handshake = handshake
+            for workload in [w for w in args.workloads.split(",") if w]:
+                for ops in [int(s) for s in args.sizes.split(",") if s]:
+                    result = run(sender, board, workload, ops, args.loops)
+                    result["handshake"] = handshake
+                    results.append(result)
+    finally:
+        sender.close()
+
+    report = {
+        "benchmark": "sender",
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "board": {
+            "time_scale": args.time_scale,
+            "latency": args.latency,
+            "chunk_latency": args.chunk_latency,
+            "buffer_packets": args.buffer_packets,
+        },
+        "pipeline_depth": args.pipeline_depth,
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=1)
+    else:
+        json.dump(report, sys.stdout, indent=1)
+        print()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,69 @@
+import math
 import sys
+import threading
 import time
 
+import numpy as np
+
+from meerk40t.core.cutcode import CubicCut, LineCut, QuadCut
 from meerk40t.core.parameters import Parameters
 
 from balor.Cal import Cal
-from balor.command_list import CommandList
+from balor.command_list import CommandList, CommandStream
 from balor.sender import Sender, BalorMachineException
 
 
+def flatten_quad(p0, p1, p2, tolerance):
+    """
+    Points along a quadratic bezier, from p0 to p2, with the chords within tolerance of the curve.
+    """
+    p = np.array([p0, p1, p2], dtype=float)
+    bend = np.hypot(*(p[0] - 2 * p[1] + p[2]))
+    n = max(1, int(math.ceil(math.sqrt(0.25 * bend / tolerance))))
+    t = np.linspace(0.0, 1.0, n + 1)[:, None]
+    return (1 - t) ** 2 * p[0] + 2 * (1 - t) * t * p[1] + t ** 2 * p[2]
+
+
+def flatten_cubic(p0, p1, p2, p3, tolerance):
+    """
+    Points along a cubic bezier, from p0 to p3, with the chords within tolerance of the curve.
+    """
+    p = np.array([p0, p1, p2, p3], dtype=float)
+    bend = max(np.hypot(*(p[0] - 2 * p[1] + p[2])), np.hypot(*(p[1] - 2 * p[2] + p[3])))
+    n = max(1, int(math.ceil(math.sqrt(0.75 * bend / tolerance))))
+    t = np.linspace(0.0, 1.0, n + 1)[:, None]
+    return (
+        (1 - t) ** 3 * p[0]
+        + 3 * (1 - t) ** 2 * t * p[1]
+        + 3 * (1 - t) * t ** 2 * p[2]
+        + t ** 3 * p[3]
+    )
+
+
+def reduce_collinear(points):
+    """
+    Drops repeated points and the inner points of straight runs, where the path goes on in the same
+    direction and, if there is a third column of power, at the same power.
+
+    @param points: (N, 2) x, y or (N, 3) x, y, on
+    @return:
+    """
+    if len(points) < 2:
+        return points
+    steps = np.diff(points, axis=0)
+    points = points[np.concatenate(([True], np.any(steps != 0, axis=1)))]
+    if len(points) < 3:
+        return points
+    d = np.diff(points[:, :2], axis=0)
+    cross = d[:-1, 0] * d[1:, 1] - d[:-1, 1] * d[1:, 0]
+    dot = d[:-1, 0] * d[1:, 0] + d[:-1, 1] * d[1:, 1]
+    keep = (cross != 0) | (dot <= 0)
+    if points.shape[1] > 2:
+        on = points[:, 2]
+        keep |= (on[:-2] != on[1:-1]) | (on[1:-1] != on[2:])
+    return points[np.concatenate(([True], keep, [True]))]
+
+
 class BalorDriver(Parameters):
     def __init__(self, service):
         Parameters.__init__(self)
@@ -29,6 +85,15 @@ class BalorDriver(Parameters):
         self.queue = []
         self.redlight_preferred = False
 
+        # Streamed mark job: the packets queued for the board, the job compiling into them, the
+        # power it was left at and the thread running it. The lock keeps reset() from dropping it
+        # while plot() is part way through a cut.
+        self.stream = None
+        self._stream_job = None
+        self._stream_on = None
+        self._stream_thread = None
+        self._stream_lock = threading.Lock()
+
     def __repr__(self):
         return "BalorDriver(%s)" % self.name
 
@@ -39,6 +104,11 @@ class BalorDriver(Parameters):
         self._shutdown = True
 
     def connect_if_needed(self):
+        if self.connected and self.connection.lost:
+            # A USB hiccup: reconnect, sending the board only what it lost.
+            self.channel("Connection lost: %s" % self.connection.monitor.error)
+            self.connection.drop()
+            self.connected = False
         if not self.connected:
             self.connect()
 
@@ -49,12 +119,18 @@ class BalorDriver(Parameters):
         :return:
         """
         self.connected = False
+        self.connection.handshake = self.service.list_handshake
+        self.connection.list_buffer_packets = self.service.list_buffer_packets or None
+        self.connection.list_memory_packets = self.service.list_memory_packets or None
+        self.connection.positions.max_rate = self.service.jog_rate or None
         while not self.connected:
             try:
                 self.connected = self.connection.open(
                     mock=self.service.mock,
+                    record=self.service.usb_record or None,
                     machine_index=self.service.machine_index,
                     cor_file=self.service.corfile,
+                    cor_data=self.service.correction_data,
                     first_pulse_killer=self.service.first_pulse_killer,
                     pwm_pulse_width=self.service.pwm_pulse_width,
                     pwm_half_period=self.service.pwm_half_period,
@@ -72,7 +148,19 @@ class BalorDriver(Parameters):
                     fly_res_p2=self.service.fly_res_p2,
                     fly_res_p3=self.service.fly_res_p3,
                     fly_res_p4=self.service.fly_res_p4,
+                    force_correction=self.service.always_send_correction,
+                    force_init=self.service.always_init,
                 )
+                if self.connected:
+                    self.channel(
+                        "%s in %.0fms, %d setting commands, correction table %s." % (
+                            "Reconnected" if self.connection.init_verified else "Initialized",
+                            self.connection.connect_time * 1000,
+                            self.connection.init_commands,
+                            "sent in %.0fms" % (self.connection.correction_time * 1000)
+                            if self.connection.correction_sent else "kept",
+                        )
+                    )
                 if self.redlight_preferred:
                     self.connection.light_on()
                 else:
@@ -95,41 +183,6 @@ class BalorDriver(Parameters):
         self.connected = False
         self.service.signal("pipe;usb_status", "Disconnected")
 
-    def group(self, plot):
-        """
-        avoids yielding any place where 0, 1, 2 are in a straight line or equal power.
-
-        This might be a little naive compared to other methods of plotplanning but a general solution does not
-        necessarily exist.
-        :return:
-        """
-        plot = list(plot)
-        for i in range(0, len(plot)):
-            if len(plot[i]) == 2:
-                try:
-                    x0, y0 = plot[i - 1]
-                    x1, y1 = plot[i]
-                    x2, y2 = plot[i + 1]
-                    if x2 - x1 == x1 - x0 and y2 - y1 == y1 - y0:
-                        continue
-                except IndexError:
-                    pass
-            else:
-                try:
-                    x0, y0, on0 = plot[i - 1]
-                    x1, y1, on1 = plot[i]
-                    x2, y2, on2 = plot[i + 1]
-                    if (
-                        x2 - x1 == x1 - x0
-                        and y2 - y1 == y1 - y0
-                        and on0 == on1
-                        and on1 == on2
-                    ):
-                        continue
-                except IndexError:
-                    pass
-            yield plot[i]
-
     # def cutcode_to_light_job(self, queue):
     #     """
     #     Converts a queue of cutcode operations into a light job.
@@ -173,13 +226,20 @@ class BalorDriver(Parameters):
         @param queue:
         @return:
         """
-        cal = None
-        if self.service.calibration_file is not None:
-            try:
-                cal = Cal(self.service.calibration_file)
-            except TypeError:
-                pass
-        job = CommandList(cal=cal)
+        job = self.mark_job()
+        last_on = None
+        for plot in queue:
+            last_on = self.compile_cut(job, plot, last_on)
+        job.laser_control(False)
+        return job
+
+    def mark_job(self):
+        """
+        A new mark job with the mark settings set, at the center of the field, laser control on.
+
+        @return:
+        """
+        job = CommandList(cal=self.service.job_calibration)
         job.set_mark_settings(
             travel_speed=self.service.travel_speed,
             power=self.service.laser_power,
@@ -192,29 +252,67 @@ class BalorDriver(Parameters):
         job.set_write_port(self.connection.get_port())
         job.goto(0x8000, 0x8000)
         job.laser_control(True)
-        last_on = None
-        for plot in queue:
-            start = plot.start
-            job.goto(start[0], start[1])
+        return job
 
-            for e in self.group(plot.generator()):
-                on = 1
-                if len(e) == 2:
-                    x, y = e
-                else:
-                    x, y, on = e
-                if on == 0:
+    def compile_cut(self, job, plot, last_on):
+        """
+        Adds a piece of cutcode to a mark job.
+
+        Lines and curves are taken from their geometry: a line is one mark and a curve is flattened
+        to within curve_tolerance galvo units. Other cutcode is plotted from its generator. Either
+        way straight runs are reduced to their ends and marked in bulk.
+
+        @param job: mark job
+        @param plot: cutcode
+        @param last_on: power the job was left at, as a fraction of laser_power
+        @return: power the job is left at
+        """
+        tolerance = self.service.curve_tolerance
+        start = plot.start
+        job.goto(start[0], start[1])
+        if isinstance(plot, LineCut):
+            points = np.array([start, plot.end], dtype=float)
+        elif isinstance(plot, QuadCut):
+            points = np.rint(flatten_quad(start, plot.c(), plot.end, tolerance))
+        elif isinstance(plot, CubicCut):
+            points = np.rint(flatten_cubic(start, plot.c1(), plot.c2(), plot.end, tolerance))
+        else:
+            points = None
+        if points is not None:
+            points = reduce_collinear(points)[1:]
+            if len(points):
+                if last_on != 1:
+                    last_on = 1
+                    job.set_power(self.service.laser_power)
+                job.mark_polyline(points)
+            return last_on
+
+        plotted = [e if len(e) == 3 else (e[0], e[1], 1) for e in plot.generator()]
+        if not plotted:
+            return last_on
+        points = reduce_collinear(np.array(plotted, dtype=float))
+        if points[0, 0] == start[0] and points[0, 1] == start[1]:
+            # Already there.
+            points = points[1:]
+            if not len(points):
+                return last_on
+        on = points[:, 2]
+        # Runs of points at the same power, each a travel or a bulk mark.
+        breaks = np.flatnonzero(on[1:] != on[:-1]) + 1
+        for run in np.split(np.arange(len(points)), breaks):
+            run_on = on[run[0]]
+            if run_on == 0:
+                for x, y in points[run, :2].tolist():
                     try:
                         job.goto(x, y)
                     except ValueError:
                         print("Not including this stroke path:", file=sys.stderr)
-                else:
-                    if last_on is None or on != last_on:
-                        last_on = on
-                        job.set_power(self.service.laser_power * on)
-                    job.mark(x, y)
-        job.laser_control(False)
-        return job
+            else:
+                if last_on is None or run_on != last_on:
+                    last_on = run_on
+                    job.set_power(self.service.laser_power * run_on)
+                job.mark_polyline(points[run, :2])
+        return last_on
 
     def hold_work(self):
         """
@@ -266,10 +364,65 @@ class BalorDriver(Parameters):
         This command is called with bits of cutcode as they are processed through the spooler. This should be optimized
         bits of cutcode data with settings on them from paths etc.
 
+        With stream_jobs, the cutcode is compiled as it comes and each full packet is sent straight away.
+
         :param plot:
         :return:
         """
-        self.queue.append(plot)
+        if not self.service.stream_jobs:
+            self.queue.append(plot)
+            return
+        with self._stream_lock:
+            if self.stream is None:
+                self.connect_if_needed()
+                self.stream = CommandStream(self.service.stream_packets)
+                self._stream_job = self.mark_job()
+                self._stream_on = None
+            self._stream_on = self.compile_cut(self._stream_job, plot, self._stream_on)
+            self._flush_stream()
+
+    def _flush_stream(self, final=False):
+        """
+        Queues the full packets of the streamed job, or all of it if final, and starts it running once a few
+        packets are waiting, so a slow start does not leave the board waiting for more straight away.
+        """
+        for packet in self._stream_job.take_packets(final):
+            if not self.stream.put(packet):
+                # Aborted, nothing takes packets any more.
+                return
+            if self._stream_thread is None and self.stream.waiting >= min(4, self.stream.depth):
+                self._start_stream()
+        if final and self._stream_thread is None:
+            self._start_stream()
+
+    def _start_stream(self):
+        self._stream_thread = threading.Thread(
+            target=self._run_stream, args=(self.stream,), name="balor-stream", daemon=True
+        )
+        self._stream_thread.start()
+
+    def _run_stream(self, stream):
+        """
+        Runs the streamed job, and stops the stream however that ends: an abort before the first
+        packet or a failed connection must not leave plot() waiting to put packets nobody takes.
+        """
+        try:
+            self.connection.execute(stream, 1)
+        except Exception as e:
+            stream.stop(e)
+        finally:
+            stream.stop()
+
+    def _drop_stream(self):
+        """
+        Forgets the streamed job. Returns the stream and the thread running it, if any.
+        """
+        stream, thread = self.stream, self._stream_thread
+        self.stream = None
+        self._stream_job = None
+        self._stream_on = None
+        self._stream_thread = None
+        return stream, thread
 
     def light(self, job):
         """
@@ -297,9 +450,24 @@ class BalorDriver(Parameters):
         :return:
         """
         self.connect_if_needed()
-        job = self.cutcode_to_mark_job(self.queue)
-        self.queue = []
-        self.connection.execute(job, 1)
+        if self.stream is not None:
+            # Streamed: send what is left and wait for it to finish.
+            with self._stream_lock:
+                try:
+                    if not self.stream.stopped:
+                        self._stream_job.laser_control(False)
+                        self._flush_stream(final=True)
+                        self.stream.close()
+                finally:
+                    stream, thread = self._drop_stream()
+            if thread is not None:
+                thread.join()
+            if stream is not None and stream.error is not None:
+                raise stream.error
+        else:
+            job = self.cutcode_to_mark_job(self.queue)
+            self.queue = []
+            self.connection.execute(job, 1)
         if self.redlight_preferred:
             self.connection.light_on()
         else:
@@ -336,7 +504,7 @@ class BalorDriver(Parameters):
         if self.native_y < 0:
             self.native_y = 0
 
-        self.connection.set_xy(self.native_x, self.native_y)
+        self.connection.stream_xy(self.native_x, self.native_y)
 
     def move_rel(self, dx, dy):
         """
@@ -370,7 +538,7 @@ class BalorDriver(Parameters):
         if self.native_y < 0:
             self.native_y = 0
 
-        self.connection.set_xy(self.native_x, self.native_y)
+        self.connection.stream_xy(self.native_x, self.native_y)
 
     def home(self, x=None, y=None):
         """
@@ -496,7 +664,12 @@ class BalorDriver(Parameters):
 
         :return:
         """
+        stream = self.stream
+        if stream is not None:
+            stream.stop()
         self.connection.abort()
+        with self._stream_lock:
+            self._drop_stream()
 
     def status(self):
         """
@@ -7,6 +7,7 @@ from meerk40t.kernel import Service
 from meerk40t.svgelements import Point, Path, SVGImage, Polygon, Shape, Angle, Matrix
 
 import balor
+import balor.calcor
 from balor.Cal import Cal
 from balor.command_list import CommandList
 from balormk.BalorDriver import BalorDriver
@@ -72,6 +73,36 @@ class BalorDevice(Service, ViewPort):
                 "label": _("Calibration File"),
                 "tip": _("Provide a calibration file for the machine"),
             },
+            {
+                "attr": "cal_backend",
+                "object": self,
+                "default": "auto",
+                "type": str,
+                "label": _("Calibration Backend"),
+                "tip": _(
+                    "Interpolation used for the calibration: auto, rbf, local, spline, linear or lut."
+                ),
+            },
+            {
+                "attr": "cal_accuracy",
+                "object": self,
+                "default": 0.25,
+                "type": float,
+                "label": _("Calibration Accuracy (mm)"),
+                "tip": _(
+                    "The auto backend picks the fastest interpolation within this leave-one-out error."
+                ),
+            },
+            {
+                "attr": "cal_on_board",
+                "object": self,
+                "default": False,
+                "type": bool,
+                "label": _("Calibrate on the board"),
+                "tip": _(
+                    "Upload the calibration as the board's correction table at connect, in place of the correction file, and send jobs uncorrected."
+                ),
+            },
             {
                 "attr": "corfile_enabled",
                 "object": self,
@@ -88,6 +119,26 @@ class BalorDevice(Service, ViewPort):
                 "label": _("Correction File"),
                 "tip": _("Provide a correction file for the machine"),
             },
+            {
+                "attr": "always_send_correction",
+                "object": self,
+                "default": False,
+                "type": bool,
+                "label": _("Always send correction table"),
+                "tip": _(
+                    "Send the correction table on every connect, even if the board was already sent the same table."
+                ),
+            },
+            {
+                "attr": "always_init",
+                "object": self,
+                "default": False,
+                "type": bool,
+                "label": _("Always initialize fully"),
+                "tip": _(
+                    "Reset the board and send every setting on every connect. Otherwise a board this session connected to before, whose galvo still reports the position it was last known at, is only sent the settings that changed, e.g. after a USB hiccup."
+                ),
+            },
             {
                 "attr": "lens_size",
                 "object": self,
@@ -192,6 +243,16 @@ class BalorDevice(Service, ViewPort):
                 "label": _("Polygon Delay"),
                 "tip": _("Delay amount between different points in the path travel."),
             },
+            {
+                "attr": "curve_tolerance",
+                "object": self,
+                "default": 1.0,
+                "type": float,
+                "label": _("Curve Tolerance"),
+                "tip": _(
+                    "Curves are marked as straight lines within this many galvo units of the curve."
+                ),
+            },
         ]
         self.register_choices("balor-global", choices)
 
@@ -332,6 +393,76 @@ class BalorDevice(Service, ViewPort):
                 "label": _("Fly Res, Parameter 4"),
                 "tip": _("Unknown"),
             },
+            {
+                "attr": "list_handshake",
+                "object": self,
+                "default": "packet",
+                "type": str,
+                "label": _("List handshake"),
+                "tip": _(
+                    "packet: end of list and execute after every list packet, as EzCad does. start: only after the first packet of each loop."
+                ),
+            },
+            {
+                "attr": "list_buffer_packets",
+                "object": self,
+                "default": 0,
+                "type": int,
+                "label": _("List buffer packets"),
+                "tip": _(
+                    "Packets sent without checking the board is ready with the start handshake. 0 checks every packet. Larger than the board's buffer stalls or fails the job."
+                ),
+            },
+            {
+                "attr": "list_memory_packets",
+                "object": self,
+                "default": 0,
+                "type": int,
+                "label": _("List memory packets"),
+                "tip": _(
+                    "Light and looped jobs up to this many packets are sent once and run again from the board's list memory. 0 sends them every time; they are still only compiled once."
+                ),
+            },
+            {
+                "attr": "usb_record",
+                "object": self,
+                "default": "",
+                "type": str,
+                "label": _("Record USB traffic"),
+                "tip": _(
+                    "File to record every command, list packet and reply of the connection to, for replay with balor.recording.ReplayConnection. Empty records nothing."
+                ),
+            },
+            {
+                "attr": "stream_jobs",
+                "object": self,
+                "default": False,
+                "type": bool,
+                "label": _("Stream jobs"),
+                "tip": _(
+                    "Compile cutcode as the spooler plans it and send each list packet as soon as it is ready, so marking starts straight away and the job is never held in memory whole. If planning falls behind the board, the board waits for it mid job."
+                ),
+            },
+            {
+                "attr": "stream_packets",
+                "object": self,
+                "default": 16,
+                "type": int,
+                "label": _("Stream packets"),
+                "tip": _(
+                    "List packets of a streamed job compiled ahead of the board, at most."
+                ),
+            },
+            {
+                "attr": "jog_rate",
+                "object": self,
+                "default": 200.0,
+                "type": float,
+                "label": _("Jog rate"),
+                "tip": _(
+                    "Most galvo moves a second sent while jogging or following the pointer. Moves coming in faster are coalesced, only the newest is sent. 0 sends as fast as the board answers."
+                ),
+            },
         ]
         self.register_choices("balor-extra", choices)
 
@@ -352,6 +483,10 @@ class BalorDevice(Service, ViewPort):
         self.add_service_delegate(self.spooler)
 
         self.viewbuffer = ""
+        self._calibration = None
+        self._calibration_key = None
+        self._correction_data = None
+        self._correction_cal = None
 
         @self.console_command(
             "spool",
@@ -446,15 +581,7 @@ class BalorDevice(Service, ViewPort):
             """
             channel("Creating mark job out of elements.")
             paths = data
-            from balor.Cal import Cal
-
-            cal = None
-            if self.calibration_file is not None:
-                try:
-                    cal = Cal(self.calibration_file)
-                except TypeError:
-                    pass
-            job = CommandList(cal=cal)
+            job = CommandList(cal=self.job_calibration)
             job.set_mark_settings(
                 travel_speed=self.travel_speed
                 if travel_speed is None
@@ -533,13 +660,7 @@ class BalorDevice(Service, ViewPort):
         ):
             channel("Creating light job out of elements.")
             paths = data
-            cal = None
-            if self.calibration_file is not None:
-                try:
-                    cal = Cal(self.calibration_file)
-                except TypeError:
-                    pass
-            job = CommandList(cal=cal)
+            job = CommandList(cal=self.job_calibration)
             if travel_speed is None:
                 travel_speed = self.travel_speed
             if simulation_speed is None:
@@ -716,6 +837,44 @@ class BalorDevice(Service, ViewPort):
             self.spooler.set_idle(("light", data))
             return "balor", data
 
+        @self.console_option(
+            "once",
+            "o",
+            type=bool,
+            action="store_true",
+            help=_("do not re-arm after the job"),
+        )
+        @self.console_command(
+            "arm",
+            help=_("stage the job to run on each press of the footswitch"),
+            input_type="balor",
+            output_type="balor",
+        )
+        def balor_arm(command, channel, _, data=None, once=False, remainder=None, **kwgs):
+            self.driver.connect_if_needed()
+            connection = self.driver.connection
+
+            def progress(kind, loop_index, packet_index):
+                if kind == "fired":
+                    channel(
+                        _("Footswitch: fired in {latency:.1f}ms").format(
+                            latency=connection.trigger_latency * 1e3
+                        )
+                    )
+
+            connection.arm(data, rearm=not once, callback_progress=progress)
+            channel(_("Armed: press the footswitch to run {job}.").format(job=str(data)))
+            return "balor", data
+
+        @self.console_command(
+            "disarm",
+            help=_("stop waiting for the footswitch"),
+            input_type=(None, "balor"),
+        )
+        def balor_disarm(command, channel, _, data=None, remainder=None, **kwgs):
+            self.driver.connection.disarm()
+            channel(_("Disarmed."))
+
         @self.console_argument("x", type=float, default=0.0)
         @self.console_argument("y", type=float, default=0.0)
         @self.console_command(
@@ -791,12 +950,185 @@ class BalorDevice(Service, ViewPort):
                     )
                 )
 
+        @self.console_option(
+            "output",
+            "o",
+            type=str,
+            help=_("write the statistics to this file as JSON"),
+        )
+        @self.console_option(
+            "reset",
+            "r",
+            type=bool,
+            action="store_true",
+            help=_("reset the statistics after reporting them"),
+        )
+        @self.console_command(
+            "usbstats",
+            help=_("Reports USB latency, throughput and waits."),
+        )
+        def balor_usbstats(
+            command, channel, _, output=None, reset=False, remainder=None, **kwgs
+        ):
+            connection = self.driver.connection
+            stats = connection.usb_stats()
+            usb = stats["connection"]
+            if usb is None:
+                channel(_("Not connected."))
+                return
+            channel(
+                "{elapsed:.1f}s: {written} bytes written, {read} bytes read, "
+                "{rate:.0f} bytes/s, {timeouts} timeouts, {errors} errors".format(
+                    elapsed=usb["elapsed"],
+                    written=usb["bytes_written"],
+                    read=usb["bytes_read"],
+                    rate=usb["bytes_per_second"],
+                    timeouts=usb["timeouts"],
+                    errors=usb["errors"],
+                )
+            )
+            chunks = usb["list_chunks"]
+            channel(
+                "List chunks: {count}, mean {mean:.2f}ms, p99 {p99:.2f}ms, {rate:.0f} bytes/s".format(
+                    count=chunks["count"],
+                    mean=chunks["mean"] * 1e3,
+                    p99=chunks["p99"] * 1e3,
+                    rate=usb["chunk_bytes_per_second"],
+                )
+            )
+            for name, write in usb["writes"].items():
+                read = usb["reads"].get(name)
+                channel(
+                    "{name:>22}: {count:6d} x write {write:.3f}ms{read}".format(
+                        name=name,
+                        count=write["count"],
+                        write=write["mean"] * 1e3,
+                        read=""
+                        if read is None
+                        else ", read {mean:.3f}ms (p99 {p99:.3f}ms)".format(
+                            mean=read["mean"] * 1e3, p99=read["p99"] * 1e3
+                        ),
+                    )
+                )
+            connect = stats["connect"]
+            if connect["time"] is not None:
+                channel(
+                    "Connect: {kind} in {time:.1f}ms, {commands} setting commands, "
+                    "correction table {table}".format(
+                        kind="reconnected" if connect["verified"] else "initialized",
+                        time=connect["time"] * 1e3,
+                        commands=connect["commands"],
+                        table="kept"
+                        if connect["correction_time"] is None
+                        else "sent in {:.1f}ms".format(connect["correction_time"] * 1e3),
+                    )
+                )
+            monitor = stats["monitor"]
+            channel(
+                "Status polls: {polls} at {rate:.1f}/s, change detected in {detect:.2f}ms mean".format(
+                    polls=monitor["polls"],
+                    rate=monitor["poll_rate"],
+                    detect=monitor["detect_latency_mean"] * 1e3,
+                )
+            )
+            for kind, wait in monitor["wait_by_kind"].items():
+                channel(
+                    "Waiting for {kind}: {count} waits, {total:.3f}s total".format(
+                        kind=kind, count=wait["count"], total=wait["total"]
+                    )
+                )
+            send = stats["send"]
+            if send is not None:
+                channel(
+                    "Last job: {packets} packets in {seconds:.3f}s, "
+                    "{rtp:.2f} round trips per packet, {rate:.0f} bytes/s".format(
+                        packets=send["packets"],
+                        seconds=send["seconds"],
+                        rtp=send["round_trips_per_packet"],
+                        rate=send["bytes_per_second"],
+                    )
+                )
+            loops = stats["loops"]
+            if loops["refresh"]["count"]:
+                channel(
+                    "Runs: {count} at {rate:.1f}/s, {restarts} restarted from list memory, "
+                    "{reused} sent precompiled".format(
+                        count=loops["refresh"]["count"],
+                        rate=loops["refresh_rate"],
+                        restarts=loops["restarts"],
+                        reused=loops["reused"],
+                    )
+                )
+            trigger = stats["trigger"]
+            if trigger["fired"]["count"]:
+                channel(
+                    "Footswitch: fired {count} times, {mean:.2f}ms mean and {max:.2f}ms worst "
+                    "after the press was seen, seen within {window:.2f}ms of it".format(
+                        count=trigger["fired"]["count"],
+                        mean=trigger["fired"]["mean"] * 1e3,
+                        max=trigger["fired"]["max"] * 1e3,
+                        window=trigger["window"]["max"] * 1e3,
+                    )
+                )
+            positions = stats["positions"]
+            if positions["requests"]:
+                channel(
+                    "Jog: {requests} moves, {sent} sent at {rate:.0f}/s, "
+                    "lag mean {mean:.1f}ms, p99 {p99:.1f}ms".format(
+                        requests=positions["requests"],
+                        sent=positions["sent"],
+                        rate=positions["rate"],
+                        mean=positions["lag"]["mean"] * 1e3,
+                        p99=positions["lag"]["p99"] * 1e3,
+                    )
+                )
+            if output is not None:
+                import json
+
+                with open(output, "w") as f:
+                    json.dump(stats, f, indent=1)
+                channel(_("Wrote {file}").format(file=os.path.realpath(output)))
+            if reset:
+                connection.reset_usb_stats()
+
+        @self.console_option(
+            "backend",
+            "b",
+            type=str,
+            help=_("calibration backend: auto, rbf, local, spline, linear or lut"),
+        )
+        @self.console_option(
+            "accuracy",
+            "a",
+            type=float,
+            help=_("accuracy bound in mm for the auto backend"),
+        )
         @self.console_argument("filename", type=str, default=None)
         @self.console_command(
             "calibrate",
             help=_("set the calibration file"),
         )
-        def set_calfile(command, channel, _, filename=None, remainder=None, **kwgs):
+        def set_calfile(
+            command,
+            channel,
+            _,
+            filename=None,
+            backend=None,
+            accuracy=None,
+            remainder=None,
+            **kwgs
+        ):
+            if backend is not None:
+                if backend != "auto" and backend not in balor.Cal.BACKENDS:
+                    channel(
+                        "Unknown backend {backend}, use auto, {names}.".format(
+                            backend=backend, names=", ".join(balor.Cal.BACKENDS)
+                        )
+                    )
+                    return
+                self.cal_backend = backend
+            if accuracy is not None:
+                self.cal_accuracy = accuracy
             if filename is None:
                 calfile = self.calfile
                 if calfile is None:
@@ -809,11 +1141,46 @@ class BalorDevice(Service, ViewPort):
 
                     if exists(calfile):
                         channel("Calibration file exists!")
-                        cal = balor.Cal.Cal(calfile)
-                        if cal.enabled:
-                            channel("Calibration file successfully loads.")
-                        else:
+                        # The calibration jobs use, only reloaded if the options
+                        # above changed the backend settings.
+                        cal = self._load_calibration(calfile)
+                        if cal is None:
                             channel("Calibration file does not load.")
+                            return
+                        channel("Calibration file successfully loads.")
+                        channel(
+                            "Backend: {backend} ({setting}, grid: {grid})".format(
+                                backend=cal.backend,
+                                setting=self.cal_backend,
+                                grid="yes" if cal.grid is not None else "no",
+                            )
+                        )
+                        for r in cal.report:
+                            channel(
+                                "{backend:>8}: {single:.1f}us/pt single, {batch:.2f}us/pt batch, "
+                                "max error {max_error:.3f}mm, mean error {mean_error:.3f}mm".format(
+                                    backend=r["backend"],
+                                    single=r["single"] * 1e6,
+                                    batch=r["batch"] * 1e6,
+                                    max_error=r["max_error"],
+                                    mean_error=r["mean_error"],
+                                )
+                            )
+                        max_error, mean_error = cal.round_trip_error()
+                        channel(
+                            "Inverse round trip error: max {max_error:.4f}mm, mean {mean_error:.4f}mm".format(
+                                max_error=max_error, mean_error=mean_error
+                            )
+                        )
+                        table = balor.calcor.correction_table(cal)
+                        channel(
+                            "On-board correction: largest offset {offset} galvo, "
+                            "lens size {x:.2f}mm x {y:.2f}mm".format(
+                                offset=int(abs(table).max()),
+                                x=cal.linear_y * 0xFFFF,
+                                y=cal.linear_x * 0xFFFF,
+                            )
+                        )
                     else:
                         channel("WARNING: Calibration file does not exist.")
             else:
@@ -879,7 +1246,10 @@ class BalorDevice(Service, ViewPort):
             if bounds is None:
                 channel(_("Nothing Selected"))
                 return
-            cal = balor.Cal.Cal(self.calibration_file)
+            cal = self.calibration
+            if cal is None:
+                channel(_("No calibration file enabled."))
+                return
 
             x0 = bounds[0] * self.get_native_scale_x
             y0 = bounds[1] * self.get_native_scale_y
@@ -894,6 +1264,14 @@ class BalorDevice(Service, ViewPort):
                     cx=cx, cy=cy, mx=mx, my=my
                 )
             )
+            if self.driver.connected:
+                gx, gy = self.driver.connection.get_xy()
+                mx, my = cal.inverse(gx, gy)
+                channel(
+                    "Galvo position: ({gx}, {gy}) = ({mx:.3f}mm, {my:.3f}mm)".format(
+                        gx=gx, gy=gy, mx=mx, my=my
+                    )
+                )
 
         @self.console_argument("lens_size", type=str, default=None)
         @self.console_command(
@@ -1131,13 +1509,7 @@ class BalorDevice(Service, ViewPort):
                 gsmin = grayscale_min
                 gsmax = grayscale_max
                 gsslope = (gsmax - gsmin) / 256.0
-            cal = None
-            if self.calibration_file is not None:
-                try:
-                    cal = Cal(self.calibration_file)
-                except TypeError:
-                    pass
-            job = CommandList(cal=cal)
+            job = CommandList(cal=self.job_calibration)
 
             img = scipy.interpolate.RectBivariateSpline(
                 np.linspace(y0, y0 + height, in_file.size[1]),
@@ -1279,15 +1651,7 @@ class BalorDevice(Service, ViewPort):
             polygon_delay=None,
             **kwargs
         ):
-            from balor.Cal import Cal
-
-            cal = None
-            if self.calibration_file is not None:
-                try:
-                    cal = Cal(self.calibration_file)
-                except TypeError:
-                    pass
-            job = CommandList(cal=cal)
+            job = CommandList(cal=self.job_calibration)
             job.set_mark_settings(
                 travel_speed=self.travel_speed
                 if travel_speed is None
@@ -1395,3 +1759,54 @@ class BalorDevice(Service, ViewPort):
             return self.calfile
         else:
             return None
+
+    @property
+    def calibration(self):
+        """
+        Cal object for the enabled calibration file. Loading benchmarks the backends so the
+        object is kept until the file or the backend settings change.
+        """
+        calfile = self.calibration_file
+        if calfile is None:
+            return None
+        return self._load_calibration(calfile)
+
+    def _load_calibration(self, calfile):
+        """Cal object for calfile with the backend settings, None if it does not load."""
+        key = (calfile, self.cal_backend, self.cal_accuracy)
+        if key != self._calibration_key:
+            try:
+                self._calibration = Cal(
+                    calfile, backend=self.cal_backend, accuracy=self.cal_accuracy
+                )
+            except (TypeError, ValueError, IndexError):
+                self._calibration = None
+            self._calibration_key = key
+        return self._calibration
+
+    @property
+    def job_calibration(self):
+        """
+        Calibration for compiling jobs. None when the calibration is on the board, jobs are
+        then sent in linear galvo space and the board's correction table does the rest.
+        """
+        if self.cal_on_board:
+            return None
+        return self.calibration
+
+    @property
+    def correction_data(self):
+        """
+        .cor contents generated from the calibration when it is on the board, otherwise None.
+        """
+        if not self.cal_on_board:
+            return None
+        cal = self.calibration
+        if cal is None:
+            return None
+        if cal is not self._correction_cal:
+            self._correction_data = balor.calcor.encode_correction_table(
+                balor.calcor.correction_table(cal)
+            )
+            self._correction_cal = cal
+        return self._correction_data
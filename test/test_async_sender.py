@@ -0,0 +1,149 @@
+import asyncio
+import threading
+import unittest
+
+from balor.async_sender import AsyncSender
+from balor.command_list import CommandList, CommandSource
+from balor.emulator import EmulatedConnection
+
+# Set as a test's session ends, so no endless job outlives it.
+closing = threading.Event()
+
+
+def marking_job(marks=20):
+    job = CommandList()
+    job.set_frequency(30)
+    job.set_power(50)
+    job.set_laser_on_delay(100)
+    job.set_laser_off_delay(100)
+    job.set_polygon_delay(10)
+    job.set_travel_speed(4000)
+    job.set_cut_speed(1000)
+    for n in range(marks):
+        x = 0x6000 + n * 0x100
+        job.goto(x, 0x6000)
+        job.mark(x, 0x7000)
+    return job
+
+
+class FailingJob(CommandSource):
+    def packet_generator(self):
+        raise ValueError("compile failed")
+        yield
+
+
+class StartedJob(CommandSource):
+    """Job that runs until the session ends, sets started when its first packet is taken."""
+
+    def __init__(self):
+        self.started = threading.Event()
+        self.packet = bytes(marking_job().packet_generator().__next__())
+
+    def packet_generator(self):
+        while not closing.is_set():
+            self.started.set()
+            yield self.packet
+
+
+def run(test):
+    async def session():
+        closing.clear()
+        sender = AsyncSender()
+        await sender.open(mock=EmulatedConnection(time_scale=1.0))
+        try:
+            return await test(sender)
+        finally:
+            closing.set()
+            await sender.close()
+
+    return asyncio.run(asyncio.wait_for(session(), 30))
+
+
+async def wait_event(event):
+    while not event.is_set():
+        await asyncio.sleep(0.01)
+
+
+class TestAsyncSender(unittest.TestCase):
+    def test_execute_completes(self):
+        async def test(sender):
+            events = []
+
+            async def collect():
+                async for event in sender.progress():
+                    events.append(event.kind)
+                    if event.kind == "finished":
+                        return
+
+            collector = asyncio.ensure_future(collect())
+            await asyncio.sleep(0)
+            completed = await sender.execute(marking_job())
+            await collector
+            return completed, events
+
+        completed, events = run(test)
+        self.assertTrue(completed)
+        self.assertEqual(events[0], "started")
+        self.assertIn("packet", events)
+        self.assertEqual(events[-1], "finished")
+
+    def test_abort_running_job(self):
+        async def test(sender):
+            job = StartedJob()
+            task = asyncio.ensure_future(sender.execute(job))
+            await wait_event(job.started)
+            await sender.abort()
+            return await task
+
+        self.assertFalse(run(test))
+
+    def test_cancel_running_job(self):
+        async def test(sender):
+            job = StartedJob()
+            task = asyncio.ensure_future(sender.execute(job))
+            await wait_event(job.started)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+            # The job thread let go of the board: another job runs to completion.
+            return await sender.execute(marking_job())
+
+        self.assertTrue(run(test))
+
+    def test_cancel_queued_jobs(self):
+        async def test(sender):
+            running = StartedJob()
+            queued = [StartedJob() for _ in range(3)]
+            first = asyncio.ensure_future(sender.execute(running))
+            await wait_event(running.started)
+            tasks = [asyncio.ensure_future(sender.execute(job)) for job in queued]
+            await asyncio.sleep(0.05)
+            for task in tasks:
+                task.cancel()
+            done, pending = await asyncio.wait(tasks, timeout=5)
+            cancelled = len(pending) == 0 and all(task.cancelled() for task in done)
+            # Cancelling the queued jobs leaves the running one running.
+            await asyncio.sleep(0.1)
+            still_running = not first.done()
+            await sender.abort()
+            aborted = not await asyncio.wait_for(first, 5)
+            return cancelled, still_running, aborted, [job.started.is_set() for job in queued]
+
+        cancelled, still_running, aborted, started = run(test)
+        self.assertTrue(cancelled)
+        self.assertTrue(still_running)
+        self.assertTrue(aborted)
+        self.assertEqual(started, [False, False, False])
+
+    def test_exception_propagates(self):
+        async def test(sender):
+            with self.assertRaises(ValueError):
+                await sender.execute(FailingJob())
+            # The sender is usable after the failed job.
+            return await sender.execute(marking_job())
+
+        self.assertTrue(run(test))
+
+
+if __name__ == "__main__":
+    unittest.main()